@@ -2,8 +2,9 @@
 
 from fastapi import APIRouter
 
-from apis.routers import admin_login, admin_mgmt
+from apis.routers import admin_farms, admin_login, admin_mgmt
 from apis.routers import create_user, update_user
+from apis.routers import internal, internal_metrics
 
 
 api_routers = APIRouter()
@@ -14,6 +15,7 @@ prefix = '/admin'  # pylint: disable=[C0103]
 tags = ['Admin']
 api_routers.include_router(admin_login.router, prefix=prefix, tags=tags, include_in_schema=admin_schema)
 api_routers.include_router(admin_mgmt.router, prefix=prefix, tags=tags, include_in_schema=admin_schema)
+api_routers.include_router(admin_farms.router, prefix=prefix, tags=tags, include_in_schema=admin_schema)
 
 
 # User
@@ -21,3 +23,11 @@ prefix = '/user'  # pylint: disable=[C0103]
 tags = ['User']
 api_routers.include_router(create_user.router, prefix=prefix, tags=tags)
 api_routers.include_router(update_user.router, prefix=prefix, tags=tags)
+
+
+# Internal
+internal_schema = False  # pylint: disable=[C0103]
+prefix = '/internal'  # pylint: disable=[C0103]
+tags = ['Internal']
+api_routers.include_router(internal.router, prefix=prefix, tags=tags, include_in_schema=internal_schema)
+api_routers.include_router(internal_metrics.router, prefix=prefix, tags=tags, include_in_schema=internal_schema)
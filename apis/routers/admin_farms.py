@@ -0,0 +1,514 @@
+'''This module manages the farms ingestion, synchronization, lookup, geospatial query, analytics and export FastAPI routers.'''
+
+import time
+from typing import AsyncIterator
+import numpy as np
+from fastapi import APIRouter, Depends, Query, Request, status
+from sqlalchemy import and_, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from apis.schemas.export import ExportFormat
+from apis.schemas.farm import (
+    FarmFilters, FarmGroup, FarmMetric, FarmResponse, FarmsAnalyticsResponse, FarmsIngestResponse, FarmsResponse, FarmsSyncResponse, IngestFormat
+)
+from apis.schemas.page import PageResponse
+from database import crud, models
+from database.session import get_db
+from database.snapshot import TableSnapshot
+from helpers.api_exceptions import ResponseValidationError
+from helpers.analytics import group_by as aggregate_groups
+from helpers.api_responses import ORJSONResponse
+from helpers.export import export_response, select_columns
+from helpers.geo import BBox, Candidates, MAX_DISTANCE_KM, cell_ranges, nearest, within_radius
+from helpers.ingestion import Field, IngestionError, csv_rows, ingest, ndjson_rows
+from helpers.lru_caching import SingleFlight, TTLCache
+from helpers.profiling import ProfiledRoute
+from helpers.response_cache import cached_response
+from security.admin import get_current_active_admin
+
+
+router = APIRouter(route_class=ProfiledRoute, dependencies=[Depends(get_current_active_admin)])
+
+RANGES = dict(
+    Latitude=(-90, 90),
+    Longitude=(-180, 180),
+    FarmSize=(0, None),
+    EffectiveArea=(0, None),
+    PlantAge=(0, None),
+    SphaSurvival=(0, None)
+)
+KINDS = dict(Float='float', Boolean='bool')
+
+
+def farm_fields() -> list[Field]:
+    '''Upload columns derived from the farms table, except the generated ones (primary key, computed and default values).'''
+    return [
+        Field(c.name, KINDS.get(type(c.type).__name__, 'str'), not c.nullable, *RANGES.get(c.name, (None, None)))
+        for c in models.FarmsTable.__table__.columns if not (c.primary_key or c.computed is not None or c.server_default is not None)
+    ]
+
+
+FIELDS = farm_fields()
+COLUMNS = [x.name for x in FIELDS]
+FARM_COLUMNS = ['id', *COLUMNS, 'created_at', 'updated_at']
+CATEGORIES = ('GroupScheme', 'Country', 'Province', 'AreaTypeName', 'ProductGroup', 'GenusName', 'SpeciesName')  # low-cardinality columns
+
+# farms held in memory column by column, for the lookups and filters of the read routes
+farms_snapshot = TableSnapshot(
+    table=models.FarmsTable,
+    columns=dict(id='int', **{x.name: 'category' if x.name in CATEGORIES else x.kind for x in FIELDS}, created_at='datetime', updated_at='datetime'),
+    unique=('FarmId',)
+)
+
+Latitude = Query(ge=-90, le=90)
+Longitude = Query(ge=-180, le=180)
+
+# analytics results per table version and parameters, older versions are evicted as least recently used
+analytics_cache = TTLCache(ttl=3600, maxsize=128)
+analytics_flight = SingleFlight()
+
+
+def upload_rows(request: Request, upload_format: IngestFormat | None) -> AsyncIterator[dict | None]:
+    '''Parse the rows of an upload streamed as the request body, its format is read from the Content-Type header by default.'''
+    content_type = request.headers.get('content-type', '')
+    if upload_format is None and 'csv' in content_type:
+        upload_format = IngestFormat.CSV
+    elif upload_format is None and ('ndjson' in content_type or 'jsonlines' in content_type):
+        upload_format = IngestFormat.NDJSON
+
+    if upload_format == IngestFormat.CSV:
+        return csv_rows(request.stream(), required=[x.name for x in FIELDS if x.required])
+    if upload_format == IngestFormat.NDJSON:
+        return ndjson_rows(request.stream())
+    raise ResponseValidationError(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        message='Unknown upload format, it must be one of the following: csv | ndjson.'
+    )
+
+
+@router.post('/farms/ingest', status_code=status.HTTP_200_OK, response_model=FarmsIngestResponse)
+async def ingest_farms(
+    request: Request,
+    upload_format: IngestFormat | None = Query(default=None, alias='format'),
+    db: AsyncSession = Depends(get_db)
+):
+    '''
+    Ingest new farms from a CSV or NDJSON upload streamed as the request body, invalid rows and farms that already exist
+    (FarmId of an existing farm or of an earlier row) are skipped and reported. Each batch of rows is committed on its own,
+    so that the batches before a database error are kept.
+
+        :param format [str]: Upload format, it must be one of the following: csv | ndjson. By default, it is read from the Content-Type header.
+
+        :returns [FarmsIngestResponse]: Number of rows, inserted and rejected rows, errors of the first rejected rows, and throughput.
+
+        :raises [HTTPException]:
+            :[400] Bad request: Unknown upload format, or missing CSV columns.
+            :[409] Conflict: Unable to add objects to database.
+    '''
+
+    async def write(records: list[tuple]) -> dict[int, dict]:
+        rejected = await crud.copy_objects(
+            db=db,
+            table=models.FarmsTable,
+            columns=COLUMNS,
+            records=records,
+            conflict=['FarmId'],
+            exc_message='Unable to add farms to the database.'
+        )
+        return {i: dict(FarmId='it already exists, use /admin/farms/sync to update existing farms') for i in rejected}
+
+    # stream, validate and copy the rows batch by batch
+    try:
+        report = await ingest(rows=upload_rows(request, upload_format), fields=FIELDS, write=write)
+    except IngestionError as e:
+        raise ResponseValidationError(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            message=str(e)) from e
+    finally:
+        farms_snapshot.expire()
+
+    return FarmsIngestResponse(
+        message=f'{report["valid"]} farms have successfully been ingested.',
+        rows=report['rows'],
+        inserted=report['valid'],
+        rejected=report['rejected'],
+        errors=report['errors'],
+        seconds=report['seconds'],
+        rowsPerSecond=report['rows_per_second']
+    )
+
+
+def kept_missing_farms(report: dict) -> str | None:
+    '''Reason why the active farms missing from a sync dataset must not be deactivated, None if the dataset is complete.'''
+    if report['rejected']:
+        return 'some rows are invalid'
+    if not report['valid']:
+        return 'the dataset is empty'
+    return None
+
+
+@router.post('/farms/sync', status_code=status.HTTP_200_OK, response_model=FarmsSyncResponse)
+async def sync_farms(
+    request: Request,
+    upload_format: IngestFormat | None = Query(default=None, alias='format'),
+    deactivate_missing: bool = False,
+    db: AsyncSession = Depends(get_db)
+):
+    '''
+    Synchronize farms with a full CSV or NDJSON dataset streamed as the request body, keyed by FarmId: new farms are inserted,
+    changed farms are updated, unchanged farms are not written. It runs in 1 transaction, invalid rows are skipped and reported.
+
+        :param format [str]: Upload format, it must be one of the following: csv | ndjson. By default, it is read from the Content-Type header.
+        :param deactivate_missing [bool]: Deactivate the active farms missing from the dataset, skipped if some rows are invalid or if it is empty.
+
+        :returns [FarmsSyncResponse]: Number of rows, inserted, updated, unchanged, deactivated and rejected rows, and throughput.
+
+        :raises [HTTPException]:
+            :[400] Bad request: Unknown upload format, or missing CSV columns.
+            :[409] Conflict: Unable to merge objects into database.
+    '''
+
+    start = time.perf_counter()
+
+    async def write(records: list[tuple]):
+        await crud.stage_objects(db=db, table=models.FarmsTable, columns=COLUMNS, records=records)
+
+    # stream, validate and stage the rows batch by batch
+    try:
+        report = await ingest(rows=upload_rows(request, upload_format), fields=FIELDS, write=write)
+    except IngestionError as e:
+        raise ResponseValidationError(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            message=str(e)) from e
+
+    # merge the staged rows, missing farms are only deactivated from a complete dataset
+    reason = kept_missing_farms(report)
+    deactivate = deactivate_missing and reason is None
+    merged = await crud.merge_objects(
+        db=db,
+        table=models.FarmsTable,
+        key='FarmId',
+        columns=COLUMNS,
+        compare='ContentHash',
+        deactivate='IsActive' if deactivate else None
+    )
+    farms_snapshot.expire()
+
+    seconds = time.perf_counter() - start
+    message = 'Farms have successfully been synchronized.'
+    if deactivate_missing and not deactivate:
+        message = f'Farms have successfully been synchronized, missing farms have not been deactivated since {reason}.'
+
+    return FarmsSyncResponse(
+        message=message,
+        rows=report['rows'],
+        inserted=merged['inserted'],
+        updated=merged['updated'],
+        unchanged=merged['unchanged'],
+        deactivated=merged['deactivated'],
+        rejected=report['rejected'],
+        errors=report['errors'],
+        seconds=seconds,
+        rowsPerSecond=report['rows'] / seconds if seconds else 0.0
+    )
+
+
+def bbox_conditions(bbox: BBox) -> list:
+    '''Filter conditions of the farms within a bounding box, its min longitude is greater than its max longitude if it crosses 180.'''
+    min_lat, min_lon, max_lat, max_lon = bbox
+    table = models.FarmsTable
+    if min_lon <= max_lon:
+        return [table.Latitude.between(min_lat, max_lat), and_(table.Longitude >= min_lon, table.Longitude <= max_lon)]
+    return [table.Latitude.between(min_lat, max_lat), or_(table.Longitude >= min_lon, table.Longitude <= max_lon)]
+
+
+def candidates(db: AsyncSession):
+    '''Coroutine function that fetches the ids and coordinates of the farms within a bounding box, pruned by grid cells.'''
+
+    async def fetch(bbox: BBox) -> Candidates:
+        rows = await crud.get_ranges(
+            db=db,
+            table=models.FarmsTable,
+            column='GeoCell',
+            ranges=cell_ranges(bbox),
+            columns=['id', 'Latitude', 'Longitude'],
+            where=bbox_conditions(bbox)
+        )
+        data = np.array(rows, dtype=np.float64).reshape(-1, 3)
+        return data[:, 0].astype(np.int64), data[:, 1], data[:, 2]
+    return fetch
+
+
+async def ranked_farms(db: AsyncSession, found: list[tuple]) -> list[dict]:
+    '''Fetch the farms found by a distance query, in the same order, with their distance.'''
+    farms = await crud.get_values(db=db, table=models.FarmsTable, column='id', values=[x[0] for x in found], columns=FARM_COLUMNS)
+    return [dict(farms[key], distanceKm=distance) for key, distance in found if key in farms]
+
+
+@router.get('/farms/bbox', status_code=status.HTTP_200_OK, response_model=FarmsResponse)
+async def retrieve_farms_bbox(
+    min_lat: float = Latitude,
+    min_lon: float = Longitude,
+    max_lat: float = Latitude,
+    max_lon: float = Longitude,
+    limit: int = Query(default=100, ge=1, le=1000),
+    db: AsyncSession = Depends(get_db)
+):
+    '''
+    Retrieve the farms within a bounding box, ordered by id.
+
+        :param min_lat [float]: South latitude.
+        :param min_lon [float]: West longitude, greater than the east longitude if the box crosses the 180th meridian.
+        :param max_lat [float]: North latitude.
+        :param max_lon [float]: East longitude.
+        :param limit [int]: Maximum number of farms.
+
+        :returns [FarmsResponse]: Farms.
+
+        :raises [HTTPException]:
+            :[400] Bad request: The south latitude is greater than the north latitude.
+    '''
+    if min_lat > max_lat:
+        raise ResponseValidationError(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            message='The south latitude must be lower than the north latitude.'
+        )
+
+    bbox = (min_lat, min_lon, max_lat, max_lon)
+    rows = await crud.get_ranges(
+        db=db,
+        table=models.FarmsTable,
+        column='GeoCell',
+        ranges=cell_ranges(bbox),
+        columns=FARM_COLUMNS,
+        where=bbox_conditions(bbox),
+        limit=limit
+    )
+    data = [dict(zip(FARM_COLUMNS, row)) for row in rows]
+    return ORJSONResponse(content=dict(message='Farms have successfully been found.', data=data, total=len(data)))
+
+
+@router.get('/farms/radius', status_code=status.HTTP_200_OK, response_model=FarmsResponse)
+async def retrieve_farms_radius(
+    lat: float = Latitude,
+    lon: float = Longitude,
+    radius: float = Query(gt=0, le=MAX_DISTANCE_KM),
+    limit: int = Query(default=100, ge=1, le=1000),
+    db: AsyncSession = Depends(get_db)
+):
+    '''
+    Retrieve the farms within a distance of a point, closest first.
+
+        :param lat [float]: Point latitude.
+        :param lon [float]: Point longitude.
+        :param radius [float]: Distance in km.
+        :param limit [int]: Maximum number of farms.
+
+        :returns [FarmsResponse]: Farms with their distance in km.
+    '''
+    found = await within_radius(candidates(db), lat, lon, radius, limit=limit)
+    data = await ranked_farms(db, found)
+    return ORJSONResponse(content=dict(message='Farms have successfully been found.', data=data, total=len(data)))
+
+
+@router.get('/farms/nearest', status_code=status.HTTP_200_OK, response_model=FarmsResponse)
+async def retrieve_farms_nearest(
+    lat: float = Latitude,
+    lon: float = Longitude,
+    k: int = Query(default=10, ge=1, le=1000),
+    db: AsyncSession = Depends(get_db)
+):
+    '''
+    Retrieve the k nearest farms of a point, closest first.
+
+        :param lat [float]: Point latitude.
+        :param lon [float]: Point longitude.
+        :param k [int]: Number of farms.
+
+        :returns [FarmsResponse]: Farms with their distance in km.
+    '''
+    found = await nearest(candidates(db), lat, lon, k)
+    data = await ranked_farms(db, found)
+    return ORJSONResponse(content=dict(message='Farms have successfully been found.', data=data, total=len(data)))
+
+
+async def farm_analytics(db: AsyncSession, version: tuple, keys: list[str], metrics: list[str], filters: dict, percentiles: list[float], bins: int) -> dict:
+    '''Aggregate farm metrics, cached per farms table version and parameters. Concurrent identical requests compute them once.'''
+    table = models.FarmsTable
+
+    # the table version is part of the key, so that any write makes the next request compute fresh results
+    key = (version, tuple(keys), tuple(metrics), tuple(sorted(filters.items())), tuple(percentiles), bins)
+    result = analytics_cache.get(key)
+    if result is not None:
+        return result
+
+    async def compute():
+        columns = await crud.get_columns(db=db, table=table, columns=[*keys, *metrics], where=[getattr(table, k) == v for k, v in filters.items()])
+        arrays = {name: np.array(values, dtype=None if name in keys else np.float64) for name, values in columns.items()}
+        value = aggregate_groups(arrays, keys=keys, metrics=metrics, percentiles=percentiles, bins=bins)
+        analytics_cache.set(key, value)
+        return value
+    return await analytics_flight.call_async(key, compute)
+
+
+@router.get('/farms/analytics', status_code=status.HTTP_200_OK, response_model=FarmsAnalyticsResponse)
+async def retrieve_farms_analytics(
+    request: Request,
+    group_by: list[FarmGroup] = Query(default=[]),
+    metrics: list[FarmMetric] = Query(default=list(FarmMetric)),
+    percentiles: list[float] = Query(default=[50, 90]),
+    bins: int = Query(default=0, ge=0, le=100),
+    filters: FarmFilters = Depends(),
+    db: AsyncSession = Depends(get_db)
+):
+    '''
+    Retrieve farm metric aggregates (count, sum, mean, min, max, percentiles and histograms) grouped by region, species or product.
+    Results are cached until the farms table changes, conditional requests get a 304 response.
+
+        :param request [Request]: Request.
+        :param group_by [list[str]]: Grouping columns, it must be any of the following: Country | Province | GenusName | SpeciesName | ProductGroup
+        :param metrics [list[str]]: Aggregated columns, it must be any of the following: FarmSize | EffectiveArea | PlantAge | SphaSurvival
+        :param percentiles [list[float]]: Percentiles to compute, between 0 and 100.
+        :param bins [int]: Number of histogram bins, shared by all groups, 0 for none.
+        :param filters [FarmFilters]: Farm filters: country, province, product_group, genus_name, species_name, is_active.
+
+        :returns [FarmsAnalyticsResponse]: Groups with their keys, count and metric aggregates, and histogram edges of each metric.
+
+        :raises [HTTPException]:
+            :[400] Bad request: Percentiles are not between 0 and 100.
+    '''
+    if any(not 0 <= x <= 100 for x in percentiles):
+        raise ResponseValidationError(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            message='Percentiles must be between 0 and 100.'
+        )
+
+    async def compute():
+        result = await farm_analytics(
+            db=db,
+            version=version,
+            keys=[x.value for x in dict.fromkeys(group_by)],
+            metrics=[x.value for x in dict.fromkeys(metrics)],
+            filters=filters.columns(),
+            percentiles=percentiles,
+            bins=bins
+        )
+        return ORJSONResponse(
+            content=dict(
+                message='Farm analytics have successfully been computed.',
+                data=result['groups'],
+                edges=result['edges'],
+                total=len(result['groups'])
+            )
+        )
+
+    version = await crud.get_version(db=db, table=models.FarmsTable)
+    return await cached_response(request, models.FarmsTable.__tablename__, version, compute)
+
+
+@router.get('/farms/export', status_code=status.HTTP_200_OK)
+async def export_farms(
+    export_format: ExportFormat = Query(default=ExportFormat.CSV, alias='format'),
+    columns: list[str] = Query(default=[]),
+    filters: FarmFilters = Depends(),
+    db: AsyncSession = Depends(get_db)
+):
+    '''
+    Export farms ordered by id as a CSV or NDJSON attachment, streamed from a server-side cursor.
+
+        :param format [str]: Export format, it must be one of the following: csv | ndjson
+        :param columns [list[str]]: Exported columns, all by default. CSV exports of the upload columns can be synchronized back.
+        :param filters [FarmFilters]: Farm filters: country, province, product_group, genus_name, species_name, is_active.
+
+        :returns [StreamingResponse]: Farms.
+
+        :raises [HTTPException]:
+            :[400] Bad request: Unknown columns.
+    '''
+    columns = select_columns(FARM_COLUMNS, columns)
+    table = models.FarmsTable
+    batches = crud.stream_columns(db=db, table=table, columns=columns, where=[getattr(table, k) == v for k, v in filters.columns().items()])
+    return await export_response(columns, batches, export_format.value, filename='farms')
+
+
+@router.get('/farms', status_code=status.HTTP_200_OK, response_model=PageResponse)
+async def retrieve_farms(
+    request: Request,
+    cursor: str | None = None,
+    size: int = Query(default=50, ge=1, le=1000),
+    filters: FarmFilters = Depends(),
+    db: AsyncSession = Depends(get_db)
+):
+    '''
+    Retrieve a page of farms ordered by id, served from the in-memory farms snapshot, or from the response cache until it changes.
+
+        :param request [Request]: Request, conditional requests get a 304 response.
+        :param cursor [str]: Cursor returned by the previous page.
+        :param size [int]: Page size.
+        :param filters [FarmFilters]: Farm filters: country, province, product_group, genus_name, species_name, is_active.
+
+        :returns [PageResponse]: Farms, next page cursor, and total number of farms matching the filters.
+
+        :raises [HTTPException]:
+            :[400] Bad request: Invalid cursor.
+    '''
+    snapshot = await farms_snapshot.get(db)
+
+    async def compute():
+        rows = snapshot.filter(filters.columns())
+        total = len(rows)
+        ids = snapshot.column('id')[rows]
+        if cursor:
+            _, after = crud.decode_cursor(cursor, 'id')
+            rows, ids = rows[ids > after], ids[ids > after]
+
+        # the first size + 1 ids are selected before being sorted, the next one tells if there is a next page
+        if len(ids) > size + 1:
+            first = np.argpartition(ids, size)[:size + 1]
+            rows, ids = rows[first], ids[first]
+        order = np.argsort(ids)
+        page = rows[order[:size]]
+        next_cursor = crud.encode_cursor('id', int(ids[order[size - 1]]), int(ids[order[size - 1]])) if len(ids) > size else None
+
+        return ORJSONResponse(
+            content=dict(
+                message='Farms have successfully been found.',
+                data=snapshot.rows(page, FARM_COLUMNS),
+                nextCursor=next_cursor,
+                total=total
+            )
+        )
+
+    return await cached_response(request, models.FarmsTable.__tablename__, farms_snapshot.version, compute)
+
+
+@router.get('/farms/{farm_id}', status_code=status.HTTP_200_OK, response_model=FarmResponse)
+async def retrieve_farm(
+    request: Request,
+    farm_id: str,
+    db: AsyncSession = Depends(get_db)
+):
+    '''
+    Retrieve a farm by its FarmId, served from the in-memory farms snapshot, or from the response cache until it changes.
+
+        :param request [Request]: Request, conditional requests get a 304 response.
+        :param farm_id [str]: Farm FarmId.
+
+        :returns [FarmResponse]: Farm.
+
+        :raises [HTTPException]:
+            :[404] Not found: Farm not found.
+    '''
+    snapshot = await farms_snapshot.get(db)
+
+    async def compute():
+        row = snapshot.find('FarmId', farm_id)
+        if row is None:
+            raise ResponseValidationError(
+                status_code=status.HTTP_404_NOT_FOUND,
+                message='Farm not found.'
+            )
+
+        return ORJSONResponse(content=dict(message='Farm has successfully been found.', data=snapshot.rows(np.array([row]), FARM_COLUMNS)[0]))
+
+    return await cached_response(request, models.FarmsTable.__tablename__, farms_snapshot.version, compute)
@@ -1,53 +1,136 @@
 '''This module is part of the /admin FastAPI router.'''
 
-from fastapi import APIRouter, Depends, status
-from fastapi_pagination import Page, paginate
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, Query, Request, status
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from apis.schemas.admin import CreateAdminRequest, UpdateAdminRequest, AdminsResponse, AdminResponse
+from apis.schemas.export import ExportFormat
+from apis.schemas.page import PageOrder, PageTotal
 from database import crud, models
 from database.session import get_db
+from helpers.api_responses import ORJSONResponse
+from helpers.export import export_response, select_columns
+from helpers.profiling import ProfiledRoute
+from helpers.response_cache import cached_response
 from security.admin import get_current_active_admin
 from security.hashing import SecureHash
-from helpers.misc import objects_to_dict_list
+from security.principals import broadcast_invalidation, principal_cache
 
 
-router = APIRouter(dependencies=[Depends(get_current_active_admin)])
+router = APIRouter(route_class=ProfiledRoute, dependencies=[Depends(get_current_active_admin)])
 
+# password hashes are never exported
+ADMIN_COLUMNS = [c.name for c in models.AdminsTable.__table__.columns if c.name != 'hashed_password']
+USER_COLUMNS = [c.name for c in models.UserTable.__table__.columns if c.name != 'hashed_password']
 
-@router.get('', status_code=status.HTTP_200_OK, response_model=Page[AdminsResponse])
+
+@router.get('', status_code=status.HTTP_200_OK, response_model=AdminsResponse)
 async def retrieve_admins(
-    db: Session = Depends(get_db)
+    request: Request,
+    cursor: str | None = None,
+    size: int = Query(default=50, ge=1, le=500),
+    order_by: PageOrder = PageOrder.ID,
+    total: PageTotal | None = None,
+    db: AsyncSession = Depends(get_db)
 ):
     '''
-    Retrieve admins from the database.
+    Retrieve a page of admins from the database, answered from its ETag validator or from the response cache
+    until the admins table changes.
+
+        :param request [Request]: Request, conditional requests get a 304 response.
+        :param cursor [str]: Cursor returned by the previous page.
+        :param size [int]: Page size.
+        :param order_by [str]: Page ordering, it must be one of the following: id | updated_at
+        :param total [str]: Count admins, it must be one of the following: exact | estimated
 
         :returns [AdminsResponse]: Admin accounts.
     '''
 
-    # get admin from the database
-    admin_objects = crud.get_table(
-        db=db,
-        table=models.AdminsTable,
-        exc_message='Unable to find admins.'
-    )
-
-    # parse admins
-    admins = objects_to_dict_list(admin_objects)
-    admins = [{k: v for k, v in d.items() if k in ['username', 'is_active', 'updated_at']} for d in admins]
+    async def compute():
+        # get a page of admins from the database
+        page = await crud.get_page(
+            db=db,
+            table=models.AdminsTable,
+            columns=['username', 'is_active', 'updated_at'],
+            order_by=order_by.value,
+            cursor=cursor,
+            size=size,
+            total=total.value if total else None
+        )
 
-    return paginate(
-        AdminsResponse(
-            message='Admins have successfully been found.',
-            data=admins
+        # pages are serialized by orjson directly, skipping the response model encoding of every item
+        return ORJSONResponse(
+            content=dict(
+                message='Admins have successfully been found.',
+                data=page['items'],
+                nextCursor=page['next_cursor'],
+                total=page['total']
+            )
         )
-    )
+
+    version = await crud.get_version(db=db, table=models.AdminsTable)
+    return await cached_response(request, models.AdminsTable.__tablename__, version, compute)
+
+
+@router.get('/export', status_code=status.HTTP_200_OK)
+async def export_admins(
+    export_format: ExportFormat = Query(default=ExportFormat.CSV, alias='format'),
+    columns: list[str] = Query(default=[]),
+    is_active: bool | None = None,
+    db: AsyncSession = Depends(get_db)
+):
+    '''
+    Export admins ordered by id as a CSV or NDJSON attachment, streamed from a server-side cursor. Password hashes are not exported.
+
+        :param format [str]: Export format, it must be one of the following: csv | ndjson
+        :param columns [list[str]]: Exported columns, all by default.
+        :param is_active [bool]: Admin status filter.
+
+        :returns [StreamingResponse]: Admin accounts.
+
+        :raises [HTTPException]:
+            :[400] Bad request: Unknown columns.
+    '''
+    columns = select_columns(ADMIN_COLUMNS, columns)
+    table = models.AdminsTable
+    batches = crud.stream_columns(db=db, table=table, columns=columns, where=[] if is_active is None else [table.is_active == is_active])
+    return await export_response(columns, batches, export_format.value, filename='admins')
+
+
+@router.get('/users/export', status_code=status.HTTP_200_OK)
+async def export_users(
+    export_format: ExportFormat = Query(default=ExportFormat.CSV, alias='format'),
+    columns: list[str] = Query(default=[]),
+    is_active: bool | None = None,
+    user_status: models.Status | None = Query(default=None, alias='status'),
+    db: AsyncSession = Depends(get_db)
+):
+    '''
+    Export users ordered by id as a CSV or NDJSON attachment, streamed from a server-side cursor. Password hashes are not exported.
+
+        :param format [str]: Export format, it must be one of the following: csv | ndjson
+        :param columns [list[str]]: Exported columns, all by default.
+        :param is_active [bool]: User status filter.
+        :param status [str]: User approval filter, it must be one of the following: approved | declined | pending
+
+        :returns [StreamingResponse]: User accounts.
+
+        :raises [HTTPException]:
+            :[400] Bad request: Unknown columns.
+    '''
+    columns = select_columns(USER_COLUMNS, columns)
+    table = models.UserTable
+    where = [] if is_active is None else [table.is_active == is_active]
+    if user_status is not None:
+        where.append(table.status == user_status)
+    batches = crud.stream_columns(db=db, table=table, columns=columns, where=where)
+    return await export_response(columns, batches, export_format.value, filename='users')
 
 
 @router.post('/create', status_code=status.HTTP_200_OK, response_model=AdminResponse)
 async def add_admin(
     item: CreateAdminRequest,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     '''
     Add new admin in the database.
@@ -58,41 +141,33 @@ async def add_admin(
         :returns [AdminResponse]: Admin account that has just been created.
     '''
 
-    # create database new admin object
-    admin_object = models.AdminsTable(
-        username=item.username,
-        hashed_password=SecureHash.create(item.password),
-        is_active=True
-    )
-
     # add new admin to the database
-    crud.create_object(
-        db=db,
-        data=admin_object,
-        exc_message='Unable to create admin.'
-    )
-
-    new_admin = crud.get_object(
+    new_admin = await crud.create_object(
         db=db,
         table=models.AdminsTable,
-        column=models.AdminsTable.username,
-        value=item.username,
-        exc_message='Unable to find admin.'
+        data=dict(
+            username=item.username,
+            hashed_password=await SecureHash.create_async(item.password),
+            is_active=True
+        ),
+        exc_message='Unable to create admin.',
+        conflict_message='Admin already exists.'
     )
-    new_admin = new_admin.__dict__
-    for k in ['id', 'hashed_password', 'updated_at']:
-        del new_admin[k]
 
     return AdminResponse(
         message='Admin has successfully been created.',
-        data=new_admin
+        data=dict(
+            username=new_admin.username,
+            is_active=new_admin.is_active,
+            created_at=new_admin.created_at
+        )
     )
 
 
 @router.post('/update', status_code=status.HTTP_200_OK, response_model=AdminResponse)
 async def alter_admin_status(
     item: UpdateAdminRequest,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     '''
     Update other admin status (is_active) in the database.
@@ -103,8 +178,9 @@ async def alter_admin_status(
         :returns [AdminResponse]: Admin account that has just been updated.
     '''
 
-    # update other admin in the database
-    crud.update_object(
+    # update other admin in the database, cached principals are invalidated by every worker once committed
+    await broadcast_invalidation(db=db, username=item.username)
+    updated_admin = await crud.update_object(
         db=db,
         table=models.AdminsTable,
         column=models.AdminsTable.username,
@@ -112,19 +188,13 @@ async def alter_admin_status(
         data=dict(is_active=item.is_active),
         exc_message='Unable to update admin.'
     )
-
-    updated_admin = crud.get_object(
-        db=db,
-        table=models.AdminsTable,
-        column=models.AdminsTable.username,
-        value=item.username,
-        exc_message='Unable to find admin.'
-    )
-    updated_admin = updated_admin.__dict__
-    for k in ['id', 'hashed_password', 'created_at']:
-        del updated_admin[k]
+    principal_cache.invalidate(item.username)
 
     return AdminResponse(
         message='Admin has successfully been updated.',
-        data=updated_admin
+        data=dict(
+            username=updated_admin.username,
+            is_active=updated_admin.is_active,
+            updated_at=updated_admin.updated_at
+        )
     )
@@ -1,22 +1,28 @@
 '''This module manages the user creation FastAPI router.'''
 
+import asyncio
 from fastapi import APIRouter, Depends, status
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from apis.schemas.user import CreateUserRequest, UserResponse
+from apis.schemas.user import CreateUserRequest, CreateUserStatus, CreateUsersResponse, UserResponse
 from database import crud, models
 from database.session import get_db
 from helpers.api_exceptions import ResponseValidationError
+from helpers.profiling import ProfiledRoute
+from security.admin import get_current_active_admin
 from security.hashing import SecureHash
 
 
-router = APIRouter()
+router = APIRouter(route_class=ProfiledRoute)
+
+MAX_USERS = 100  # users per batch request, about 7 seconds of hashing on one core with the default settings (scrypt n=2^14, 15 hashes/s)
+BATCH_SIZE = 25  # users inserted at once, while the passwords of the next ones are being hashed
 
 
 @router.post('/create', status_code=status.HTTP_200_OK, response_model=UserResponse)
 async def create_user(
     item: CreateUserRequest,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     '''
     Create a user and store to database.
@@ -31,35 +37,16 @@ async def create_user(
             :[409] Conflict: Unable to add object to database.
     '''
 
-    # check if user exists
-    user = crud.get_object(
+    # add user, an existing email violates the unique constraint
+    user = await crud.create_object(
         db=db,
         table=models.UserTable,
-        column=models.UserTable.email,
-        value=item.email
-    )
-    if user:
-        raise ResponseValidationError(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            message='Email already exists.'
-        )
-
-    # add user
-    crud.create_object(
-        db=db,
-        data=models.UserTable(
+        data=dict(
             email=item.email,
-            hashed_password=SecureHash.create(item.password),
+            hashed_password=await SecureHash.create_async(item.password),
             is_active=True
-        )
-    )
-
-    # format response
-    user = crud.get_object(
-        db=db,
-        table=models.UserTable,
-        column=models.UserTable.email,
-        value=item.email
+        ),
+        conflict_message='Email already exists.'
     )
 
     return UserResponse(
@@ -68,3 +55,65 @@ async def create_user(
         createdAt=user.created_at,
         updatedAt=user.updated_at
     )
+
+
+@router.post('/create/batch', status_code=status.HTTP_200_OK, response_model=CreateUsersResponse, dependencies=[Depends(get_current_active_admin)])
+async def create_users(
+    items: list[CreateUserRequest],
+    db: AsyncSession = Depends(get_db)
+):
+    '''
+    Create users in bulk and store them to database, e.g. when onboarding an organisation. Existing emails are skipped.
+
+        :param items [list[CreateUserRequest]]: Users email and password, up to 100 users.
+
+        :returns [CreateUsersResponse]: Number of created and duplicate users, and the status of each user (created | duplicate) in the same order.
+
+        :raises [HTTPException]:
+            :[400] Bad request: Too many users.
+            :[409] Conflict: Unable to add objects to database.
+    '''
+    if len(items) > MAX_USERS:
+        raise ResponseValidationError(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            message=f'Too many users, the maximum is {MAX_USERS} per request.'
+        )
+
+    # existing and repeated emails are not hashed, the other passwords are all submitted to the hashing thread pool at once
+    emails = list(dict.fromkeys(x.email for x in items))
+    existing = await crud.get_values(db=db, table=models.UserTable, column='email', values=emails, columns=[])
+    passwords = {x.email: x.password for x in reversed(items)}  # the first occurrence of an email wins
+    new = [x for x in emails if x not in existing]
+    hashes = [asyncio.ensure_future(SecureHash.create_async(passwords[x])) for x in new]
+
+    async def batches():
+        for start in range(0, len(new), BATCH_SIZE):
+            end = start + BATCH_SIZE
+            yield [dict(email=email, hashed_password=await hashed, is_active=True) for email, hashed in zip(new[start:end], hashes[start:end])]
+
+    # each batch is inserted once its passwords are hashed, emails created concurrently by other requests are skipped
+    try:
+        rows = await crud.insert_objects(
+            db=db,
+            table=models.UserTable,
+            batches=batches(),
+            conflict=['email'],
+            returning=['email'],
+            exc_message='Unable to create users.'
+        )
+    finally:
+        for hashed in hashes:
+            hashed.cancel()
+
+    created, data = {row.email for row in rows}, []
+    for item in items:
+        data.append(dict(email=item.email, status=CreateUserStatus.CREATED if item.email in created else CreateUserStatus.DUPLICATE))
+        created.discard(item.email)
+
+    count = sum(x['status'] == CreateUserStatus.CREATED for x in data)
+    return CreateUsersResponse(
+        message=f'{count} users have successfully been created.',
+        created=count,
+        duplicates=len(items) - count,
+        data=data
+    )
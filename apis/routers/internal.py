@@ -0,0 +1,84 @@
+'''This module is part of the /internal FastAPI router (runtime statistics for operators).'''
+
+from fastapi import APIRouter, Depends, status
+
+from apis.schemas.internal import InternalResponse
+from database.session import get_pool_statistics
+from database.snapshot import snapshot_statistics
+from helpers.http_requests import upstream_statistics
+from helpers.profiling import ProfiledRoute, profile_summaries
+from helpers.response_cache import response_cache
+from security.admin import get_current_active_admin
+
+
+router = APIRouter(route_class=ProfiledRoute, dependencies=[Depends(get_current_active_admin)])
+
+
+@router.get('/pool', status_code=status.HTTP_200_OK, response_model=InternalResponse)
+async def retrieve_pool_statistics():
+    '''
+    Retrieve the database connection pool statistics of the worker process serving the request.
+
+        :returns [InternalResponse]: Pool gauges (size, checked out, idle, overflow), checkouts, checkout timeouts and checkout wait histogram.
+    '''
+
+    return InternalResponse(
+        message='Pool statistics have successfully been found.',
+        data=get_pool_statistics()
+    )
+
+
+@router.get('/upstreams', status_code=status.HTTP_200_OK, response_model=InternalResponse)
+async def retrieve_upstream_statistics():
+    '''
+    Retrieve the outbound HTTP calls statistics of the worker process serving the request.
+
+        :returns [InternalResponse]: Circuit breakers state (closed | open | half-open), error and slow call rates, and coalesced calls per upstream.
+    '''
+
+    return InternalResponse(
+        message='Upstream statistics have successfully been found.',
+        data=upstream_statistics()
+    )
+
+
+@router.get('/snapshots', status_code=status.HTTP_200_OK, response_model=InternalResponse)
+async def retrieve_snapshot_statistics():
+    '''
+    Retrieve the in-memory table snapshots statistics of the worker process serving the request.
+
+        :returns [InternalResponse]: Number of rows, memory footprint in bytes (total and per column), watermark, and refresh counts and latencies per table.
+    '''
+
+    return InternalResponse(
+        message='Snapshot statistics have successfully been found.',
+        data=snapshot_statistics()
+    )
+
+
+@router.get('/responses', status_code=status.HTTP_200_OK, response_model=InternalResponse)
+async def retrieve_response_cache_statistics():
+    '''
+    Retrieve the response cache statistics of the worker process serving the request.
+
+        :returns [InternalResponse]: Cached responses and their size in bytes, hits, misses, evictions, 304 responses and invalidations.
+    '''
+
+    return InternalResponse(
+        message='Response cache statistics have successfully been found.',
+        data=response_cache.info()
+    )
+
+
+@router.get('/profiles', status_code=status.HTTP_200_OK, response_model=InternalResponse)
+async def retrieve_profiles():
+    '''
+    Retrieve the summaries of the latest request profiles, written by the worker processes of this host.
+
+        :returns [InternalResponse]: Profile name, request method, path and status, wall time and phase timings in seconds, and number of stack samples.
+    '''
+
+    return InternalResponse(
+        message='Profiles have successfully been found.',
+        data=dict(profiles=profile_summaries())
+    )
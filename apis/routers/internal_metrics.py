@@ -0,0 +1,25 @@
+'''This module is part of the /internal FastAPI router (runtime metrics for scrape jobs, authenticated by a static bearer token).'''
+
+from fastapi import APIRouter, Depends, Response, status
+
+from helpers.metrics import CONTENT_TYPE, metrics_publisher, render
+from helpers.profiling import ProfiledRoute
+from security.dependencies import verify_scrape_token
+
+
+router = APIRouter(route_class=ProfiledRoute, dependencies=[Depends(verify_scrape_token)])
+
+
+@router.get('/metrics', status_code=status.HTTP_200_OK, response_class=Response)
+async def retrieve_metrics():
+    '''
+    Retrieve the runtime metrics of the worker processes of this host in the Prometheus text format, for a Prometheus scrape job.
+
+        :returns [Response]: Request latency histograms, status code counters and in-flight gauges per route, database statement latency,
+            rows and statements per request, connection pool gauges, and rate limiter rejections.
+
+        :raises [HTTPException]:
+            :[401] Unauthorized: Missing or invalid METRICS_TOKEN bearer token.
+    '''
+
+    return Response(content=render(metrics_publisher.collect()), media_type=CONTENT_TYPE)
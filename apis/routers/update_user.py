@@ -1,21 +1,22 @@
 '''This module manages the user update FastAPI router.'''
 
 from fastapi import APIRouter, Depends, status
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from apis.schemas.user import UpdateUserRequest, UserResponse
 from database import crud, models
 from database.session import get_db
+from helpers.profiling import ProfiledRoute
 from security.dependencies import authenticate_user
 
 
-router = APIRouter()
+router = APIRouter(route_class=ProfiledRoute)
 
 
 @router.post('/update', status_code=status.HTTP_200_OK, dependencies=[Depends(authenticate_user)], response_model=UserResponse)
 async def update_user(
     item: UpdateUserRequest,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     '''
     Update a user data profile.
@@ -27,7 +28,7 @@ async def update_user(
         :returns [UserResponse]: User has successfully been updated.
     '''
 
-    crud.update_object(
+    user = await crud.update_object(
         db=db,
         table=models.UserTable,
         column=models.UserTable.email,
@@ -35,14 +36,6 @@ async def update_user(
         data=dict(is_active=item.isActive)
     )
 
-    # format response
-    user = crud.get_object(
-        db=db,
-        table=models.UserTable,
-        column=models.UserTable.email,
-        value=item.email
-    )
-
     return UserResponse(
         email=user.email,
         isActive=user.is_active,
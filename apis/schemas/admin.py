@@ -2,6 +2,8 @@
 
 from pydantic import BaseModel
 
+from apis.schemas.page import PageResponse
+
 
 # Dependencies
 class AccessTokenData(BaseModel):
@@ -18,14 +20,14 @@ class Admin(BaseModel):
 
 
 # Requests
-class CreateAdmin(BaseModel):
+class CreateAdminRequest(BaseModel):
     '''Router schema to /admin/create'''
 
     username: str
     password: str
 
 
-class UpdateAdmin(Admin):
+class UpdateAdminRequest(Admin):
     '''Router schema to /admin/update'''
 
 
@@ -44,8 +46,5 @@ class AdminResponse(BaseModel):
     data: dict | None = None
 
 
-class AdminsResponse(BaseModel):
+class AdminsResponse(PageResponse):
     '''Response schema to /admin'''
-
-    message: str | None = None
-    data: list | None = None
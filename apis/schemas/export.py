@@ -0,0 +1,11 @@
+'''This module defines the HTTP request/response schemas shared by the export FastAPI routers.'''
+
+from enum import Enum
+
+
+# Enumerations
+class ExportFormat(str, Enum):
+    '''Export format values.'''
+
+    CSV = 'csv'
+    NDJSON = 'ndjson'
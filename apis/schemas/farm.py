@@ -0,0 +1,107 @@
+'''This module defines the HTTP request/response schemas for the /admin/farms FastAPI routers.'''
+
+from enum import Enum
+from pydantic import BaseModel
+
+
+# Enumerations
+class IngestFormat(str, Enum):
+    '''Upload format values.'''
+
+    CSV = 'csv'
+    NDJSON = 'ndjson'
+
+
+class FarmGroup(str, Enum):
+    '''Analytics grouping values.'''
+
+    COUNTRY = 'Country'
+    PROVINCE = 'Province'
+    GENUS_NAME = 'GenusName'
+    SPECIES_NAME = 'SpeciesName'
+    PRODUCT_GROUP = 'ProductGroup'
+
+
+class FarmMetric(str, Enum):
+    '''Analytics metric values.'''
+
+    FARM_SIZE = 'FarmSize'
+    EFFECTIVE_AREA = 'EffectiveArea'
+    PLANT_AGE = 'PlantAge'
+    SPHA_SURVIVAL = 'SphaSurvival'
+
+
+# Requests
+class FarmFilters(BaseModel):
+    '''Query parameters schema to filter farms.'''
+
+    country: str | None = None
+    province: str | None = None
+    product_group: str | None = None
+    genus_name: str | None = None
+    species_name: str | None = None
+    is_active: bool | None = None
+
+    def columns(self) -> dict:
+        '''Filter values keyed by farms table column names, unset filters excluded.'''
+        values = dict(
+            Country=self.country,
+            Province=self.province,
+            ProductGroup=self.product_group,
+            GenusName=self.genus_name,
+            SpeciesName=self.species_name,
+            IsActive=self.is_active
+        )
+        return {k: v for k, v in values.items() if v is not None}
+
+
+# Responses
+class RowError(BaseModel):
+    '''Response schema to an invalid upload row.'''
+
+    row: int
+    errors: dict[str, str]
+
+
+class FarmsIngestResponse(BaseModel):
+    '''Response schema to /admin/farms/ingest'''
+
+    message: str
+    rows: int
+    inserted: int
+    rejected: int
+    errors: list[RowError]
+    seconds: float
+    rowsPerSecond: float
+
+
+class FarmsSyncResponse(FarmsIngestResponse):
+    '''Response schema to /admin/farms/sync'''
+
+    updated: int
+    unchanged: int
+    deactivated: int
+
+
+class FarmResponse(BaseModel):
+    '''Response schema to /admin/farms/{farm_id}'''
+
+    message: str | None = None
+    data: dict | None = None
+
+
+class FarmsResponse(BaseModel):
+    '''Response schema to /admin/farms/bbox, /admin/farms/radius and /admin/farms/nearest'''
+
+    message: str | None = None
+    data: list | None = None
+    total: int | None = None
+
+
+class FarmsAnalyticsResponse(BaseModel):
+    '''Response schema to /admin/farms/analytics'''
+
+    message: str | None = None
+    data: list | None = None
+    edges: dict | None = None
+    total: int | None = None
@@ -0,0 +1,11 @@
+'''This module defines the HTTP request/response schemas for the /internal FastAPI routers.'''
+
+from pydantic import BaseModel
+
+
+# Responses
+class InternalResponse(BaseModel):
+    '''Response schema to /internal/*'''
+
+    message: str | None = None
+    data: dict | None = None
@@ -0,0 +1,29 @@
+'''This module defines the HTTP request/response schemas shared by the paginated FastAPI routers.'''
+
+from enum import Enum
+from pydantic import BaseModel
+
+
+# Enumerations
+class PageOrder(str, Enum):
+    '''Page ordering values.'''
+
+    ID = 'id'
+    UPDATED_AT = 'updated_at'
+
+
+class PageTotal(str, Enum):
+    '''Page total counting values.'''
+
+    EXACT = 'exact'
+    ESTIMATED = 'estimated'
+
+
+# Responses
+class PageResponse(BaseModel):
+    '''Response schema to paginated routers.'''
+
+    message: str | None = None
+    data: list | None = None
+    nextCursor: str | None = None
+    total: int | None = None
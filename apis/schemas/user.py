@@ -13,6 +13,13 @@ class Example(str, Enum):
     USD = 'USD'
 
 
+class CreateUserStatus(str, Enum):
+    '''Batch user creation status values.'''
+
+    CREATED = 'created'
+    DUPLICATE = 'duplicate'
+
+
 # Requests
 class CreateUserRequest(BaseModel):
     '''Request schema to /user/create'''
@@ -38,3 +45,19 @@ class UserResponse(BaseModel):
     isActive: bool
     createdAt: date
     updatedAt: date
+
+
+class CreateUserResult(BaseModel):
+    '''Response schema to an item of /user/create/batch'''
+
+    email: str
+    status: CreateUserStatus
+
+
+class CreateUsersResponse(BaseModel):
+    '''Response schema to /user/create/batch'''
+
+    message: str
+    created: int
+    duplicates: int
+    data: list[CreateUserResult]
@@ -0,0 +1,39 @@
+'''This module benchmarks the password hashing schemes throughput at different cost settings.
+Run it from the project root directory: python -m benchmarks.hashing_benchmark'''
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from security.hashing import HmacSha3, Scrypt
+
+
+PASSWORD = 'correct horse battery staple'
+WORKERS = 4
+DURATION = 2  # seconds
+
+
+def throughput(func, workers: int = 1) -> float:
+    '''Count the number of calls per second of a function, running it in a thread pool.'''
+    calls, start = 0, time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while time.perf_counter() - start < DURATION:
+            list(executor.map(lambda _: func(PASSWORD), range(workers)))
+            calls += workers
+    return calls / (time.perf_counter() - start)
+
+
+def main():
+    '''Print hashes per second for each scheme, with 1 thread and with the thread pool.'''
+    schemes = [('hmac-sha3-512', HmacSha3(key='benchmark'))]
+    schemes += [(f'scrypt n=2^{n.bit_length() - 1} r=8 p=1', Scrypt(cost=n, block_size=8, parallelism=1)) for n in [2 ** 12, 2 ** 14, 2 ** 15, 2 ** 16]]
+
+    print(f'| scheme | hashes/s (1 thread) | hashes/s ({WORKERS} threads) | latency (ms) |')
+    print('|---|---|---|---|')
+    for name, scheme in schemes:
+        single = throughput(scheme.create)
+        pooled = throughput(scheme.create, workers=WORKERS)
+        print(f'| {name} | {single:,.0f} | {pooled:,.0f} | {1000 / single:.2f} |')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+'''This module benchmarks the JSON serialization of paginated payloads, through the former pipeline (jsonable_encoder and stdlib json)
+and the orjson response class. Run it from the project root directory: python -m benchmarks.serialization_benchmark'''
+
+import time
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from uuid import uuid4
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from helpers.api_responses import ORJSONResponse
+
+
+DURATION = 1  # seconds
+
+
+def page(size: int) -> dict:
+    '''Build a paginated payload of farm-like rows.'''
+    now = datetime.now(timezone.utc)
+    items = [
+        dict(
+            id=i, farmId=str(uuid4()), name=f'Farm {i}', region='Some Region', active=i % 3 != 0, latitude=Decimal('-23.550520'),
+            longitude=Decimal('-46.633308'), area=1234.5 + i, createdAt=now - timedelta(days=i), updatedAt=now
+        )
+        for i in range(size)
+    ]
+    return dict(message='Farms have successfully been found.', data=items, nextCursor='WyJpZCIsbnVsbCwxMDAwXQ', total=size * 10)
+
+
+def latency(func) -> float:
+    '''Measure the mean latency of a function, in milliseconds.'''
+    calls, start = 0, time.perf_counter()
+    while time.perf_counter() - start < DURATION:
+        func()
+        calls += 1
+    return (time.perf_counter() - start) / calls * 1000
+
+
+def main():
+    '''Print the serialization latency of each pipeline per page size: before, route responses (validated and encoded by FastAPI), and error responses.'''
+    print('| page size | jsonable_encoder + json (ms) | jsonable_encoder + orjson (ms) | orjson (ms) |')
+    print('|---|---|---|---|')
+    for size in [50, 500, 5000]:
+        payload = page(size)
+        results = [
+            latency(lambda: JSONResponse(content=jsonable_encoder(payload))),  # pylint: disable=[W0640]
+            latency(lambda: ORJSONResponse(content=jsonable_encoder(payload))),  # pylint: disable=[W0640]
+            latency(lambda: ORJSONResponse(content=payload))  # pylint: disable=[W0640]
+        ]
+        print(f'| {size:,} | ' + ' | '.join(f'{x:,.3f}' for x in results) + ' |')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+'''This module benchmarks the JWT encoding and decoding throughput per algorithm, with keys parsed per call or once in the key ring.
+Run it from the project root directory: python -m benchmarks.tokens_benchmark'''
+
+import time
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jose import jwt
+
+from security.tokens import SigningKey
+
+
+DURATION = 1  # seconds
+CLAIMS = {'username': 'benchmark', 'exp': 4102444800}
+
+
+def throughput(func) -> float:
+    '''Count the number of calls per second of a function.'''
+    calls, start = 0, time.perf_counter()
+    while time.perf_counter() - start < DURATION:
+        func()
+        calls += 1
+    return calls / (time.perf_counter() - start)
+
+
+def rsa_private_key() -> str:
+    '''Generate a 2048 bits RSA private key in PEM format.'''
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()).decode()
+
+
+def main():
+    '''Print encoded and decoded tokens per second for each algorithm.'''
+    secret, private_pem = 'a' * 64, rsa_private_key()
+    public_pem = SigningKey(kid='rsa', algorithm='RS256', key=private_pem).public.to_pem().decode()
+
+    print('| algorithm | encode/s (raw key) | encode/s (key ring) | decode/s (raw key) | decode/s (key ring) |')
+    print('|---|---|---|---|---|')
+    for algorithm in ['HS256', 'HS512', 'RS256', 'RS512']:
+        sign, verify = (secret, secret) if algorithm.startswith('HS') else (private_pem, public_pem)
+        key = SigningKey(kid=algorithm, algorithm=algorithm, key=sign)
+        token = jwt.encode(CLAIMS, sign, algorithm=algorithm)
+
+        results = [
+            throughput(lambda: jwt.encode(CLAIMS, sign, algorithm=algorithm)),  # pylint: disable=[W0640]
+            throughput(lambda: jwt.encode(CLAIMS, key.private, algorithm=algorithm)),  # pylint: disable=[W0640]
+            throughput(lambda: jwt.decode(token, verify, algorithms=[algorithm])),  # pylint: disable=[W0640]
+            throughput(lambda: jwt.decode(token, key.public, algorithms=[algorithm]))  # pylint: disable=[W0640]
+        ]
+        print(f'| {algorithm} | ' + ' | '.join(f'{x:,.0f}' for x in results) + ' |')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,34 +1,302 @@
-'''This module configures application settings from config.yaml'''
+'''This module configures application settings from config.yaml and the environment.
+Settings are parsed and validated once into an immutable snapshot, so that reading them costs an attribute access.
+A reload (explicit, or when config.yaml changes) swaps in a new snapshot and notifies the subscribers, so that the modules holding
+state derived from the settings (connection pool, rate limits, JWT keys, password hashing) reconfigure themselves.'''
 
-from pyaml_env import parse_config
+import asyncio
+import logging
+from inspect import isawaitable
+from typing import Any, Callable, Literal
+import yaml
 from dotenv import load_dotenv
+from pyaml_env import parse_config
+from pydantic import BaseModel, Extra, ValidationError, confloat, conint, constr, root_validator, validator
+from watchfiles import awatch
 
-from helpers.misc import AppSettings, DataFormatter
-from helpers.lru_caching import timed_lru_cache
+from helpers.misc import DataFormatter
 
 
 load_dotenv()
 
+CONFIG_FILE = 'config.yaml'
+
+logger = logging.getLogger(__name__)
+
+Limit = constr(strip_whitespace=True, regex=r'^\d+\s*/\s*(second|minute|hour|day)$')
+Required = constr(min_length=1)
+
+
+class FrozenSettings(BaseModel):
+    '''Immutable settings section, unknown keys are rejected.'''
+
+    class Config:
+        '''Pydantic model configuration.'''
+        frozen = True
+        extra = Extra.forbid
+
+
+# Sections
+class AppConfig(FrozenSettings):
+    '''APP settings.'''
+
+    PROJECT_NAME: str
+    PROJECT_VERSION: str
+    ENVIRONMENT: Literal['development', 'production']
+    DEBUG: bool = False
+    TESTING: bool = False
+    WATCH_CONFIG: bool = True
+
+
+class ApiConfig(FrozenSettings):
+    '''API settings, derived from the APP settings.'''
+
+    PREFIX: str
+
+
+class AdminConfig(FrozenSettings):
+    '''ADMIN settings.'''
+
+    USERNAME: Required
+    PASSWORD: Required
+
+
+class PoolConfig(FrozenSettings):
+    '''DATABASE.POOL settings.'''
+
+    SIZE: conint(ge=1) = 5
+    MAX_OVERFLOW: conint(ge=0) = 10
+    TIMEOUT: conint(ge=0) = 30
+    RECYCLE: int = 1800
+    PRE_PING: bool = True
+
+
+class SnapshotConfig(FrozenSettings):
+    '''DATABASE.SNAPSHOT settings.'''
+
+    REFRESH: confloat(ge=0) = 5
+    BATCH_SIZE: conint(ge=1) = 10000
+
+
+class DatabaseConfig(FrozenSettings):
+    '''DATABASE settings.'''
+
+    BASE_URL: Required
+    ASYNC_URL: str = ''
+    POOL: PoolConfig = PoolConfig()
+    SNAPSHOT: SnapshotConfig = SnapshotConfig()
+
+
+class PolicyConfig(FrozenSettings):
+    '''THROTTLING.POLICIES item settings.'''
+
+    ROUTE: Required
+    KEY: Literal['ip', 'admin', 'user'] = 'ip'
+    LIMITS: tuple[Limit, ...]
+    BURST: conint(ge=1) | None = None
+
+
+class ThrottlingConfig(FrozenSettings):
+    '''THROTTLING settings.'''
+
+    STORAGE: Literal['memory', 'shm', 'redis'] = 'memory'
+    SHM_PATH: str = '/dev/shm/fastapi-throttling'
+    REDIS_URL: str | None = None
+    BATCH: conint(ge=1) = 1
+    LIMITS: tuple[Limit, ...] = ()
+    BURST: conint(ge=1) | None = None
+    POLICIES: tuple[PolicyConfig, ...] = ()
+
+
+class ProfilingConfig(FrozenSettings):
+    '''PROFILING settings.'''
+
+    ENABLED: bool = False
+    SAMPLE_RATE: confloat(ge=0, le=1) = 0
+    HEADER: str = 'X-Profile'
+    TOKEN: str | None = None
+    INTERVAL: confloat(gt=0) = 0.005
+    DIRECTORY: str = '/tmp/fastapi-profiles'
+    MAX_PROFILES: conint(ge=1) = 100
+
+
+class MetricsConfig(FrozenSettings):
+    '''METRICS settings.'''
+
+    DIRECTORY: str = '/tmp/fastapi-metrics'
+    INTERVAL: confloat(gt=0) = 5
+    TOKEN: str | None = None
+
+
+class QueryBudgetConfig(FrozenSettings):
+    '''QUERIES.BUDGETS item settings.'''
+
+    ROUTE: Required
+    MAX: conint(ge=0) | None = None
+
+
+class QueriesConfig(FrozenSettings):
+    '''QUERIES settings.'''
+
+    SLOW: confloat(ge=0) | None = 0.5
+    BUDGET: conint(ge=0) | None = None
+    BUDGETS: tuple[QueryBudgetConfig, ...] = ()
+    ON_EXCEEDED: Literal['log', 'raise'] = 'log'
+
+
+class JWTKeyConfig(FrozenSettings):
+    '''SECURITY.JWT_KEYS item settings.'''
+
+    KID: Required
+    ALGORITHM: Required
+    KEY: str | None = None
+    PUBLIC_KEY: str | None = None
+
+    @root_validator(skip_on_failure=True)
+    def has_key(cls, values):
+        '''Ensure the key can verify tokens: HS keys need their secret KEY, the other ones KEY or PUBLIC_KEY.'''
+        if values['ALGORITHM'].startswith('HS') and not values['KEY']:
+            raise ValueError(f'JWT key {values["KID"]} needs a KEY with the {values["ALGORITHM"]} algorithm')
+        if not values['KEY'] and not values['PUBLIC_KEY']:
+            raise ValueError(f'JWT key {values["KID"]} needs a KEY or a PUBLIC_KEY')
+        return values
+
+
+class PrincipalCacheConfig(FrozenSettings):
+    '''SECURITY.PRINCIPAL_CACHE settings.'''
+
+    TTL: float = 60
+    MAXSIZE: conint(ge=1) = 1024
+
+
+class HashingConfig(FrozenSettings):
+    '''SECURITY.HASHING settings.'''
+
+    ALGORITHM: Literal['scrypt', 'hmac-sha3-512'] = 'scrypt'
+    SCRYPT_N: int = 16384
+    SCRYPT_R: conint(ge=1) = 8
+    SCRYPT_P: conint(ge=1) = 1
+    WORKERS: conint(ge=1) = 4
+
+    @validator('SCRYPT_N')
+    def power_of_two(cls, v):
+        '''Ensure the scrypt cost is a power of 2.'''
+        if v < 2 or v & (v - 1):
+            raise ValueError('it must be a power of 2')
+        return v
+
+
+class SecurityConfig(FrozenSettings):
+    '''SECURITY settings.'''
+
+    JWT_EXPIRE_MINUTES: conint(ge=1)
+    JWT_ALGORITHM: Required
+    JWT_SECRET_KEY: Required
+    JWT_ACTIVE_KID: str | None = None
+    JWT_KEYS: tuple[JWTKeyConfig, ...] = ()
+    PRINCIPAL_CACHE: PrincipalCacheConfig = PrincipalCacheConfig()
+    HASHING: HashingConfig = HashingConfig()
+
+
+class Settings(FrozenSettings):
+    '''Application settings.'''
+
+    APP: AppConfig
+    API: ApiConfig
+    ADMIN: AdminConfig
+    DATABASE: DatabaseConfig
+    THROTTLING: ThrottlingConfig = ThrottlingConfig()
+    PROFILING: ProfilingConfig = ProfilingConfig()
+    METRICS: MetricsConfig = MetricsConfig()
+    QUERIES: QueriesConfig = QueriesConfig()
+    SECURITY: SecurityConfig
+
+
+def load_settings(path: str = CONFIG_FILE) -> Settings:
+    '''Parse and validate the settings of a config file, environment variables are resolved by the !ENV tag.'''
+    loader = type('ConfigLoader', (yaml.SafeLoader,), {})  # parse_config registers its resolvers on the loader class
+    config = parse_config(path, default_value='', loader=loader)
+
+    # set up API prefix
+    version = config['APP']['PROJECT_VERSION']
+    config['API'] = dict(PREFIX=f'/api/v{str(version).split(".", maxsplit=1)[0]}')
+
+    # set up environment
+    if config['APP']['ENVIRONMENT'] == 'development':
+        config['APP']['DEBUG'] = True
+        config['APP']['TESTING'] = True
+
+    # set up database
+    config['DATABASE']['BASE_URL'] = DataFormatter.postgresql(config['DATABASE']['BASE_URL'])
+    config['DATABASE']['ASYNC_URL'] = DataFormatter.asyncpg(config['DATABASE']['BASE_URL'])
+
+    return Settings.parse_obj(config)
+
+
+class SettingsStore:
+    '''Holder of the current settings snapshot and of the subscribers to its reloads.'''
+
+    def __init__(self, path: str):
+        self.path = path
+        self.current = load_settings(path)
+        self.subscribers: list[Callable[[Settings, Settings], Any]] = []
+        self.task: asyncio.Task | None = None
+        self.stop_event: asyncio.Event | None = None
+
+    def subscribe(self, callback: Callable[[Settings, Settings], Any]) -> Callable[[Settings, Settings], Any]:
+        '''Call a function, or await a coroutine function, with the old and new settings on every reload.'''
+        self.subscribers.append(callback)
+        return callback
+
+    async def reload(self) -> Settings:
+        '''Swap in the settings of the config file, then notify the subscribers. Invalid settings are rejected and kept unchanged.'''
+        old, new = self.current, load_settings(self.path)
+        if new == old:
+            return old
+        self.current = new
+        for callback in self.subscribers:
+            try:
+                result = callback(old, new)
+                if isawaitable(result):
+                    await result
+            except Exception:  # pylint: disable=[W0703]
+                logger.exception('Settings subscriber %s failed to reload.', getattr(callback, '__qualname__', callback))
+        return new
+
+    async def watch(self, stop_event: asyncio.Event) -> None:
+        '''Reload the settings whenever the config file changes, until the stop event is set.'''
+        async for _ in awatch(self.path, stop_event=stop_event):
+            try:
+                await self.reload()
+            except (OSError, ValidationError, yaml.YAMLError) as e:
+                logger.error('Invalid %s, settings have not been reloaded: %s', self.path, e)
+
+    async def start(self) -> None:
+        '''Start watching the config file, if enabled.'''
+        if self.current.APP.WATCH_CONFIG and self.task is None:
+            self.stop_event = asyncio.Event()
+            self.task = asyncio.create_task(self.watch(self.stop_event))
+
+    async def stop(self) -> None:
+        '''Stop watching the config file.'''
+        if self.task:
+            self.stop_event.set()
+            await self.task
+            self.task = None
+
 
-@timed_lru_cache(seconds=60)
-def get_settings() -> AppSettings:
-    '''Set up settings in cache for the above lifetime, then refreshes it.'''
-    return AppSettings(config)
+settings_store = SettingsStore(CONFIG_FILE)
 
 
-# project settings
-config = parse_config('config.yaml')
+def get_settings() -> Settings:
+    '''Get the current settings snapshot. Read it at use time, so that reloads are taken into account.'''
+    return settings_store.current
 
-# set up API prefix
-version = config['APP']['PROJECT_VERSION']
-config['API'] = {}
-config['API']['PREFIX'] = f'/api/v{version.split(".")[0]}'
 
+def subscribe_settings(callback: Callable[[Settings, Settings], Any]) -> Callable[[Settings, Settings], Any]:
+    '''Subscribe to settings reloads, it can be used as a decorator.'''
+    return settings_store.subscribe(callback)
 
-# set up environment
-if config['APP']['ENVIRONMENT'] == 'development':
-    config['APP']['DEBUG'] = True
-    config['APP']['TESTING'] = True
 
-# set up database
-config['DATABASE']['BASE_URL'] = DataFormatter.postgresql(config['DATABASE']['BASE_URL'])
+async def reload_settings() -> Settings:
+    '''Reload the settings from the config file and notify the subscribers.'''
+    return await settings_store.reload()
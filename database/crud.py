@@ -1,16 +1,35 @@
 '''This module defines general database CRUD operations.'''
 
-from typing import Any
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+from datetime import datetime
+from typing import Any, AsyncIterator
+from asyncpg import PostgresError
 from fastapi import status
-from sqlalchemy.orm import Session
+from sqlalchemy import delete, func, insert, literal_column, or_, select, text, tuple_, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm.decl_api import DeclarativeMeta
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 
+from database import models
+from database.query_log import instrumented
 from helpers.api_exceptions import ResponseValidationError
+from helpers.response_cache import response_cache
 
 
-def get_object(
-    db: Session,
+UNIQUE_VIOLATION = '23505'  # PostgreSQL error code
+
+
+def _is_unique_violation(e: IntegrityError) -> bool:
+    '''Check if an integrity error has been raised by a unique constraint.'''
+    return getattr(e.orig, 'pgcode', None) == UNIQUE_VIOLATION
+
+
+@instrumented
+async def get_object(
+    db: AsyncSession,
     table: DeclarativeMeta,
     column: DeclarativeMeta,
     value: Any,
@@ -30,7 +49,8 @@ def get_object(
         :returns: Database object.
     '''
     try:
-        data = db.query(table).filter(column == value).first()
+        result = await db.execute(select(table).where(column == value))
+        data = result.scalars().first()
         if not data:
             raise ResponseValidationError(
                 status_code=exc_status_code,
@@ -43,12 +63,10 @@ def get_object(
             status_code=exc_status_code,
             message=exc_message) from e
 
-    finally:
-        db.close()
 
-
-def get_table(
-    db: Session,
+@instrumented
+async def get_table(
+    db: AsyncSession,
     table: DeclarativeMeta,
     exc_status_code: status = status.HTTP_409_CONFLICT,
     exc_message: str = 'Unable to find table in the database.'
@@ -64,7 +82,8 @@ def get_table(
         :returns: Database table objects.
     '''
     try:
-        data = db.query(table).all()
+        result = await db.execute(select(table))
+        data = result.scalars().all()
         if not data:
             raise ResponseValidationError(
                 status_code=exc_status_code,
@@ -77,12 +96,319 @@ def get_table(
             status_code=exc_status_code,
             message=exc_message) from e
 
-    finally:
-        db.close()
+
+def encode_cursor(order_by: str, value: Any, key: int) -> str:
+    '''Encode the keyset position of the last row of a page into an opaque cursor.'''
+    if isinstance(value, datetime):
+        value = {'datetime': value.isoformat()}
+    data = json.dumps([order_by, value, key], separators=(',', ':'))
+    return urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str, order_by: str) -> tuple[Any, int]:
+    '''Decode an opaque cursor into the keyset position of the last row of the previous page.'''
+    try:
+        data = urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        cursor_order_by, value, key = json.loads(data)
+        if isinstance(value, dict):
+            value = datetime.fromisoformat(value['datetime'])
+    except (BinasciiError, KeyError, TypeError, ValueError) as e:
+        raise ResponseValidationError(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            message='Invalid cursor.') from e
+
+    if cursor_order_by != order_by or not isinstance(key, int):
+        raise ResponseValidationError(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            message='Invalid cursor.'
+        )
+    return value, key
+
+
+@instrumented
+async def count_objects(
+    db: AsyncSession,
+    table: DeclarativeMeta,
+    where: list | None = None,
+    estimated: bool = False
+) -> int:
+    '''
+    Count database objects of a table.
+
+        :param db [generator]: Database session.
+        :param table [orm]: Declarative base Table.
+        :param where [list]: Filter conditions, ignored when estimated.
+        :param estimated [bool]: Read the planner row estimate instead of scanning the table.
+
+        :returns [int]: Number of objects.
+    '''
+    if estimated:
+        result = await db.execute(
+            text('SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(:name)'),
+            dict(name=table.__tablename__)
+        )
+        return max(result.scalar() or 0, 0)
+
+    result = await db.execute(select(func.count()).select_from(table).where(*(where or [])))
+    return result.scalar()
+
+
+@instrumented
+async def get_page(
+    db: AsyncSession,
+    table: DeclarativeMeta,
+    columns: list[str] | None = None,
+    order_by: str = 'id',
+    cursor: str | None = None,
+    size: int = 50,
+    total: str | None = None,
+    where: list | None = None
+) -> dict:
+    '''
+    Fetch a page of database objects using keyset (cursor) pagination, so the cost does not depend on the page position.
+
+        :param db [generator]: Database session.
+        :param table [orm]: Declarative base Table.
+        :param columns [list[str]]: Column names to return, all by default.
+        :param order_by [str]: Column name to order by, ties are broken by id.
+        :param cursor [str]: Opaque cursor returned by the previous page.
+        :param size [int]: Page size.
+        :param total [str]: Count the table objects, it must be one of the following: exact | estimated.
+        :param where [list]: Filter conditions.
+
+        :returns [dict]: Page items, next page cursor, and total number of objects.
+    '''
+    columns = columns or [c.name for c in table.__table__.columns]
+    order_column = getattr(table, order_by)
+    stmt = select(*[getattr(table, c) for c in columns], order_column, table.id)
+    stmt = stmt.where(*(where or []))
+    if cursor:
+        stmt = stmt.where(tuple_(order_column, table.id) > tuple_(*decode_cursor(cursor, order_by)))
+    stmt = stmt.order_by(order_column, table.id).limit(size + 1)
+
+    try:
+        result = await db.execute(stmt)
+        rows = result.all()
+        count = await count_objects(db=db, table=table, where=where, estimated=total == 'estimated') if total else None
+
+    except SQLAlchemyError as e:
+        raise ResponseValidationError(
+            status_code=status.HTTP_409_CONFLICT,
+            message='Unable to find table in the database.') from e
+
+    next_cursor = None
+    if len(rows) > size:
+        rows = rows[:size]
+        next_cursor = encode_cursor(order_by, rows[-1][-2], rows[-1][-1])
+
+    return dict(
+        items=[dict(zip(columns, row)) for row in rows],
+        next_cursor=next_cursor,
+        total=count
+    )
+
+
+@instrumented
+async def get_columns(
+    db: AsyncSession,
+    table: DeclarativeMeta,
+    columns: list[str],
+    where: list | None = None
+) -> dict[str, list]:
+    '''
+    Fetch column values of database objects as 1 list per column (array_agg), without building a row or an ORM object per object.
+
+        :param db [generator]: Database session.
+        :param table [orm]: Declarative base Table.
+        :param columns [list[str]]: Column names to return.
+        :param where [list]: Filter conditions.
+
+        :returns [dict]: Lists of values keyed by column name, in the same object order.
+    '''
+    try:
+        result = await db.execute(select(*[func.array_agg(getattr(table, c)) for c in columns]).where(*(where or [])))
+        return {c: values or [] for c, values in zip(columns, result.first())}
+
+    except SQLAlchemyError as e:
+        raise ResponseValidationError(
+            status_code=status.HTTP_409_CONFLICT,
+            message='Unable to find table in the database.') from e
+
+
+@instrumented
+async def stream_columns(
+    db: AsyncSession,
+    table: DeclarativeMeta,
+    columns: list[str],
+    where: list | None = None,
+    batch_size: int = 1000
+) -> AsyncIterator[list]:
+    '''
+    Fetch column values of database objects ordered by id, batch by batch through a server-side cursor,
+    so that the objects are never all held in memory at once.
+
+        :param db [generator]: Database session, it must stay open until the last batch.
+        :param table [orm]: Declarative base Table.
+        :param columns [list[str]]: Column names to return.
+        :param where [list]: Filter conditions.
+        :param batch_size [int]: Number of rows fetched at once.
+
+        :returns [AsyncIterator]: Batches of database rows.
+    '''
+    stmt = select(*[getattr(table, c) for c in columns]).where(*(where or [])).order_by(table.id)
+    try:
+        result = await db.stream(stmt.execution_options(max_row_buffer=batch_size))
+        async for rows in result.partitions(batch_size):
+            yield rows
+
+    except SQLAlchemyError as e:
+        raise ResponseValidationError(
+            status_code=status.HTTP_409_CONFLICT,
+            message='Unable to find table in the database.') from e
+
+
+# start time of the oldest transaction running in the database, this session's included (sessions of other roles are not visible)
+HORIZON = "SELECT min(xact_start) FROM pg_stat_activity WHERE datname = current_database() AND backend_type = 'client backend'"
+
+
+def _version_column(table: DeclarativeMeta, column: str):
+    '''Version column of a table (see get_version) as a scalar subquery, 0 until the table is first written to.'''
+    versions = models.TableVersionsTable
+    return func.coalesce(select(getattr(versions, column)).where(versions.name == table.__tablename__).scalar_subquery(), 0)
+
+
+async def _bump_version(db: AsyncSession, table: DeclarativeMeta, deleted: bool = False) -> None:
+    '''Bump the version of a table in the transaction that writes to it, right before its commit, see get_version.
+    The version row stays locked until the commit, so that the concurrent writes of a table bump it one after the other.'''
+    versions = models.TableVersionsTable
+    stmt = pg_insert(versions).values(name=table.__tablename__, version=1, deletions=int(deleted))
+    await db.execute(stmt.on_conflict_do_update(
+        index_elements=[versions.name],
+        set_=dict(version=versions.version + 1, deletions=versions.deletions + int(deleted))
+    ))
+
+
+@instrumented
+async def get_version(db: AsyncSession, table: DeclarativeMeta) -> tuple[int, int]:
+    '''
+    Fetch the version of a table, 1 primary key lookup whatever the size of the table. The CRUD write functions bump it
+    in the transaction of their writes: it changes when they are committed, whatever the order of the commits,
+    and a statement that reads a version also reads the rows written up to it. Writes made without the CRUD functions must bump it too.
+
+        :param db [generator]: Database session.
+        :param table [orm]: Declarative base Table.
+
+        :returns [tuple]: Number of writes and number of deletes of the table.
+    '''
+    try:
+        result = await db.execute(select(_version_column(table, 'version'), _version_column(table, 'deletions')))
+        return tuple(result.first())
+
+    except SQLAlchemyError as e:
+        raise ResponseValidationError(
+            status_code=status.HTTP_409_CONFLICT,
+            message='Unable to find table in the database.') from e
+
+
+# start time of the oldest transaction running in the database, this session's included (sessions of other roles are not visible)
+HORIZON = "SELECT min(xact_start) FROM pg_stat_activity WHERE datname = current_database() AND backend_type = 'client backend'"
+
+
+@instrumented
+async def get_state(db: AsyncSession, table: DeclarativeMeta) -> tuple[int, int, datetime | None]:
+    '''
+    Fetch the version of a table (see get_version), with the start time of the oldest transaction running in the database.
+    now() is the start time of a transaction, so that the objects it adds or updates have an updated_at later than this time,
+    even if they are committed after newer ones.
+
+        :param db [generator]: Database session.
+        :param table [orm]: Declarative base Table.
+
+        :returns [tuple]: Number of writes and number of deletes of the table, and start time of the oldest running transaction (horizon).
+    '''
+    try:
+        result = await db.execute(select(_version_column(table, 'version'), _version_column(table, 'deletions'), literal_column(f'({HORIZON})')))
+        return tuple(result.first())
+
+    except SQLAlchemyError as e:
+        raise ResponseValidationError(
+            status_code=status.HTTP_409_CONFLICT,
+            message='Unable to find table in the database.') from e
+
+
+@instrumented
+async def get_ranges(
+    db: AsyncSession,
+    table: DeclarativeMeta,
+    column: str,
+    ranges: list[tuple[Any, Any]],
+    columns: list[str],
+    where: list | None = None,
+    limit: int | None = None
+) -> list:
+    '''
+    Fetch the database objects whose indexed column value is within any of the ranges, e.g. the grid cells overlapped by an area.
+
+        :param db [generator]: Database session.
+        :param table [orm]: Declarative base Table.
+        :param column [str]: Indexed column name.
+        :param ranges [list[tuple]]: Inclusive ranges of the column values.
+        :param columns [list[str]]: Column names to return.
+        :param where [list]: Filter conditions.
+        :param limit [int]: Maximum number of objects, ordered by id.
+
+        :returns [list]: Database rows.
+    '''
+    indexed = getattr(table, column)
+    stmt = select(*[getattr(table, c) for c in columns]).where(or_(*[indexed.between(a, b) for a, b in ranges]), *(where or []))
+    if limit is not None:
+        stmt = stmt.order_by(table.id).limit(limit)
+
+    try:
+        result = await db.execute(stmt)
+        return result.all()
+
+    except SQLAlchemyError as e:
+        raise ResponseValidationError(
+            status_code=status.HTTP_409_CONFLICT,
+            message='Unable to find table in the database.') from e
+
+
+@instrumented
+async def get_values(
+    db: AsyncSession,
+    table: DeclarativeMeta,
+    column: str,
+    values: list,
+    columns: list[str]
+) -> dict:
+    '''
+    Fetch the database objects whose column value is one of the values.
+
+        :param db [generator]: Database session.
+        :param table [orm]: Declarative base Table.
+        :param column [str]: Column name to look up, it must be unique.
+        :param values [list]: Values to look up.
+        :param columns [list[str]]: Column names to return.
+
+        :returns [dict]: Objects as dictionaries keyed by their column value.
+    '''
+    if not values:
+        return {}
+    key = getattr(table, column)
+    try:
+        result = await db.execute(select(key, *[getattr(table, c) for c in columns]).where(key.in_(values)))
+        return {row[0]: dict(zip(columns, row[1:])) for row in result.all()}
+
+    except SQLAlchemyError as e:
+        raise ResponseValidationError(
+            status_code=status.HTTP_409_CONFLICT,
+            message='Unable to find table in the database.') from e
 
 
-def delete_table(
-    db: Session,
+@instrumented
+async def delete_table(
+    db: AsyncSession,
     table: DeclarativeMeta,
     exc_status_code: status = status.HTTP_409_CONFLICT,
     exc_message: str = 'Unable to delete objects from the database.'
@@ -96,49 +422,67 @@ def delete_table(
         :param exc_message [str]: Exception error message.
     '''
     try:
-        db.query(table).delete()
-        db.commit()
+        await db.execute(delete(table))
+        await _bump_version(db, table, deleted=True)
+        await db.commit()
+        response_cache.invalidate(table.__tablename__)
 
     except SQLAlchemyError as e:
-        db.rollback()
+        await db.rollback()
         raise ResponseValidationError(
             status_code=exc_status_code,
             message=exc_message) from e
 
-    finally:
-        db.close()
 
-
-def create_object(
-    db: Session,
-    data: DeclarativeMeta,
+@instrumented
+async def create_object(
+    db: AsyncSession,
+    table: DeclarativeMeta,
+    data: dict,
     exc_status_code: status = status.HTTP_409_CONFLICT,
-    exc_message: str = 'Unable to add object to the database.'
+    exc_message: str = 'Unable to add object to the database.',
+    conflict_message: str | None = None
 ):
     '''
-    Add an object to the database.
+    Add an object to the database and return it in the same statement (INSERT ... RETURNING).
 
         :param db [generator]: Database session.
-        :param data [orm]: Declarative base object.
+        :param table [orm]: Declarative base Table.
+        :param data [dict]: Object column values.
         :param exc_status_code [int]: Exception HTTP status code.
         :param exc_message [str]: Exception error message.
+        :param conflict_message [str]: Exception error message (HTTP 400) if the object violates a unique constraint.
+
+        :returns: Database row that has just been created.
     '''
     try:
-        db.add(data)
-        db.commit()
+        result = await db.execute(insert(table).values(**data).returning(*table.__table__.columns))
+        row = result.first()
+        await _bump_version(db, table)
+        await db.commit()
+        response_cache.invalidate(table.__tablename__)
+        return row
+
+    except IntegrityError as e:
+        await db.rollback()
+        if conflict_message and _is_unique_violation(e):
+            raise ResponseValidationError(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                message=conflict_message) from e
+        raise ResponseValidationError(
+            status_code=exc_status_code,
+            message=exc_message) from e
 
     except SQLAlchemyError as e:
-        db.rollback()
+        await db.rollback()
         raise ResponseValidationError(
             status_code=exc_status_code,
             message=exc_message) from e
 
-    finally:
-        db.close()
 
-
-def create_objects(
-    db: Session,
+@instrumented
+async def create_objects(
+    db: AsyncSession,
     data: list[DeclarativeMeta],
     exc_status_code: status = status.HTTP_409_CONFLICT,
     exc_message: str = 'Unable to add objects to the database.'
@@ -153,20 +497,246 @@ def create_objects(
     '''
     try:
         db.add_all(data)
-        db.commit()
+        tables = sorted({type(x) for x in data}, key=lambda x: x.__tablename__)  # version rows locked in the same order by every writer
+        for table in tables:
+            await _bump_version(db, table)
+        await db.commit()
+        for table in tables:
+            response_cache.invalidate(table.__tablename__)
+
+    except SQLAlchemyError as e:
+        await db.rollback()
+        raise ResponseValidationError(
+            status_code=exc_status_code,
+            message=exc_message) from e
+
+
+@instrumented
+async def insert_objects(
+    db: AsyncSession,
+    table: DeclarativeMeta,
+    batches: AsyncIterator[list[dict]],
+    conflict: list[str],
+    returning: list[str],
+    exc_status_code: status = status.HTTP_409_CONFLICT,
+    exc_message: str = 'Unable to add objects to the database.'
+) -> list:
+    '''
+    Add batches of objects to the database, 1 multi-row INSERT statement per batch without ORM objects,
+    skipping the objects that already exist (ON CONFLICT DO NOTHING). The batches are committed at once after the last one.
+
+        :param db [generator]: Database session.
+        :param table [orm]: Declarative base Table.
+        :param batches [AsyncIterator]: Batches of object column values, each batch is inserted as soon as it is ready.
+        :param conflict [list[str]]: Unique column names, objects whose values already exist are skipped.
+        :param returning [list[str]]: Column names to return.
+        :param exc_status_code [int]: Exception HTTP status code.
+        :param exc_message [str]: Exception error message.
+
+        :returns [list]: Database rows of the objects that have been added.
+    '''
+    rows = []
+    try:
+        async for data in batches:
+            if data:
+                stmt = pg_insert(table).values(data).on_conflict_do_nothing(index_elements=conflict)
+                result = await db.execute(stmt.returning(*[getattr(table, c) for c in returning]))
+                rows.extend(result.all())
+        if rows:
+            await _bump_version(db, table)
+        await db.commit()
+        response_cache.invalidate(table.__tablename__)
+        return rows
 
     except SQLAlchemyError as e:
-        db.rollback()
+        await db.rollback()
+        raise ResponseValidationError(
+            status_code=exc_status_code,
+            message=exc_message) from e
+
+
+async def _copy_records(db: AsyncSession, name: str, columns: list[str], records: list[tuple], schema: str | None = None) -> None:
+    '''Copy records into a table with PostgreSQL COPY, on the connection of the session.'''
+    connection = await (await db.connection()).get_raw_connection()
+    driver = connection.driver_connection
+    async with driver.transaction():  # a savepoint if the session has already started a transaction
+        await driver.copy_records_to_table(name, records=records, columns=columns, schema_name=schema)
+
+
+@instrumented
+async def copy_objects(
+    db: AsyncSession,
+    table: DeclarativeMeta,
+    columns: list[str],
+    records: list[tuple],
+    conflict: list[str] | None = None,
+    exc_status_code: status = status.HTTP_409_CONFLICT,
+    exc_message: str = 'Unable to add objects to the database.'
+) -> list[int]:
+    '''
+    Add a batch of objects to the database with PostgreSQL COPY, much faster than INSERT statements for large batches.
+    The batch is committed on its own, so that successive batches do not hold a growing transaction.
+    With conflict columns, the batch is copied into the staging table of the table, then inserted skipping the objects
+    that already exist (in the table, or earlier in the batch), so that a conflict rejects its objects only.
+
+        :param db [generator]: Database session.
+        :param table [orm]: Declarative base Table.
+        :param columns [list[str]]: Column names, in the order of the record values.
+        :param records [list[tuple]]: Object column values.
+        :param conflict [list[str]]: Unique column names, that must be part of the columns.
+        :param exc_status_code [int]: Exception HTTP status code.
+        :param exc_message [str]: Exception error message.
+
+        :returns [list[int]]: Positions of the records that have not been added, since they already exist.
+    '''
+    try:
+        if conflict:
+            rejected = await _insert_new_records(db, table, columns, records, conflict)
+        else:
+            await _copy_records(db, table.__tablename__, columns, records, schema=table.__table__.schema)
+            rejected = []
+        if len(rejected) < len(records):
+            await _bump_version(db, table)
+        await db.commit()
+        response_cache.invalidate(table.__tablename__)
+        return rejected
+
+    except (PostgresError, SQLAlchemyError) as e:
+        await db.rollback()
+        raise ResponseValidationError(
+            status_code=exc_status_code,
+            message=exc_message) from e
+
+
+async def _insert_new_records(db: AsyncSession, table: DeclarativeMeta, columns: list[str], records: list[tuple], conflict: list[str]) -> list[int]:
+    '''Copy the first record of each conflict key into the staging table, insert the ones that do not exist yet, and return
+    the positions of the other records.'''
+    positions = [columns.index(c) for c in conflict]
+    keys = [tuple(x[i] for i in positions) for x in records]
+    first = {}
+    for position, key in enumerate(keys):
+        first.setdefault(key, position)
+
+    staging = await _create_staging(db, table, columns)
+    await _copy_records(db, staging, columns, [records[i] for i in first.values()])
+    selected, returned = ', '.join(f'"{c}"' for c in columns), ', '.join(f'"{c}"' for c in conflict)
+    result = await db.execute(text(
+        f'INSERT INTO {table.__tablename__} ({selected}) SELECT {selected} FROM {staging} '
+        f'ON CONFLICT ({returned}) DO NOTHING RETURNING {returned}'
+    ))
+    inserted = {tuple(x) for x in result.all()}
+    return [i for i, key in enumerate(keys) if first[key] != i or key not in inserted]
+
+
+async def _create_staging(db: AsyncSession, table: DeclarativeMeta, columns: list[str]) -> str:
+    '''Create the staging table of a table, if it does not exist yet in the transaction, and return its name.'''
+    name, selected = f'{table.__tablename__}_staging', ', '.join(f'"{c}"' for c in columns)
+    await db.execute(text(f'CREATE TEMPORARY TABLE IF NOT EXISTS {name} ON COMMIT DROP AS SELECT {selected} FROM {table.__tablename__} WITH NO DATA'))
+    return name
+
+
+@instrumented
+async def stage_objects(
+    db: AsyncSession,
+    table: DeclarativeMeta,
+    columns: list[str],
+    records: list[tuple],
+    exc_status_code: status = status.HTTP_409_CONFLICT,
+    exc_message: str = 'Unable to stage objects in the database.'
+):
+    '''
+    Copy a batch of objects into the staging table of a table, see merge_objects. The staging table is temporary, without constraints,
+    created on the first batch and dropped at the end of the transaction.
+
+        :param db [generator]: Database session.
+        :param table [orm]: Declarative base Table.
+        :param columns [list[str]]: Column names, in the order of the record values.
+        :param records [list[tuple]]: Object column values.
+        :param exc_status_code [int]: Exception HTTP status code.
+        :param exc_message [str]: Exception error message.
+    '''
+    try:
+        await _copy_records(db, await _create_staging(db, table, columns), columns, records)
+
+    except (PostgresError, SQLAlchemyError) as e:
+        await db.rollback()
+        raise ResponseValidationError(
+            status_code=exc_status_code,
+            message=exc_message) from e
+
+
+def _merge_statement(name: str, staging: str, key: str, columns: list[str], compare: str) -> str:
+    '''Upsert the staged rows deduplicated by key, and count the staged, inserted and updated rows.'''
+    quoted = [f'"{c}"' for c in columns]
+    updates = ', '.join(f'{c} = EXCLUDED.{c}' for c in quoted if c != f'"{key}"')
+    return (
+        f'WITH merged AS ('
+        f'INSERT INTO {name} ({", ".join(quoted)}) '
+        f'SELECT DISTINCT ON ("{key}") {", ".join(quoted)} FROM {staging} ORDER BY "{key}", ctid DESC '
+        f'ON CONFLICT ("{key}") DO UPDATE SET {updates}, updated_at = now() '
+        f'WHERE {name}."{compare}" IS DISTINCT FROM EXCLUDED."{compare}" '
+        f'RETURNING xmax = 0 AS inserted) '
+        f'SELECT (SELECT count(DISTINCT "{key}") FROM {staging}), count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted) FROM merged'
+    )
+
+
+@instrumented
+async def merge_objects(
+    db: AsyncSession,
+    table: DeclarativeMeta,
+    key: str,
+    columns: list[str],
+    compare: str,
+    deactivate: str | None = None,
+    exc_status_code: status = status.HTTP_409_CONFLICT,
+    exc_message: str = 'Unable to merge objects into the database.'
+) -> dict:
+    '''
+    Merge the staged objects into their table with set-based statements, then commit: new objects are inserted,
+    changed objects are updated (and their updated_at bumped), unchanged objects are not written at all.
+    The staged objects are deduplicated by key, the last one wins.
+
+        :param db [generator]: Database session.
+        :param table [orm]: Declarative base Table.
+        :param key [str]: Column name of the unique key that identifies objects.
+        :param columns [list[str]]: Staged column names.
+        :param compare [str]: Column name of the generated hash of the object content, compared to find changed objects.
+        :param deactivate [str]: Boolean column name set to false on the active objects that have not been staged, if given.
+        :param exc_status_code [int]: Exception HTTP status code.
+        :param exc_message [str]: Exception error message.
+
+        :returns [dict]: Number of staged, inserted, updated, unchanged and deactivated objects.
+    '''
+    try:
+        name = await _create_staging(db, table, columns)
+        await db.execute(text(f'ANALYZE {name}'))
+        result = await db.execute(text(_merge_statement(table.__tablename__, name, key, columns, compare)))
+        staged, inserted, updated = result.first()
+
+        deactivated = 0
+        if deactivate:
+            result = await db.execute(text(
+                f'UPDATE {table.__tablename__} SET "{deactivate}" = false, updated_at = now() '
+                f'WHERE "{deactivate}" AND NOT EXISTS (SELECT 1 FROM {name} s WHERE s."{key}" = {table.__tablename__}."{key}")'
+            ))
+            deactivated = result.rowcount
+        if inserted or updated or deactivated:
+            await _bump_version(db, table)
+        await db.commit()
+        response_cache.invalidate(table.__tablename__)
+
+    except (PostgresError, SQLAlchemyError) as e:
+        await db.rollback()
         raise ResponseValidationError(
             status_code=exc_status_code,
             message=exc_message) from e
 
-    finally:
-        db.close()
+    return dict(staged=staged, inserted=inserted, updated=updated, unchanged=staged - inserted - updated, deactivated=deactivated)
 
 
-def update_object(
-    db: Session,
+@instrumented
+async def update_object(
+    db: AsyncSession,
     table: DeclarativeMeta,
     column: DeclarativeMeta,
     value: Any,
@@ -175,7 +745,7 @@ def update_object(
     exc_message: str = 'Unable to update object in the database.'
 ):
     '''
-    Update a database object.
+    Update a database object and return it in the same statement (UPDATE ... RETURNING).
 
         :param db [generator]: Database session.
         :param table [orm]: Declarative base Table.
@@ -184,24 +754,41 @@ def update_object(
         :param data [dict]: Update dictionary.
         :param exc_status_code [int]: Exception HTTP status code.
         :param exc_message [str]: Exception error message.
+
+        :returns: Database row that has just been updated.
     '''
 
     try:
-        db.query(table).filter(column == value).update(data)
-        db.commit()
+        result = await db.execute(
+            update(table)
+            .where(column == value)
+            .values(**data)
+            .returning(*table.__table__.columns)
+            .execution_options(synchronize_session=False)
+        )
+        row = result.first()
+        if row:
+            await _bump_version(db, table)
+        await db.commit()
+        response_cache.invalidate(table.__tablename__)
 
     except SQLAlchemyError as e:
-        db.rollback()
+        await db.rollback()
         raise ResponseValidationError(
             status_code=exc_status_code,
             message=exc_message) from e
 
-    finally:
-        db.close()
+    if not row:
+        raise ResponseValidationError(
+            status_code=exc_status_code,
+            message=exc_message
+        )
+    return row
 
 
-def delete_object(
-    db: Session,
+@instrumented
+async def delete_object(
+    db: AsyncSession,
     data: DeclarativeMeta,
     exc_status_code: status = status.HTTP_409_CONFLICT,
     exc_message: str = 'Unable to delete object from the database.'
@@ -215,14 +802,13 @@ def delete_object(
         :param exc_message [str]: Exception error message.
     '''
     try:
-        db.delete(data)
-        db.commit()
+        await db.delete(data)
+        await _bump_version(db, type(data), deleted=True)
+        await db.commit()
+        response_cache.invalidate(data.__tablename__)
 
     except SQLAlchemyError as e:
-        db.rollback()
+        await db.rollback()
         raise ResponseValidationError(
             status_code=exc_status_code,
             message=exc_message) from e
-
-    finally:
-        db.close()
@@ -1,10 +1,11 @@
 '''This module defines all database tables.'''
 
 from enum import Enum as Enumerations
-from sqlalchemy import Column, Boolean, Integer, Float, String, DateTime, Enum
+from sqlalchemy import BigInteger, Column, Boolean, Computed, Integer, Float, String, DateTime, Enum, Index
 from sqlalchemy.sql import func
 
 from database.session import Base
+from helpers.geo import cell_expression
 
 
 # Enumerations
@@ -16,11 +17,19 @@ class Status(Enumerations):
     PENDING = 'pending'
 
 
+# Generated Columns
+def content_hash(*columns: str) -> Computed:
+    '''MD5 hash of column values computed by PostgreSQL on write, so that changed rows are found by comparing 1 column.'''
+    values = " || chr(31) || ".join(f"coalesce(\"{c}\"::text, '')" for c in columns)
+    return Computed(f'md5({values})', persisted=True)
+
+
 # Database Columns
 class AdminsTable(Base):
     '''Define admins as a database table.'''
 
     __tablename__ = 'admins'
+    __table_args__ = (Index('ix_admins_updated_at_id', 'updated_at', 'id'),)
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     username = Column(String, unique=True, nullable=False)
@@ -34,6 +43,7 @@ class UserTable(Base):
     '''Define users as a database table.'''
 
     __tablename__ = 'users'
+    __table_args__ = (Index('ix_users_updated_at_id', 'updated_at', 'id'),)
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     email = Column(String, unique=True, nullable=False)
@@ -48,6 +58,10 @@ class FarmsTable(Base):
     '''Define farms as a database table.'''
 
     __tablename__ = 'farms'
+    __table_args__ = (
+        Index('ix_farms_updated_at_id', 'updated_at', 'id'),
+        Index('ix_farms_geo_cell', 'GeoCell'),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     GroupScheme = Column(String, nullable=False)
@@ -55,7 +69,7 @@ class FarmsTable(Base):
     Province = Column(String, nullable=False)
     Latitude = Column(Float, nullable=False)
     Longitude = Column(Float, nullable=False)
-    FarmId = Column(String, nullable=False)
+    FarmId = Column(String, unique=True, nullable=False)
     FarmSize = Column(Float, nullable=False)
     UnitNumber = Column(String, nullable=False)
     EffectiveArea = Column(Float, nullable=False)
@@ -67,5 +81,20 @@ class FarmsTable(Base):
     SphaSurvival = Column(Float, nullable=False)
     PlannedPlantDT = Column(String, nullable=False)
     IsActive = Column(Boolean, nullable=False)
+    ContentHash = Column(String, content_hash(
+        'GroupScheme', 'Country', 'Province', 'Latitude', 'Longitude', 'FarmSize', 'UnitNumber', 'EffectiveArea', 'AreaTypeName',
+        'ProductGroup', 'GenusName', 'SpeciesName', 'PlantAge', 'SphaSurvival', 'PlannedPlantDT', 'IsActive'
+    ))
+    GeoCell = Column(BigInteger, Computed(cell_expression('Latitude', 'Longitude'), persisted=True))
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+
+class TableVersionsTable(Base):
+    '''Define the versions of the other tables as a database table, bumped by the CRUD write functions, see crud.get_version.'''
+
+    __tablename__ = 'table_versions'
+
+    name = Column(String, primary_key=True)
+    version = Column(BigInteger, nullable=False, server_default='0')
+    deletions = Column(BigInteger, nullable=False, server_default='0')
@@ -0,0 +1,71 @@
+'''This module instruments the database connection pool to collect its statistics.'''
+
+from bisect import bisect_left
+from time import perf_counter
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import AsyncAdaptedQueuePool, Pool
+
+
+class PoolStatistics:
+    '''Connection pool statistics class.'''
+
+    WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # seconds
+
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_sum = 0.0
+        self.wait_counts = [0] * (len(self.WAIT_BUCKETS) + 1)
+
+    def observe_checkout(self, seconds: float) -> None:
+        '''Record how long a connection checkout has waited.'''
+        self.checkouts += 1
+        self.wait_sum += seconds
+        self.wait_counts[bisect_left(self.WAIT_BUCKETS, seconds)] += 1
+
+    def observe_timeout(self) -> None:
+        '''Record a connection checkout that has timed out.'''
+        self.timeouts += 1
+
+    def reset(self) -> None:
+        '''Reset the collected statistics.'''
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_sum = 0.0
+        self.wait_counts = [0] * (len(self.WAIT_BUCKETS) + 1)
+
+    def snapshot(self, pool: Pool) -> dict:
+        '''Read the pool gauges and the collected statistics.'''
+        histogram, cumulative = {}, 0
+        for bound, count in zip(self.WAIT_BUCKETS + ('+Inf',), self.wait_counts):
+            cumulative += count
+            histogram[str(bound)] = cumulative
+
+        return dict(
+            size=pool.size(),
+            checked_out=pool.checkedout(),
+            idle=pool.checkedin(),
+            overflow=max(pool.overflow(), 0),
+            checkouts=self.checkouts,
+            checkout_timeouts=self.timeouts,
+            wait_seconds_sum=self.wait_sum,
+            wait_seconds_histogram=histogram
+        )
+
+
+pool_stats = PoolStatistics()
+
+
+class InstrumentedQueuePool(AsyncAdaptedQueuePool):
+    '''Asynchronous queue pool that records checkout wait times and timeouts.'''
+
+    def connect(self):
+        '''Check out a connection from the pool, waiting for one to be returned if the pool is saturated.'''
+        start = perf_counter()
+        try:
+            return super().connect()
+        except PoolTimeoutError:
+            pool_stats.observe_timeout()
+            raise
+        finally:
+            pool_stats.observe_checkout(perf_counter() - start)
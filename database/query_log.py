@@ -0,0 +1,121 @@
+'''This module watches the database statements of each request: their number against the budget of the request route,
+and their latency against the slow statement threshold (QUERIES settings). Statements are logged normalized (literals and
+parameters replaced by ?) with the types of their parameters only, the route and the CRUD function that has issued them.'''
+
+import logging
+import re
+from contextvars import ContextVar
+from functools import wraps
+from inspect import isasyncgenfunction
+from typing import Any, Callable
+
+from config import QueriesConfig, get_settings
+from helpers.metrics import current_request, route_path
+from helpers.profiling import profiled
+
+
+logger = logging.getLogger(__name__)
+
+LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|\$\d+|%\(\w+\)s|%s|(?<!:):\w+")
+LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+REPEATS = re.compile(r'(\(\.\.\.\)|\(\?\))(?:\s*,\s*\1)+')
+MAX_TYPES = 10  # parameter types logged per statement
+
+current_operation: ContextVar[str | None] = ContextVar('query_operation', default=None)
+
+
+class QueryBudgetExceeded(RuntimeError):
+    '''A request has issued more database statements than the budget of its route, raised if QUERIES.ON_EXCEEDED is raise.'''
+
+
+def instrumented(func: Callable) -> Callable:
+    '''Name the statements of a CRUD coroutine function after it in the query logs, and time it as the crud request phase.'''
+    if isasyncgenfunction(func):
+        return profiled('crud')(func)
+
+    @wraps(func)
+    async def wrapper(*args: Any, **kwargs: Any) -> Any:
+        '''Await the decorated function.'''
+        token = current_operation.set(func.__name__)
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            current_operation.reset(token)
+    return profiled('crud')(wrapper)
+
+
+def normalize(statement: str) -> str:
+    '''Normalize a SQL statement: literals and parameter placeholders replaced by ?, lists and repeated rows collapsed, whitespace squeezed.'''
+    statement = LITERALS.sub('?', ' '.join(statement.split()))
+    return REPEATS.sub(r'\1, ...', LISTS.sub('(...)', statement))
+
+
+def redact(parameters: Any) -> str:
+    '''Describe statement parameters by their types only, so that their values are never logged.'''
+    if not parameters:
+        return '()'
+    if isinstance(parameters, dict):
+        items = [f'{k}: {type(v).__name__}' for k, v in list(parameters.items())[:MAX_TYPES]]
+    else:
+        items = [type(x).__name__ for x in list(parameters)[:MAX_TYPES]]
+    more = len(parameters) - MAX_TYPES
+    return f'({", ".join(items)}{f", +{more} more" if more > 0 else ""})'
+
+
+class QueryBudgets:
+    '''Statements budget per route, from the QUERIES settings: the budget of the longest matching route path prefix, QUERIES.BUDGET otherwise.
+    Budgets are looked up once per route and settings snapshot.'''
+
+    def __init__(self):
+        self.config: QueriesConfig | None = None
+        self.routes: dict[str, int | None] = {}
+
+    def get(self, route: str, config: QueriesConfig) -> int | None:
+        '''Budget of a route path template, None if unlimited.'''
+        if config is not self.config:
+            self.config, self.routes = config, {}
+        if route not in self.routes:
+            matches = [x for x in config.BUDGETS if route == x.ROUTE or route.startswith(x.ROUTE.rstrip('/') + '/')]
+            self.routes[route] = max(matches, key=lambda x: len(x.ROUTE)).MAX if matches else config.BUDGET
+        return self.routes[route]
+
+
+budgets = QueryBudgets()
+
+
+def before_query(statement: str) -> None:
+    '''Check the statements budget of the request being served, before its statement is executed.'''
+    request = current_request.get()
+    if request is None or request.budget_exceeded:
+        return
+    config = get_settings().QUERIES
+    route = route_path(request.scope)
+    budget = budgets.get(route, config)
+    if budget is None or request.queries < budget:
+        return
+
+    message = (
+        f'Query budget exceeded on {request.scope["method"]} {route}: statement {request.queries + 1} of {budget} allowed, '
+        f'issued by {current_operation.get() or "-"}: {normalize(statement)}'
+    )
+    if config.ON_EXCEEDED == 'raise':
+        raise QueryBudgetExceeded(message)
+    request.budget_exceeded = True  # logged once per request
+    logger.warning(message)
+
+
+def after_query(statement: str, parameters: Any, seconds: float, rows: int | None) -> None:
+    '''Log a statement slower than QUERIES.SLOW seconds, with its rows if the driver reports them.'''
+    slow = get_settings().QUERIES.SLOW
+    if slow is None or seconds < slow:
+        return
+    request = current_request.get()
+    logger.warning(
+        'Slow query (%.3f s, %s rows) on %s, issued by %s: %s parameters: %s',
+        seconds,
+        '-' if rows is None else rows,
+        f'{request.scope["method"]} {route_path(request.scope)}' if request else '-',
+        current_operation.get() or '-',
+        normalize(statement),
+        redact(parameters)
+    )
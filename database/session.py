@@ -1,22 +1,89 @@
-'''This module creates the database engine and a session for each instance as a generator.'''
+'''This module creates the asynchronous database engine and a session for each instance as a generator.'''
 
-from typing import Generator
-from sqlalchemy import create_engine
+from time import perf_counter
+from typing import AsyncGenerator
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
 
-from config import get_settings
+from config import DatabaseConfig, Settings, get_settings, subscribe_settings
+from database.pool import InstrumentedQueuePool, pool_stats
+from database.query_log import after_query, before_query
+from helpers.metrics import metric_state, observe_query, registry
 
 
-settings = get_settings()
-engine = create_engine(settings.DATABASE.BASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:  # pylint: disable=[W0613]
+    '''Check the statements budget of the request, and start timing a statement.'''
+    before_query(statement)
+    context.query_start = perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:  # pylint: disable=[W0613]
+    '''Record the latency and number of rows of a statement, log it if slow. The rows are the ones reported by the driver, None if it reports
+    none (-1 rowcount, e.g. the SELECT statements of asyncpg).'''
+    rows = cursor.rowcount if cursor.rowcount >= 0 else None
+    seconds = perf_counter() - context.query_start
+    observe_query(statement, seconds, rows)
+    after_query(statement, parameters, seconds, rows)
+
+
+def create_engine(database: DatabaseConfig) -> AsyncEngine:
+    '''Create the asynchronous database engine and its connection pool, its statements are recorded in the metrics.'''
+    engine = create_async_engine(
+        database.ASYNC_URL,
+        poolclass=InstrumentedQueuePool,
+        pool_size=database.POOL.SIZE,
+        max_overflow=database.POOL.MAX_OVERFLOW,
+        pool_timeout=database.POOL.TIMEOUT,
+        pool_recycle=database.POOL.RECYCLE,
+        pool_pre_ping=database.POOL.PRE_PING
+    )
+    event.listen(engine.sync_engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine.sync_engine, 'after_cursor_execute', after_cursor_execute)
+    return engine
+
+
+engine = create_engine(get_settings().DATABASE)
+SessionLocal = sessionmaker(bind=engine, class_=AsyncSession, autocommit=False, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
 
-def get_db() -> Generator:
-    '''Database generator.'''
-    try:
-        db = SessionLocal()
+@subscribe_settings
+async def reconfigure_engine(old: Settings, new: Settings) -> None:
+    '''Replace the engine when the database settings change. New sessions use the new pool, the idle connections of the old one are closed.'''
+    global engine  # pylint: disable=[W0603,C0103]
+    if new.DATABASE == old.DATABASE:
+        return
+    previous, engine = engine, create_engine(new.DATABASE)
+    SessionLocal.configure(bind=engine)
+    await previous.dispose()
+
+
+def get_pool_statistics() -> dict:
+    '''Database connection pool statistics of the current worker process.'''
+    return pool_stats.snapshot(engine.sync_engine.pool)
+
+
+@registry.collector
+def pool_metrics() -> dict:
+    '''Connection pool metrics of the current worker process, read at scrape time.'''
+    stats = get_pool_statistics()
+    return dict(
+        db_pool_size=metric_state('gauge', 'Connections kept open by the pool.', [((), stats['size'])]),
+        db_pool_connections=metric_state(
+            'gauge', 'Pool connections, per state.',
+            [(('checked_out',), stats['checked_out']), (('idle',), stats['idle']), (('overflow',), stats['overflow'])], labels=('state',)
+        ),
+        db_pool_checkouts_total=metric_state('counter', 'Connection checkouts.', [((), stats['checkouts'])]),
+        db_pool_checkout_timeouts_total=metric_state('counter', 'Connection checkouts that have timed out.', [((), stats['checkout_timeouts'])]),
+        db_pool_checkout_wait_seconds=metric_state(
+            'histogram', 'Connection checkout wait in seconds.',
+            [((), [list(pool_stats.wait_counts), pool_stats.wait_sum])], buckets=pool_stats.WAIT_BUCKETS
+        )
+    )
+
+
+async def get_db() -> AsyncGenerator[AsyncSession, None]:
+    '''Database asynchronous generator. The session is the unit of work of the whole request.'''
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
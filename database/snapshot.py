@@ -0,0 +1,130 @@
+'''This module keeps columnar in-memory snapshots of read-mostly database tables, per worker process.
+A snapshot is refreshed from its updated_at watermark when the table version has changed: only the rows updated since the last refresh
+are fetched and applied in place, and it is fully reloaded when rows have been deleted (the number of deletes of the table has changed).'''
+
+import time
+from collections.abc import AsyncIterator
+from functools import partial
+from datetime import datetime, timedelta
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.decl_api import DeclarativeMeta
+
+from config import get_settings
+from database import crud
+from helpers.columnar import ColumnarTable
+from helpers.lru_caching import SingleFlight
+
+
+snapshots: dict[str, 'TableSnapshot'] = {}
+
+
+class TableSnapshot:
+    '''
+    Columnar snapshot of a database table with an updated_at column, see ColumnarTable.
+
+        :param table [orm]: Declarative base Table.
+        :param columns [dict]: Column kinds keyed by column name, the primary key (id) included.
+        :param unique [tuple[str]]: Unique column names, rows can be looked up by them.
+    '''
+
+    def __init__(self, table: DeclarativeMeta, columns: dict[str, str], unique: tuple[str, ...] = ()):
+        self.table = table
+        self.empty = partial(ColumnarTable, dict(columns), unique=unique)
+        self.data = self.empty()
+        self.version: tuple[int, int] | None = None  # table version of the last refresh, see crud.get_version
+        self.watermark: datetime | None = None
+        self.checked_at = float('-inf')
+        self.flight = SingleFlight()
+        self.stats = dict(refreshes=0, reloads=0, rows=0, seconds=0.0, last_rows=0, last_seconds=0.0)
+        snapshots[table.__tablename__] = self
+
+    async def get(self, db: AsyncSession) -> ColumnarTable:
+        '''Get the snapshot, refreshed first if it has not been checked for DATABASE.SNAPSHOT.REFRESH seconds.'''
+        if time.monotonic() - self.checked_at >= get_settings().DATABASE.SNAPSHOT.REFRESH:
+            await self.flight.call_async(None, lambda: self.refresh(db))
+        return self.data
+
+    def expire(self) -> None:
+        '''Check the table for changes on the next request, e.g. after this worker process has written to it.'''
+        self.checked_at = float('-inf')
+
+    async def state(self, db: AsyncSession) -> tuple[tuple[int, int], datetime | None]:
+        '''Fetch the table version (number of writes and deletes), and the start time of the oldest running transaction, see crud.get_state.'''
+        writes, deletes, horizon = await crud.get_state(db=db, table=self.table)
+        return (writes, deletes), horizon
+
+    async def fetch(self, db: AsyncSession, since: datetime | None = None) -> AsyncIterator[dict[str, list]]:
+        '''Fetch the rows updated after a time (all rows by default) ordered by id, DATABASE.SNAPSHOT.BATCH_SIZE rows at once through a server-side cursor.'''
+        names = list(dict.fromkeys([*self.data.kinds, 'updated_at']))
+        where = [] if since is None else [self.table.updated_at > since]
+        batches = crud.stream_columns(db=db, table=self.table, columns=names, where=where, batch_size=get_settings().DATABASE.SNAPSHOT.BATCH_SIZE)
+        async for rows in batches:
+            yield {name: list(values) for name, values in zip(names, zip(*rows))}
+
+    async def apply(self, db: AsyncSession, data: ColumnarTable, since: datetime | None = None) -> tuple[int, datetime | None]:
+        '''
+        Upsert the rows updated after a time (all rows by default) into a columnar table, chunk by chunk.
+
+            :param db [generator]: Database session.
+            :param data [ColumnarTable]: Columnar table to update.
+            :param since [datetime]: Update time of the rows already applied.
+
+            :returns [tuple]: Number of rows applied, and their latest update time.
+        '''
+        rows, latest = 0, None
+        async for columns in self.fetch(db, since=since):
+            data.upsert(columns)
+            rows += len(columns['updated_at'])
+            latest = max(columns['updated_at'] if latest is None else [latest, *columns['updated_at']])
+        return rows, latest
+
+    async def reload(self, db: AsyncSession) -> tuple[int, datetime | None]:
+        '''Replace the snapshot with all the rows of the table, the current one is served until they are all loaded.'''
+        data = self.empty()
+        rows, latest = await self.apply(db, data)
+        self.data = data
+        self.stats['reloads'] += 1
+        return rows, latest
+
+    async def refresh(self, db: AsyncSession) -> None:
+        '''
+        Apply the rows updated after the watermark, nothing is fetched if the table version has not changed since the last refresh.
+        The watermark is the latest update time fetched, kept before the start time of the oldest transaction running before the fetch:
+        the rows of a long transaction committed after the fetch have an older updated_at than the latest one, its commit bumps the version,
+        and the next refresh fetches them from the watermark. The version is read before the fetch, so that a commit in between is fetched again.
+        '''
+        start = time.perf_counter()
+        version, horizon = await self.state(db)
+        rows = 0
+        if version != self.version:
+            if self.watermark is None or self.version is None or version[1] != self.version[1]:  # rows have been deleted
+                rows, latest = await self.reload(db)
+            else:
+                rows, latest = await self.apply(db, self.data, since=self.watermark)
+            if latest is not None:
+                self.watermark = min(latest, horizon - timedelta(microseconds=1)) if horizon else latest
+            self.version = version
+
+        seconds = time.perf_counter() - start
+        self.checked_at = time.monotonic()
+        self.stats['refreshes'] += 1
+        self.stats['rows'] += rows
+        self.stats['seconds'] += seconds
+        self.stats['last_rows'], self.stats['last_seconds'] = rows, seconds
+
+    def info(self) -> dict:
+        '''Snapshot size, memory footprint and refresh statistics.'''
+        sizes = self.data.nbytes()
+        return dict(
+            self.stats,
+            length=len(self.data),
+            bytes=sum(sizes.values()),
+            columns=sizes,
+            watermark=self.watermark,
+            age=time.monotonic() - self.checked_at if self.stats['refreshes'] else None
+        )
+
+
+def snapshot_statistics() -> dict:
+    '''Snapshots statistics of the current worker process, per table.'''
+    return {name: snapshot.info() for name, snapshot in snapshots.items()}
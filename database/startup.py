@@ -2,24 +2,17 @@
 
 from config import get_settings
 from database import crud, models, session
-from helpers.misc import try_except
+from helpers.misc import try_except_async
 from security.hashing import SecureHash
 
 
-settings = get_settings()
-
-
-ADMIN_MASTER = models.AdminsTable(
-    username=settings.ADMIN.USERNAME,
-    hashed_password=SecureHash.create(settings.ADMIN.PASSWORD),
-    is_active=True
-)
-
-
-def setup_database():
+async def setup_database():
     '''Insert initial data to the database.'''
-    try:
-        db = session.SessionLocal()
-        try_except(crud.create_object, db=db, data=ADMIN_MASTER)
-    finally:
-        db.close()
+    settings = get_settings()
+    admin_master = dict(
+        username=settings.ADMIN.USERNAME,
+        hashed_password=await SecureHash.create_async(settings.ADMIN.PASSWORD),
+        is_active=True
+    )
+    async with session.SessionLocal() as db:
+        await try_except_async(crud.create_object, db=db, table=models.AdminsTable, data=admin_master)
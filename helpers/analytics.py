@@ -0,0 +1,112 @@
+'''This module computes group-by aggregates over columns held as NumPy arrays: count, sum, mean, min, max, percentiles and histograms.
+Rows are encoded into group numbers once, then each aggregate is computed for every group at once (bincount, lexsort),
+without a Python loop over rows or groups.'''
+
+import numpy as np
+
+
+def group_rows(keys: list[np.ndarray]) -> tuple[list[np.ndarray], np.ndarray]:
+    '''
+    Encode the group of each row from its key columns.
+
+        :param keys [list[ndarray]]: Key columns, the rows are grouped by their combination.
+
+        :returns [tuple]: Key values of each group (1 array per key column, groups in sorted order), and group number of each row.
+    '''
+    uniques, codes = [], []
+    for column in keys:
+        unique, inverse = np.unique(column.astype(str) if column.dtype == object else column, return_inverse=True)  # fixed-width strings sort faster
+        uniques.append(unique)
+        codes.append(inverse.ravel())
+    if not keys:
+        return [], np.zeros(0, dtype=np.intp)
+
+    shape = tuple(len(x) for x in uniques)
+    groups, inverse = np.unique(np.ravel_multi_index(codes, shape), return_inverse=True)
+    return [unique[x] for unique, x in zip(uniques, np.unravel_index(groups, shape))], inverse.ravel()
+
+
+def aggregate(values: np.ndarray, groups: np.ndarray, size: int, percentiles: list[float], bins: int) -> dict[str, np.ndarray]:
+    '''
+    Aggregate the values of each group.
+
+        :param values [ndarray]: Values.
+        :param groups [ndarray]: Group number of each value, see group_rows.
+        :param size [int]: Number of groups, each of them has 1 value at least.
+        :param percentiles [list[float]]: Percentiles to compute, between 0 and 100 (linear interpolation).
+        :param bins [int]: Number of histogram bins, shared by all groups (equal widths between the min and max values), 0 for none.
+
+        :returns [dict]: Arrays of the aggregates of each group: count, sum, mean, min, max, percentiles (groups x percentiles),
+        histogram (groups x bins) and edges (bins + 1).
+    '''
+    count = np.bincount(groups, minlength=size)
+    total = np.bincount(groups, weights=values, minlength=size)
+
+    # values sorted by group then value, so that each group is a sorted slice
+    ordered = values[np.lexsort((values, groups))]
+    starts = np.concatenate(([0], np.cumsum(count)[:-1]))
+    positions = starts[:, None] + (count[:, None] - 1) * np.asarray(percentiles, dtype=np.float64)[None, :] / 100
+    lower, upper = np.floor(positions).astype(np.intp), np.ceil(positions).astype(np.intp)
+
+    result = dict(
+        count=count,
+        sum=total,
+        mean=total / count,
+        min=ordered[starts],
+        max=ordered[starts + count - 1],
+        percentiles=ordered[lower] + (ordered[upper] - ordered[lower]) * (positions - lower)
+    )
+    if bins:
+        edges = np.histogram_bin_edges(values, bins=bins)
+        index = np.clip(np.searchsorted(edges, values, side='right') - 1, 0, bins - 1)
+        result['histogram'] = np.bincount(groups * bins + index, minlength=size * bins).reshape(size, bins)
+        result['edges'] = edges
+    return result
+
+
+def summary(result: dict[str, np.ndarray], index: int, percentiles: list[float]) -> dict:
+    '''Aggregates of a group, see aggregate.'''
+    data = dict(
+        sum=float(result['sum'][index]),
+        mean=float(result['mean'][index]),
+        min=float(result['min'][index]),
+        max=float(result['max'][index]),
+        percentiles={f'p{p:g}': float(v) for p, v in zip(percentiles, result['percentiles'][index])}
+    )
+    if 'histogram' in result:
+        data['histogram'] = result['histogram'][index].tolist()
+    return data
+
+
+def group_by(
+    columns: dict[str, np.ndarray],
+    keys: list[str],
+    metrics: list[str],
+    percentiles: list[float],
+    bins: int = 0
+) -> dict:
+    '''
+    Aggregate metric columns grouped by key columns.
+
+        :param columns [dict]: Columns as arrays of the same length.
+        :param keys [list[str]]: Key column names, all rows are 1 group if empty.
+        :param metrics [list[str]]: Metric column names, their values must be numbers.
+        :param percentiles [list[float]]: Percentiles to compute, between 0 and 100.
+        :param bins [int]: Number of histogram bins, 0 for none.
+
+        :returns [dict]: Groups in sorted order with their keys, count and metric aggregates, and the histogram edges of each metric.
+    '''
+    length = len(columns[metrics[0]]) if metrics else 0
+    if not length:
+        return dict(groups=[], edges={})
+    values, groups = group_rows([columns[x] for x in keys]) if keys else ([], np.zeros(length, dtype=np.intp))
+    size = len(values[0]) if values else 1
+    count = np.bincount(groups, minlength=size)
+
+    results = {x: aggregate(np.asarray(columns[x], dtype=np.float64), groups, size, percentiles, bins) for x in metrics}
+    data = []
+    for index in range(size):
+        item = dict(group={name: x[index].item() if isinstance(x[index], np.generic) else x[index] for name, x in zip(keys, values)}, count=int(count[index]))
+        item.update({name: summary(result, index, percentiles) for name, result in results.items()})
+        data.append(item)
+    return dict(groups=data, edges={name: result['edges'].tolist() for name, result in results.items() if bins})
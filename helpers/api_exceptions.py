@@ -1,9 +1,9 @@
 '''This module manages FastAPI exception messages.'''
 
 from fastapi import HTTPException, Request, status
-from fastapi.encoders import jsonable_encoder
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
+
+from helpers.api_responses import ORJSONResponse
 
 
 class ResponseValidationError(Exception):
@@ -14,27 +14,23 @@ class ResponseValidationError(Exception):
         self.message = message
 
 
-async def request_exception_handler(request: Request, exc: RequestValidationError) -> JSONResponse:  # pylint: disable=[W0613]
+async def request_exception_handler(request: Request, exc: RequestValidationError) -> ORJSONResponse:  # pylint: disable=[W0613]
     '''Ensure that the parameters passed by the HTTP request follow the defined schemas.'''
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-        content=jsonable_encoder(
-            dict(
-                error=True,
-                message={d['loc'][-1]: d['msg'] for d in exc.errors()}
-            )
+        content=dict(
+            error=True,
+            message={d['loc'][-1]: d['msg'] for d in exc.errors()}
         )
     )
 
 
-async def response_exception_handler(request: Request, exc: ResponseValidationError) -> JSONResponse:  # pylint: disable=[W0613]
+async def response_exception_handler(request: Request, exc: ResponseValidationError) -> ORJSONResponse:  # pylint: disable=[W0613]
     '''Ensure exception responses are standardized.'''
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=exc.status_code,
-        content=jsonable_encoder(
-            dict(
-                error=True,
-                message=exc.message
-            )
+        content=dict(
+            error=True,
+            message=exc.message
         )
     )
@@ -0,0 +1,15 @@
+'''This module manages the FastAPI response classes.'''
+
+from typing import Any
+from fastapi import responses
+
+from helpers.misc import JSONSerializer
+from helpers.profiling import Phase
+
+
+class ORJSONResponse(responses.ORJSONResponse):
+    '''JSON response serialized by orjson, the default response class of the application.'''
+
+    def render(self, content: Any) -> bytes:
+        with Phase('serialization'):
+            return JSONSerializer.dumps(content)
@@ -1,25 +1,267 @@
 '''This module manages the application throttling control.'''
 
-from fastapi import FastAPI
-from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.middleware import SlowAPIMiddleware
-from slowapi.errors import RateLimitExceeded
-from slowapi.util import get_remote_address
+import math
+import re
+import time
+from collections import Counter
+from fastapi import FastAPI, status
+from jose import JWTError
+from starlette.routing import BaseRoute
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+import orjson
+
+from config import Settings, ThrottlingConfig, get_settings, subscribe_settings
+from helpers.api_responses import ORJSONResponse
+from helpers.metrics import throttling_rejections
+from helpers.throttling_storage import MemoryStorage, RedisStorage, SharedMemoryStorage
+from security.tokens import JSONWebToken
+
+
+PERIODS = dict(second=1, minute=60, hour=3600, day=86400)
+MAX_USER_BODY = 16 * 1024  # bytes of a request body read to find its user email, larger requests are counted per IP address
+
+
+class Rule:
+    '''Rate limit rule, e.g. 100/minute. The burst defaults to the rate, so that the whole budget of a period can be spent at once.'''
+
+    def __init__(self, limit: str, burst: int | None = None):
+        rate, period = limit.split('/')
+        self.limit = limit
+        self.interval = PERIODS[period.strip()] / int(rate)
+        self.capacity = burst or int(rate)
+
+
+class Policy:
+    '''Throttling policy: rate limit rules counted per client key, which is one of the following:
+    ip (client IP address) | admin (authenticated admin username) | user (user email of the request body).
+    Requests without admin token or user email are counted per IP address. The requests of user policies are also counted
+    against the default limits per IP address, since their email is not authenticated.'''
+
+    KEYS = ['ip', 'admin', 'user']
+
+    def __init__(self, name: str, key: str, limits: list[str], burst: int | None = None):
+        if key not in self.KEYS:
+            raise ValueError(f'Throttling policy {name} key must be one of the following: {" | ".join(self.KEYS)}')
+        self.name = name
+        self.key = key
+        self.rules = [Rule(x, burst=burst) for x in limits]
+
+    @staticmethod
+    def from_settings(throttling: ThrottlingConfig) -> tuple[list['Policy'], 'Policy']:
+        '''Create the route policies and the default policy from the THROTTLING settings.'''
+        policies = [Policy(name=x.ROUTE, key=x.KEY, limits=x.LIMITS, burst=x.BURST) for x in throttling.POLICIES]
+        return policies, Policy(name='default', key='ip', limits=throttling.LIMITS, burst=throttling.BURST)
+
+
+class PolicyTable:
+    '''Route to throttling policy table, compiled once from the application routes so that lookups cost the same whatever the number of policies.
+    Policies are declared per route path prefix, the longest prefix wins.'''
+
+    def __init__(self, routes: list[BaseRoute], policies: list[Policy], default: Policy):
+        self.default = default
+        self.static: dict[str, Policy] = {}
+        self.dynamic: list[tuple[re.Pattern, Policy]] = []
+
+        prefixes = sorted(policies, key=lambda x: len(x.name), reverse=True)
+        for route in routes:
+            path = getattr(route, 'path', None)
+            if path is None:
+                continue
+            policy = next((x for x in prefixes if path == x.name or path.startswith(x.name.rstrip('/') + '/')), default)
+            if getattr(route, 'param_convertors', None):
+                self.dynamic.append((route.path_regex, policy))
+            else:
+                self.static[path] = policy
+
+    def get(self, path: str) -> Policy:
+        '''Get the policy of a request path.'''
+        policy = self.static.get(path)
+        if policy is not None:
+            return policy
+        for regex, policy in self.dynamic:
+            if regex.match(path):
+                return policy
+        return self.default
+
+
+class LocalLease:
+    '''Requests reserved from the shared storage, served locally until they are used or expire.'''
+
+    def __init__(self, remaining: int, expires_at: float):
+        self.remaining = remaining
+        self.expires_at = expires_at
+
+
+class RateLimiter:
+    '''Rate limiter enforcing rules per key in a storage backend.
+    With a batch size above 1, requests are reserved from the storage in batches and served from a local lease, so that most requests
+    skip the storage round trip. Reserved requests count against the limit, so it is never exceeded across workers.'''
+
+    MAX_LEASES = 100_000
+
+    def __init__(self, storage: MemoryStorage | RedisStorage | SharedMemoryStorage, batch: int = 1):
+        self.storage = storage
+        self.batch = batch
+        self.leases: dict[str, LocalLease] = {}
+        self.rejections = Counter()
+
+    async def acquire(self, key: str, rule: Rule) -> tuple[bool, float]:
+        '''Acquire 1 request of a rule, from the local lease if possible.'''
+        if self.batch <= 1:
+            return await self.storage.acquire(f'{key}:{rule.limit}', rule.interval, rule.capacity)
+
+        lease_key, now = f'{key}:{rule.limit}', time.monotonic()
+        lease = self.leases.get(lease_key)
+        if lease and lease.remaining > 0 and lease.expires_at > now:
+            lease.remaining -= 1
+            return True, 0.0
+
+        batch = min(self.batch, rule.capacity)
+        allowed, _ = await self.storage.acquire(lease_key, rule.interval, rule.capacity, cost=batch)
+        if allowed:
+            if len(self.leases) >= self.MAX_LEASES:
+                self.leases = {k: v for k, v in self.leases.items() if v.expires_at > now}
+            self.leases[lease_key] = LocalLease(remaining=batch - 1, expires_at=now + batch * rule.interval)
+            return True, 0.0
+
+        self.leases.pop(lease_key, None)
+        return await self.storage.acquire(lease_key, rule.interval, rule.capacity)
+
+    async def hit(self, key: str, policy: Policy) -> tuple[bool, float]:
+        '''Count a request against every rule of a policy, returning whether it is allowed and the seconds to wait before retrying.'''
+        for rule in policy.rules:
+            allowed, retry_after = await self.acquire(f'{policy.name}:{key}', rule)
+            if not allowed:
+                self.rejections[policy.name] += 1
+                return False, retry_after
+        return True, 0.0
+
+    async def close(self) -> None:
+        '''Release the storage resources.'''
+        await self.storage.close()
+
+
+def admin_key(scope: Scope) -> str | None:
+    '''Get the admin username of the request bearer token.'''
+    for name, value in scope['headers']:
+        if name == b'authorization' and value[:7].lower() == b'bearer ':
+            try:
+                username = JSONWebToken.decode(value[7:].decode('latin-1')).get('username')
+            except JWTError:
+                return None
+            return f'admin:{username}' if username else None
+    return None
+
+
+async def user_key(receive: Receive, max_bytes: int = MAX_USER_BODY) -> tuple[str | None, Receive]:
+    '''Get the user email of the request JSON body, and a receive channel that replays the body to the application.
+    At most max_bytes of the body are read: there is no user email if it is larger.'''
+    messages: list[Message] = []
+
+    async def replay() -> Message:
+        return messages.pop(0) if messages else await receive()
+
+    size = 0
+    while True:
+        message = await receive()
+        messages.append(message)
+        size += len(message.get('body', b''))
+        if size > max_bytes:
+            return None, replay
+        if message['type'] != 'http.request' or not message.get('more_body'):
+            break
+
+    try:
+        email = orjson.loads(b''.join(x.get('body', b'') for x in messages)).get('email')
+    except (AttributeError, orjson.JSONDecodeError):
+        email = None
+    return (f'user:{str(email).lower()}' if email else None), replay
+
+
+class ThrottlingMiddleware:
+    '''ASGI middleware rejecting the HTTP requests over the rate limits of their route policy.
+    Policies follow the THROTTLING settings, the route to policy table is compiled again on the first request after a reload.'''
+
+    def __init__(self, app: ASGIApp, limiter: RateLimiter):
+        self.app = app
+        self.limiter = limiter
+        self.policies, self.default = Policy.from_settings(get_settings().THROTTLING)
+        self.table: PolicyTable | None = None
+        subscribe_settings(self.reconfigure)
+
+    async def reconfigure(self, old: Settings, new: Settings) -> None:
+        '''Apply the THROTTLING settings, the counters of a policy are kept while its route prefix is unchanged.'''
+        if new.THROTTLING == old.THROTTLING:
+            return
+        self.policies, self.default = Policy.from_settings(new.THROTTLING)
+        self.table = None
+        self.limiter.batch = new.THROTTLING.BATCH
+        storage = ['STORAGE', 'SHM_PATH', 'REDIS_URL']
+        if any(getattr(old.THROTTLING, x) != getattr(new.THROTTLING, x) for x in storage):
+            previous, self.limiter.storage = self.limiter.storage, Throttling.storage(new)
+            self.limiter.leases.clear()
+            await previous.close()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        if self.table is None:
+            self.table = PolicyTable(routes=scope['app'].routes, policies=self.policies, default=self.default)
+        policy = self.table.get(scope['path'])
+        client = scope.get('client')
+        ip_key = f'ip:{client[0] if client else "127.0.0.1"}'
+
+        key = None
+        if policy.key == 'admin':
+            key = admin_key(scope)
+        elif policy.key == 'user':
+            # before the body is read, so that clients sending other emails on each request are still limited
+            allowed, retry_after = await self.limiter.hit(ip_key, self.default)
+            if not allowed:
+                await self.reject(scope, receive, send, self.default, retry_after)
+                return
+            key, receive = await user_key(receive)
+
+        allowed, retry_after = await self.limiter.hit(key or ip_key, policy)
+        if allowed:
+            await self.app(scope, receive, send)
+            return
+        await self.reject(scope, receive, send, policy, retry_after)
+
+    async def reject(self, scope: Scope, receive: Receive, send: Send, policy: Policy, retry_after: float) -> None:
+        '''Respond to a request over the limits of a policy.'''
+        throttling_rejections.inc((policy.name,))
+        response = ORJSONResponse(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            content=dict(error=True, message='Rate limit exceeded.'),
+            headers={'Retry-After': str(math.ceil(retry_after))}
+        )
+        await response(scope, receive, send)
 
 
 class Throttling:
     '''Throttling limiter class.'''
 
+    def storage(settings):
+        '''Create the configured storage backend.'''
+        if settings.THROTTLING.STORAGE == 'redis':
+            return RedisStorage.from_url(settings.THROTTLING.REDIS_URL)
+        if settings.THROTTLING.STORAGE == 'shm':
+            return SharedMemoryStorage(path=settings.THROTTLING.SHM_PATH)
+        return MemoryStorage()
+
     def enable(app: FastAPI):
-        '''Enable a limiter to control the amount of requests per minute based on IP address.'''
-        limiter = Limiter(key_func=get_remote_address, default_limits=['100/minute', '2/second'])
+        '''Enable a limiter to control the amount of requests per period based on route policies, IP address by default.'''
+        settings = get_settings()
+        limiter = RateLimiter(storage=Throttling.storage(settings), batch=settings.THROTTLING.BATCH)
         app.state.limiter = limiter
-        app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
-        app.add_middleware(SlowAPIMiddleware)
+        app.add_middleware(ThrottlingMiddleware, limiter=limiter)
+        app.add_event_handler('shutdown', limiter.close)
         return app
 
     def disable(app: FastAPI):
         '''Disable throttling limiter.'''
-        limiter = Limiter(key_func=get_remote_address, enabled=False)
-        app.state.limiter = limiter
+        app.state.limiter = None
         return app
@@ -0,0 +1,174 @@
+'''This module holds tables in memory as columns: 1 typed NumPy array per column instead of 1 object per row.
+Low-cardinality strings are dictionary-encoded (each distinct value is stored once, rows hold its integer code),
+changed rows are overwritten in place and new rows appended, so that a table is refreshed without being rebuilt.'''
+
+import sys
+from datetime import datetime, timezone
+import numpy as np
+
+
+DTYPES = dict(
+    int=np.dtype(np.int64),
+    float=np.dtype(np.float64),
+    bool=np.dtype(np.bool_),
+    category=np.dtype(np.int32),  # codes of a dictionary-encoded column
+    datetime=np.dtype('datetime64[us]'),  # UTC
+    str=np.dtype(object)
+)
+MIN_CAPACITY = 1024  # rows, arrays grow by doubling
+
+
+class Dictionary:
+    '''Distinct values of a dictionary-encoded column, numbered in order of appearance.'''
+
+    def __init__(self):
+        self.values: list = []
+        self.codes: dict = {}
+
+    def encode(self, values: list) -> np.ndarray:
+        '''Codes of values, new values are added to the dictionary.'''
+        for value in dict.fromkeys(values):
+            if value not in self.codes:
+                self.codes[value] = len(self.values)
+                self.values.append(value)
+        return np.fromiter((self.codes[x] for x in values), dtype=np.int32, count=len(values))
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        '''Values of codes.'''
+        return np.array(self.values, dtype=object)[codes] if len(codes) else np.empty(0, dtype=object)
+
+    def nbytes(self) -> int:
+        '''Approximate memory footprint in bytes.'''
+        return sys.getsizeof(self.values) + sys.getsizeof(self.codes) + sum(sys.getsizeof(x) for x in self.values)
+
+
+def encode_datetimes(values: list) -> np.ndarray:
+    '''Convert timezone-aware datetimes to UTC datetime64 through their timestamps, None as NaT.'''
+    seconds = np.array([np.nan if x is None else x.timestamp() for x in values], dtype=np.float64)
+    array = np.round(np.nan_to_num(seconds) * 1e6).astype(np.int64).view(DTYPES['datetime'])
+    array[np.isnan(seconds)] = np.datetime64('NaT')
+    return array
+
+
+def decode_datetimes(values: np.ndarray) -> list:
+    '''Convert UTC datetime64 to timezone-aware datetimes, NaT as None.'''
+    return [None if x is None else x.replace(tzinfo=timezone.utc) for x in values.astype(datetime).tolist()]
+
+
+class ColumnarTable:
+    '''
+    In-memory table stored column by column, rows are numbered in insertion order.
+
+        :param columns [dict]: Column kinds keyed by column name, it must be one of the following: int | float | bool | category | datetime | str
+        :param primary [str]: Primary key column name, rows are upserted by it.
+        :param unique [tuple[str]]: Other unique column names, rows can be looked up by them.
+    '''
+
+    def __init__(self, columns: dict[str, str], primary: str = 'id', unique: tuple[str, ...] = ()):
+        self.kinds = dict(columns)
+        self.primary = primary
+        self.length = 0
+        self.arrays = {name: np.empty(0, dtype=DTYPES[kind]) for name, kind in self.kinds.items()}
+        self.dictionaries = {name: Dictionary() for name, kind in self.kinds.items() if kind == 'category'}
+        self.indexes: dict[str, dict] = {name: {} for name in (primary, *unique)}
+
+    def __len__(self) -> int:
+        return self.length
+
+    def reserve(self, length: int) -> None:
+        '''Grow the arrays to hold a number of rows, doubling their capacity.'''
+        capacity = len(self.arrays[self.primary])
+        if length <= capacity:
+            return
+        capacity = max(capacity * 2, length, MIN_CAPACITY)
+        for name, array in self.arrays.items():
+            grown = np.empty(capacity, dtype=array.dtype)
+            grown[:self.length] = array[:self.length]
+            self.arrays[name] = grown
+
+    def encode(self, name: str, values: list) -> np.ndarray:
+        '''Convert the values of a column to its array type.'''
+        kind = self.kinds[name]
+        if kind == 'category':
+            return self.dictionaries[name].encode(values)
+        if kind == 'datetime':
+            return encode_datetimes(values)
+        array = np.empty(len(values), dtype=DTYPES[kind])
+        array[:] = values
+        return array
+
+    def upsert(self, columns: dict[str, list]) -> tuple[int, int]:
+        '''
+        Overwrite the rows whose primary key exists, append the others.
+
+            :param columns [dict]: Lists of values keyed by column name (every column of the table), 1 row per primary key.
+
+            :returns [tuple]: Number of updated and inserted rows.
+        '''
+        positions = self.indexes[self.primary]
+        keys = columns[self.primary]
+        rows = np.fromiter((positions.get(x, -1) for x in keys), dtype=np.int64, count=len(keys))
+        new = rows < 0
+        inserted = int(new.sum())
+        self.reserve(self.length + inserted)
+        rows[new] = np.arange(self.length, self.length + inserted)
+
+        # unique values of the updated rows may change, their previous values are unindexed first
+        updated = rows[~new]
+        for name in [x for x in self.indexes if x != self.primary]:
+            index = self.indexes[name]
+            for value, row in zip(self.arrays[name][updated].tolist(), updated.tolist()):
+                if index.get(value) == row:
+                    del index[value]
+
+        for name in self.kinds:
+            self.arrays[name][rows] = self.encode(name, columns[name])
+        self.length += inserted
+        for name, index in self.indexes.items():
+            index.update(zip(columns[name], rows.tolist()))
+        return len(updated), inserted
+
+    def column(self, name: str) -> np.ndarray:
+        '''Array of a column (codes of a dictionary-encoded column), a view that must not be modified.'''
+        return self.arrays[name][:self.length]
+
+    def values(self, name: str, rows: np.ndarray) -> list:
+        '''Values of a column at row numbers, decoded.'''
+        array = self.arrays[name][rows]
+        if name in self.dictionaries:
+            return self.dictionaries[name].decode(array).tolist()
+        if self.kinds[name] == 'datetime':
+            return decode_datetimes(array)
+        return array.tolist()
+
+    def find(self, name: str, value) -> int | None:
+        '''Row number of a primary key or unique value.'''
+        return self.indexes[name].get(value)
+
+    def filter(self, conditions: dict) -> np.ndarray:
+        '''Row numbers of the rows whose columns equal the condition values, dictionary-encoded columns are compared by code.'''
+        mask = np.ones(self.length, dtype=bool)
+        for name, value in conditions.items():
+            if name in self.dictionaries:
+                value = self.dictionaries[name].codes.get(value)
+                if value is None:
+                    return np.zeros(0, dtype=np.intp)
+            mask &= self.column(name) == value
+        return np.flatnonzero(mask)
+
+    def rows(self, rows: np.ndarray, columns: list[str] | None = None) -> list[dict]:
+        '''Rows as dictionaries, in the order of their row numbers.'''
+        columns = columns or list(self.kinds)
+        return [dict(zip(columns, x)) for x in zip(*[self.values(name, rows) for name in columns])]
+
+    def nbytes(self) -> dict[str, int]:
+        '''Approximate memory footprint in bytes of each column (its allocated capacity and dictionary) and of the lookup indexes.'''
+        sizes = {}
+        for name, array in self.arrays.items():
+            sizes[name] = array.nbytes
+            if array.dtype == object:
+                sizes[name] += sum(sys.getsizeof(x) for x in array[:self.length].tolist())
+            if name in self.dictionaries:
+                sizes[name] += self.dictionaries[name].nbytes()
+        sizes['indexes'] = sum(sys.getsizeof(x) for x in self.indexes.values())
+        return sizes
@@ -0,0 +1,112 @@
+'''This module streams exports of database rows as CSV or NDJSON: rows are fetched batch by batch and each batch is sent as 1 chunk,
+so that memory does not depend on the export size and the first rows are sent before the query has finished.
+Exported CSV values (ISO 8601 datetimes, true/false booleans) can be ingested back as they are.'''
+
+import csv
+import io
+from datetime import date, datetime
+from enum import Enum
+from typing import Any, AsyncIterator, Callable
+from fastapi import status
+from fastapi.responses import StreamingResponse
+
+from helpers.api_exceptions import ResponseValidationError
+from helpers.misc import JSONSerializer
+
+
+MEDIA_TYPES = dict(csv='text/csv', ndjson='application/x-ndjson')  # text types get a UTF-8 charset
+
+
+def select_columns(available: list[str], requested: list[str]) -> list[str]:
+    '''Select the exported columns, all the available ones by default, raises a 400 error if some of them are not available.'''
+    unknown = [x for x in requested if x not in available]
+    if unknown:
+        raise ResponseValidationError(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            message=f'Unknown columns: {", ".join(unknown)}, they must be any of the following: {" | ".join(available)}.'
+        )
+    return list(dict.fromkeys(requested)) or list(available)
+
+
+def csv_formatter(value: Any) -> Callable[[Any], Any] | None:
+    '''Formatter of the CSV fields of a column from 1 of its values, None if they are written as they are.'''
+    if isinstance(value, bool):
+        return lambda x: 'true' if x else 'false'
+    if isinstance(value, (datetime, date)):
+        return lambda x: x.isoformat()
+    if isinstance(value, Enum):
+        return lambda x: x.value
+    return None
+
+
+def csv_formatters(rows: list, detected: dict[int, Callable[[Any], Any] | None]) -> list[tuple[int, Callable[[Any], Any]]]:
+    '''Formatters of the columns that need one, each one detected from the first value of its column that is not null.
+    The columns whose values have all been null so far are detected again from the next batch of rows.'''
+    for index in [x for x in range(len(rows[0]) if rows else 0) if x not in detected]:
+        value = next((row[index] for row in rows if row[index] is not None), None)
+        if value is not None:
+            detected[index] = csv_formatter(value)
+    return [(index, formatter) for index, formatter in detected.items() if formatter]
+
+
+def csv_row(row: Any, formatters: list[tuple[int, Callable[[Any], Any]]]) -> list:
+    '''Format the values of a row that need it.'''
+    values = list(row)
+    for index, formatter in formatters:
+        if values[index] is not None:
+            values[index] = formatter(values[index])
+    return values
+
+
+async def csv_chunks(columns: list[str], batches: AsyncIterator[list]) -> AsyncIterator[bytes]:
+    '''Format batches of rows as CSV chunks, the first one starts with the header.'''
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(columns)
+    detected, formatters = {}, []
+    async for rows in batches:
+        if len(detected) < len(columns):
+            formatters = csv_formatters(rows, detected)
+        writer.writerows([csv_row(row, formatters) for row in rows] if formatters else rows)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')  # header only, no rows
+
+
+async def ndjson_chunks(columns: list[str], batches: AsyncIterator[list]) -> AsyncIterator[bytes]:
+    '''Format batches of rows as NDJSON chunks, 1 JSON object per line.'''
+    async for rows in batches:
+        yield b''.join(JSONSerializer.dumps(dict(zip(columns, row))) + b'\n' for row in rows)
+
+
+async def prepend(first: list, batches: AsyncIterator[list]) -> AsyncIterator[list]:
+    '''Yield a batch already fetched, then the next batches.'''
+    yield first
+    async for rows in batches:
+        yield rows
+
+
+async def export_response(columns: list[str], batches: AsyncIterator[list], export_format: str, filename: str) -> StreamingResponse:
+    '''
+    Stream batches of rows as a CSV or NDJSON attachment.
+
+        :param columns [list[str]]: Column names, in the order of the row values.
+        :param batches [AsyncIterator]: Batches of rows, e.g. fetched through a server-side cursor.
+        :param export_format [str]: Export format, it must be one of the following: csv | ndjson.
+        :param filename [str]: Attachment file name, without extension.
+
+        :returns [StreamingResponse]: Streaming response, sent once the first batch has been fetched so that query errors are still reported as errors.
+    '''
+    batches = aiter(batches)
+    first = await anext(batches, None)
+    if first is not None:
+        batches = prepend(first, batches)
+
+    chunks = csv_chunks if export_format == 'csv' else ndjson_chunks
+    return StreamingResponse(
+        chunks(columns, batches),
+        media_type=MEDIA_TYPES[export_format],
+        headers={'Content-Disposition': f'attachment; filename="{filename}.{export_format}"'}
+    )
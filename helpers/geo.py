@@ -0,0 +1,117 @@
+'''This module indexes coordinates on a fixed latitude/longitude grid, and answers bounding-box, radius and k-nearest queries.
+Each point belongs to a grid cell whose number is stored and indexed with it: candidates are pruned by cell ranges,
+then filtered and ranked with vectorised great-circle distances, so that a query only reads the cells it overlaps.'''
+
+import math
+from typing import Awaitable, Callable
+import numpy as np
+
+
+CELLS_PER_DEGREE = 10  # cells of 0.1 degree, about 11 km at the equator
+CELL_COLUMNS = 360 * CELLS_PER_DEGREE + 1  # longitudes 180 and -180 have their own column
+MAX_RANGES = 256  # cell ranges per query, larger areas are pruned by 1 coarser range
+EARTH_RADIUS_KM = 6371.0088
+MAX_DISTANCE_KM = math.pi * EARTH_RADIUS_KM  # half the circumference, any point is closer
+
+BBox = tuple[float, float, float, float]  # min latitude, min longitude, max latitude, max longitude (min > max longitude crosses 180)
+Candidates = tuple[np.ndarray, np.ndarray, np.ndarray]  # keys, latitudes, longitudes
+
+
+def cell_expression(latitude: str, longitude: str) -> str:
+    '''SQL expression of the cell of a point, it must compute exactly as cell.'''
+    return f'(floor(("{latitude}" + 90) * {CELLS_PER_DEGREE}) * {CELL_COLUMNS} + floor(("{longitude}" + 180) * {CELLS_PER_DEGREE}))::bigint'
+
+
+def cell(latitude: float, longitude: float) -> int:
+    '''Cell of a point.'''
+    return math.floor((latitude + 90) * CELLS_PER_DEGREE) * CELL_COLUMNS + math.floor((longitude + 180) * CELLS_PER_DEGREE)
+
+
+def cell_ranges(bbox: BBox) -> list[tuple[int, int]]:
+    '''Ranges of the cells that overlap a bounding box, adjacent ranges merged. Cells are numbered row by row (latitude first).'''
+    min_lat, min_lon, max_lat, max_lon = bbox
+    first_row, last_row = math.floor((min_lat + 90) * CELLS_PER_DEGREE), math.floor((max_lat + 90) * CELLS_PER_DEGREE)
+    first_col, last_col = math.floor((min_lon + 180) * CELLS_PER_DEGREE), math.floor((max_lon + 180) * CELLS_PER_DEGREE)
+    columns = [(first_col, last_col)] if min_lon <= max_lon else [(0, last_col), (first_col, CELL_COLUMNS - 1)]
+
+    ranges = []
+    for row in range(first_row, last_row + 1):
+        for start, end in columns:
+            start, end = row * CELL_COLUMNS + start, row * CELL_COLUMNS + end
+            if ranges and ranges[-1][1] + 1 >= start:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+    if len(ranges) > MAX_RANGES:
+        return [(ranges[0][0], ranges[-1][1])]
+    return ranges
+
+
+def radius_bbox(latitude: float, longitude: float, radius: float) -> BBox:
+    '''Bounding box of the points within a distance of a point.'''
+    dlat = math.degrees(radius / EARTH_RADIUS_KM)
+    min_lat, max_lat = max(latitude - dlat, -90.0), min(latitude + dlat, 90.0)
+    if min_lat <= -90 or max_lat >= 90 or radius >= MAX_DISTANCE_KM / 2:
+        return min_lat, -180.0, max_lat, 180.0  # the circle covers a pole or a hemisphere, every longitude
+
+    dlon = math.degrees(math.asin(min(math.sin(radius / EARTH_RADIUS_KM) / math.cos(math.radians(latitude)), 1.0)))
+    if dlon >= 180:
+        return min_lat, -180.0, max_lat, 180.0
+    min_lon, max_lon = longitude - dlon, longitude + dlon
+    if min_lon < -180:
+        min_lon += 360
+    if max_lon > 180:
+        max_lon -= 360
+    return min_lat, min_lon, max_lat, max_lon
+
+
+def haversine(latitude: float, longitude: float, latitudes: np.ndarray, longitudes: np.ndarray) -> np.ndarray:
+    '''Great-circle distances in km from a point to arrays of points.'''
+    lat1, lat2 = math.radians(latitude), np.radians(latitudes)
+    dlat, dlon = lat2 - lat1, np.radians(longitudes) - math.radians(longitude)
+    chord = np.sin(dlat / 2) ** 2 + math.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(chord, 0.0, 1.0)))
+
+
+async def within_radius(
+    fetch: Callable[[BBox], Awaitable[Candidates]],
+    latitude: float,
+    longitude: float,
+    radius: float,
+    limit: int | None = None
+) -> list[tuple]:
+    '''
+    Find the points within a distance of a point, closest first.
+
+        :param fetch [function]: Coroutine function that returns the keys, latitudes and longitudes of the points within a bounding box.
+        :param latitude [float]: Point latitude.
+        :param longitude [float]: Point longitude.
+        :param radius [float]: Distance in km.
+        :param limit [int]: Maximum number of points.
+
+        :returns [list[tuple]]: Keys and distances of the points.
+    '''
+    keys, latitudes, longitudes = await fetch(radius_bbox(latitude, longitude, radius))
+    distances = haversine(latitude, longitude, latitudes, longitudes)
+    within = np.flatnonzero(distances <= radius)
+    order = within[np.argsort(distances[within], kind='stable')][:limit]
+    return list(zip(keys[order].tolist(), distances[order].tolist()))
+
+
+async def nearest(fetch: Callable[[BBox], Awaitable[Candidates]], latitude: float, longitude: float, k: int) -> list[tuple]:
+    '''
+    Find the k nearest points of a point, closest first. The search radius starts at 1 cell and doubles until k points are within it.
+
+        :param fetch [function]: Coroutine function that returns the keys, latitudes and longitudes of the points within a bounding box.
+        :param latitude [float]: Point latitude.
+        :param longitude [float]: Point longitude.
+        :param k [int]: Number of points.
+
+        :returns [list[tuple]]: Keys and distances of the points.
+    '''
+    radius = 2 * math.pi * EARTH_RADIUS_KM / 360 / CELLS_PER_DEGREE
+    while True:
+        found = await within_radius(fetch, latitude, longitude, radius, limit=k)
+        if len(found) >= k or radius >= MAX_DISTANCE_KM:
+            return found
+        radius = min(radius * 2, MAX_DISTANCE_KM)
@@ -1,79 +1,358 @@
-'''This module does HTTP requests settings and error handling.'''
+'''This module does HTTP requests settings and error handling.
+Outbound requests share a keep-alive connection pool per upstream host, each call has a deadline (retries included),
+and retries wait a jittered exponential backoff without blocking the event loop.
+Calls to a degraded upstream fail fast once its circuit breaker opens, and identical concurrent calls can be coalesced into one.'''
 
+import asyncio
+import random
+import time
+from collections import deque
+from collections.abc import Mapping
 from functools import wraps
-import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util import Retry
+from inspect import signature
+from typing import Any, Hashable
+import httpx
 from fastapi import status
 
 from helpers.api_exceptions import ResponseValidationError
+from helpers.lru_caching import SingleFlight
 
 
-DEFAULT_TIMEOUT = 5  # seconds
-DEFAULT_RETRIES = Retry(
-    total=3,
-    backoff_factor=1,
-    status_forcelist=[429, 500, 502, 503, 504],
-    method_whitelist=['GET', 'PUT', 'POST', 'DELETE', 'OPTIONS']
-)
+DEFAULT_TIMEOUT = 5  # seconds, deadline of a call including its retries
 
 
-class TimeoutHTTPAdapter(HTTPAdapter):
-    '''Set up HTTP requests timeouts and retries.'''
+class RetryError(httpx.HTTPError):
+    '''Raised when an upstream keeps answering with a retryable status code.'''
 
-    def __init__(self, *args, **kwargs):
-        self.timeout = DEFAULT_TIMEOUT
-        self.max_retries = DEFAULT_RETRIES
 
-        if 'timeout' in kwargs:
-            self.timeout = kwargs['timeout']
-            del kwargs['timeout']
+class CircuitOpenError(httpx.HTTPError):
+    '''Raised instead of calling an upstream whose circuit breaker is open.'''
 
-        if 'max_retries' in kwargs:
-            self.max_retries = kwargs['max_retries']
-            del kwargs['max_retries']
 
-        super().__init__(*args, **kwargs)
+class Retry:
+    '''Retry policy: retryable status codes and methods, and full-jitter exponential backoff.'''
 
-    def send(self, request, **kwargs):
-        timeout = kwargs.get('timeout')
+    def __init__(
+        self,
+        total: int = 3,
+        backoff_factor: float = 1,
+        backoff_max: float = 30,
+        status_forcelist: tuple[int, ...] = (429, 500, 502, 503, 504),
+        allowed_methods: tuple[str, ...] = ('GET', 'PUT', 'POST', 'DELETE', 'OPTIONS')
+    ):
+        self.total = total
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.status_forcelist = status_forcelist
+        self.allowed_methods = allowed_methods
 
-        if timeout is None:
-            kwargs['timeout'] = self.timeout
+    def backoff(self, attempt: int, response: httpx.Response | None = None) -> float:
+        '''Seconds to wait before a retry: the Retry-After header of the response if any, else a random delay up to the exponential backoff.'''
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+        return random.uniform(0, min(self.backoff_max, self.backoff_factor * 2 ** attempt))
 
-        return super().send(request, **kwargs)
+
+DEFAULT_RETRIES = Retry()
+DEFAULT_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=30)
+
+
+class HTTPClient:
+    '''Asynchronous HTTP client with a keep-alive connection pool per upstream host.'''
+
+    def __init__(self, timeout: float = DEFAULT_TIMEOUT, retries: Retry = DEFAULT_RETRIES, limits: httpx.Limits = DEFAULT_LIMITS):
+        self.timeout = timeout
+        self.retries = retries
+        self.limits = limits
+        self.clients: dict[tuple[bytes, bytes, int | None], httpx.AsyncClient] = {}
+
+    def client(self, url: str) -> httpx.AsyncClient:
+        '''Get the client of the upstream host of a URL.'''
+        origin = httpx.URL(url)
+        key = (origin.raw_scheme, origin.raw_host, origin.port)
+        if key not in self.clients:
+            self.clients[key] = httpx.AsyncClient(limits=self.limits)
+        return self.clients[key]
+
+    async def request(self, method: str, url: str, timeout: float | None = None, retries: Retry | None = None, **kwargs: Any) -> httpx.Response:
+        '''
+        Send an HTTP request, retrying transport errors and retryable status codes until the deadline.
+
+            :param method [str]: HTTP method.
+            :param url [str]: Request URL.
+            :param timeout [float]: Deadline of the call in seconds, retries included.
+            :param retries [Retry]: Retry policy.
+            :param kwargs [dict]: Request arguments, e.g. params, headers, json.
+
+            :returns [Response]: HTTP response.
+        '''
+        method, retries = method.upper(), retries or self.retries
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (timeout or self.timeout)
+        client = self.client(url)
+
+        for attempt in range(retries.total + 1):
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            retryable = method in retries.allowed_methods and attempt < retries.total
+            try:
+                response = await client.request(method, url, timeout=remaining, **kwargs)
+            except httpx.TransportError:
+                if not retryable:
+                    raise
+                response = None
+            else:
+                if not (method in retries.allowed_methods and response.status_code in retries.status_forcelist):
+                    return response
+                await response.aclose()
+                if not retryable:
+                    raise RetryError(f'Max retries exceeded with url: {url} (too many {response.status_code} error responses)')
+
+            delay = retries.backoff(attempt, response)
+            if delay >= deadline - loop.time():
+                break
+            await asyncio.sleep(delay)
+
+        raise httpx.TimeoutException(f'Deadline of {timeout or self.timeout}s exceeded with url: {url}', request=httpx.Request(method, url))
+
+    async def get(self, url: str, **kwargs: Any) -> httpx.Response:
+        '''Send a GET request.'''
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url: str, **kwargs: Any) -> httpx.Response:
+        '''Send a POST request.'''
+        return await self.request('POST', url, **kwargs)
+
+    async def put(self, url: str, **kwargs: Any) -> httpx.Response:
+        '''Send a PUT request.'''
+        return await self.request('PUT', url, **kwargs)
+
+    async def delete(self, url: str, **kwargs: Any) -> httpx.Response:
+        '''Send a DELETE request.'''
+        return await self.request('DELETE', url, **kwargs)
+
+    async def close(self) -> None:
+        '''Close the connection pools.'''
+        clients, self.clients = self.clients, {}
+        for client in clients.values():
+            await client.aclose()
+
+
+http_client = HTTPClient()
+
+
+class CircuitBreaker:
+    '''Circuit breaker of an upstream, over a rolling window of its last calls.
+    closed: calls go through, it opens once the error rate or the slow call rate of the window reaches its threshold (after min_calls calls).
+    open: calls fail fast with CircuitOpenError, until reset_timeout seconds have elapsed.
+    half-open: 1 trial call goes through at a time, it closes after HALF_OPEN_CALLS successful fast calls and opens again on any failure.
+    Only the trial calls of the current half-open phase count there: the calls that were let through before are not trials.'''
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+    HALF_OPEN_CALLS = 3
+
+    def __init__(
+        self,
+        name: str,
+        window: int = 20,
+        min_calls: int = 10,
+        error_rate: float = 0.5,
+        latency: float = 2,
+        slow_rate: float = 0.5,
+        reset_timeout: float = 30
+    ):
+        self.name = name
+        self.thresholds = dict(min_calls=min_calls, error_rate=error_rate, latency=latency, slow_rate=slow_rate, reset_timeout=reset_timeout)
+        self.calls: deque[tuple[bool, bool]] = deque(maxlen=window)  # failed, slow
+        self.state = self.CLOSED
+        self.opened_at = 0.0
+        self.phase = 0  # number of half-open phases, trial calls are tagged with theirs
+        self.trials = 0
+        self.stats = dict(successes=0, failures=0, rejections=0, opened=0)
+
+    def settings(self) -> dict:
+        '''Thresholds of the circuit breaker, as passed to its constructor.'''
+        return dict(window=self.calls.maxlen, **self.thresholds)
+
+    def allow(self) -> int | None:
+        '''Check if a call can go through, reserving a trial call when half-open.
+        Returns None if it can not, the half-open phase of a trial call, and 0 for the other calls.'''
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.thresholds['reset_timeout']:
+                self.stats['rejections'] += 1
+                return None
+            self.state, self.phase, self.trials = self.HALF_OPEN, self.phase + 1, 0
+        if self.state == self.HALF_OPEN:
+            if self.trials > 0:
+                self.stats['rejections'] += 1
+                return None
+            self.trials += 1
+            return self.phase
+        return 0
+
+    def is_trial(self, trial: int) -> bool:
+        '''Check if a call is a trial call of the current half-open phase, see allow.'''
+        return self.state == self.HALF_OPEN and trial == self.phase
+
+    def release(self, trial: int = 0) -> None:
+        '''Release a call without outcome, e.g. cancelled.'''
+        if self.is_trial(trial):
+            self.trials -= 1
+
+    def record(self, failed: bool, duration: float, trial: int = 0) -> None:
+        '''Record the outcome of a call that went through, tagged by allow. Calls let through in another state or phase
+        than the current one are counted in the statistics only.'''
+        slow = duration >= self.thresholds['latency']
+        self.stats['failures' if failed else 'successes'] += 1
+        if self.is_trial(trial):
+            self.trials -= 1
+            if failed or slow:
+                self.open()
+                return
+            self.calls.append((False, False))
+            if sum(1 for x in self.calls if x == (False, False)) >= self.HALF_OPEN_CALLS:
+                self.close()
+            return
+        if trial or self.state != self.CLOSED:
+            return
+
+        self.calls.append((failed, slow))
+        if len(self.calls) >= self.thresholds['min_calls']:
+            error_rate, slow_rate = self.rates()
+            if error_rate >= self.thresholds['error_rate'] or slow_rate >= self.thresholds['slow_rate']:
+                self.open()
+
+    def rates(self) -> tuple[float, float]:
+        '''Error rate and slow call rate of the window.'''
+        if not self.calls:
+            return 0.0, 0.0
+        return sum(x[0] for x in self.calls) / len(self.calls), sum(x[1] for x in self.calls) / len(self.calls)
+
+    def open(self) -> None:
+        '''Stop calling the upstream.'''
+        self.state, self.opened_at, self.trials = self.OPEN, time.monotonic(), 0
+        self.calls.clear()
+        self.stats['opened'] += 1
+
+    def close(self) -> None:
+        '''Resume calling the upstream.'''
+        self.state, self.trials = self.CLOSED, 0
+        self.calls.clear()
+
+    def snapshot(self) -> dict:
+        '''Circuit breaker state and statistics.'''
+        error_rate, slow_rate = self.rates()
+        retry_in = self.opened_at + self.thresholds['reset_timeout'] - time.monotonic() if self.state == self.OPEN else 0.0
+        return dict(self.stats, state=self.state, calls=len(self.calls), error_rate=error_rate, slow_rate=slow_rate, retry_in=max(retry_in, 0.0))
+
+
+circuit_breakers: dict[str, CircuitBreaker] = {}
+coalescers: dict[str, SingleFlight] = {}
+
+
+def upstream_statistics() -> dict:
+    '''Circuit breakers state and coalescing statistics of the current worker process, per upstream.'''
+    return dict(
+        circuits={k: v.snapshot() for k, v in circuit_breakers.items()},
+        coalescing={k: dict(v.stats) for k, v in coalescers.items()}
+    )
+
+
+def is_failure(response: httpx.Response | None = None, error: BaseException | None = None) -> bool:
+    '''Check if an upstream call failed: server errors, transport errors, timeouts and exhausted retries.'''
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    if isinstance(error, httpx.HTTPError):
+        return True
+    return isinstance(response, httpx.Response) and response.status_code >= 500
+
+
+def circuit_breaker(upstream: str, **kwargs: Any):
+    '''
+    Decorator that protects the calls of an upstream with its circuit breaker, shared by every function decorated with the same upstream.
+
+        :param upstream [str]: Upstream name, e.g. its host.
+        :param kwargs [dict]: Circuit breaker thresholds, see CircuitBreaker.
+
+        :returns [function]: Decorator, apply it under error_handler so that CircuitOpenError is mapped to a response error.
+
+        :raises [ValueError]: If the circuit breaker of the upstream is already registered with other thresholds.
+    '''
+    settings = signature(CircuitBreaker).bind(name=upstream, **kwargs)
+    settings.apply_defaults()
+    settings = {k: v for k, v in settings.arguments.items() if k != 'name'}
+    breaker = circuit_breakers.get(upstream)
+    if breaker is None:
+        breaker = circuit_breakers[upstream] = CircuitBreaker(name=upstream, **settings)
+    elif breaker.settings() != settings:
+        raise ValueError(f'Circuit breaker of {upstream} is already registered with other thresholds: {breaker.settings()}')
+
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            trial = breaker.allow()
+            if trial is None:
+                raise CircuitOpenError(f'Circuit breaker of {upstream} is open.')
+            start = time.monotonic()
+            try:
+                result = await func(*args, **kwargs)
+            except httpx.HTTPError as e:
+                breaker.record(failed=is_failure(error=e), duration=time.monotonic() - start, trial=trial)
+                raise
+            except BaseException:
+                breaker.release(trial)
+                raise
+            breaker.record(failed=is_failure(response=result), duration=time.monotonic() - start, trial=trial)
+            return result
+        return wrapper
+    return decorator
+
+
+def freeze(value: Any) -> Hashable:
+    '''Hashable equivalent of a value, e.g. the params, headers or json arguments of a request: mappings, lists, tuples and sets
+    are frozen recursively, tagged by their kind so that e.g. a JSON object and a list of pairs do not share a key.'''
+    if isinstance(value, Mapping):
+        return Mapping, tuple(sorted(((k, freeze(v)) for k, v in value.items()), key=repr))
+    if isinstance(value, (list, tuple)):
+        return type(value), tuple(freeze(x) for x in value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset, frozenset(freeze(x) for x in value)
+    return value
+
+
+def coalesce(func):
+    '''Decorator that coalesces identical concurrent calls (same arguments) into one, e.g. GET requests whose response is then shared.
+    Apply it to idempotent calls only, over circuit_breaker so that coalesced calls count once.'''
+    flight = coalescers.setdefault(f'{func.__module__}.{func.__qualname__}', SingleFlight())
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await flight.call_async(freeze((args, kwargs)), lambda: func(*args, **kwargs))
+    return wrapper
+
+
+ERROR_STATUS_CODES = [  # the first matching exception class wins
+    (httpx.HTTPStatusError, status.HTTP_400_BAD_REQUEST),
+    (httpx.ConnectError, status.HTTP_404_NOT_FOUND),
+    (httpx.TimeoutException, status.HTTP_408_REQUEST_TIMEOUT),
+    (CircuitOpenError, status.HTTP_503_SERVICE_UNAVAILABLE),
+    (RetryError, status.HTTP_429_TOO_MANY_REQUESTS),
+    (httpx.HTTPError, status.HTTP_400_BAD_REQUEST)
+]
 
 
 def error_handler(func):
     '''Decorator that displays try/except errors from the HTTP requests.'''
 
     @wraps(func)
-    def wrapper(*args, **kwargs):  # pylint: disable=[R1710]
+    async def wrapper(*args, **kwargs):
         try:
-            return func(*args, **kwargs)
-        except requests.exceptions.HTTPError as e:
-            return ResponseValidationError(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                message=str(e)
-            )
-        except requests.exceptions.ConnectionError as e:
-            return ResponseValidationError(
-                status_code=status.HTTP_404_NOT_FOUND,
-                message=str(e)
-            )
-        except requests.exceptions.Timeout as e:
-            return ResponseValidationError(
-                status_code=status.HTTP_408_REQUEST_TIMEOUT,
-                message=str(e)
-            )
-        except requests.exceptions.RetryError as e:
-            return ResponseValidationError(
-                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-                message=str(e)
-            )
-        except requests.exceptions.RequestException as e:
+            return await func(*args, **kwargs)
+        except httpx.HTTPError as e:
             return ResponseValidationError(
-                status_code=status.HTTP_400_BAD_REQUEST,
+                status_code=next(code for error, code in ERROR_STATUS_CODES if isinstance(e, error)),
                 message=str(e)
             )
     return wrapper
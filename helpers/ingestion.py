@@ -0,0 +1,218 @@
+'''This module ingests streamed CSV and NDJSON uploads: rows are parsed chunk by chunk, validated column by column in vectorised batches,
+and written batch by batch, so that memory does not depend on the upload size. Invalid rows are skipped and reported.'''
+
+import codecs
+import csv
+import io
+import time
+from typing import AsyncIterator, Awaitable, Callable
+import numpy as np
+import orjson
+
+
+BATCH_SIZE = 5000  # rows validated and written at once
+MAX_ERRORS = 1000  # invalid rows reported, the next ones are only counted
+TRUE, FALSE = ('true', 't', '1', 'yes', 'y'), ('false', 'f', '0', 'no', 'n')
+
+
+class IngestionError(ValueError):
+    '''Raised when an upload cannot be ingested at all, e.g. a required column is missing.'''
+
+
+class Field:
+    '''Column of an upload: its kind (float | bool | str), whether it is required, and its range if it is a float.'''
+
+    def __init__(self, name: str, kind: str = 'str', required: bool = True, minimum: float | None = None, maximum: float | None = None):
+        self.name = name
+        self.kind = kind
+        self.required = required
+        self.minimum = minimum
+        self.maximum = maximum
+
+
+def split_records(text: str) -> tuple[str, str]:
+    '''Split CSV text after its last complete record, a line break within a quoted field does not end a record.'''
+    start, end, quotes = 0, 0, 0
+    while (newline := text.find('\n', start)) != -1:
+        quotes += text.count('"', start, newline)
+        start = newline + 1
+        if quotes % 2 == 0:
+            end = start
+    return text[:end], text[end:]
+
+
+def parse_header(row: list[str], required: list[str]) -> list[str]:
+    '''Parse the header of a CSV upload, ensuring it has the required columns.'''
+    header = [x.strip() for x in row]
+    missing = [x for x in required if x not in header]
+    if missing:
+        raise IngestionError(f'Missing columns: {", ".join(missing)}.')
+    return header
+
+
+async def csv_rows(stream: AsyncIterator[bytes], required: list[str] | None = None, encoding: str = 'utf-8-sig') -> AsyncIterator[dict]:
+    '''Parse a CSV stream into rows keyed by its header (first line), raises IngestionError if a required column is missing.'''
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    header, pending, final = None, '', False
+    stream = aiter(stream)
+    while not final:
+        try:
+            complete, pending = split_records(pending + decoder.decode(await anext(stream)))
+        except StopAsyncIteration:
+            complete, pending, final = pending + decoder.decode(b'', final=True), '', True
+        for row in csv.reader(io.StringIO(complete)):
+            if header is None:
+                header = parse_header(row, required or [])
+            elif row:
+                yield dict(zip(header, row))
+
+
+def parse_json_line(line: bytes) -> dict | None:
+    '''Parse an NDJSON line, None if it is not a JSON object.'''
+    try:
+        row = orjson.loads(line)
+    except orjson.JSONDecodeError:
+        return None
+    return row if isinstance(row, dict) else None
+
+
+async def ndjson_rows(stream: AsyncIterator[bytes]) -> AsyncIterator[dict | None]:
+    '''Parse a newline-delimited JSON stream into rows, None for the lines that are not JSON objects.'''
+    pending = b''
+    async for chunk in stream:
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield parse_json_line(line)
+    if pending.strip():
+        yield parse_json_line(pending)
+
+
+def to_floats(values: list) -> np.ndarray:
+    '''Convert values to floats at once, or one by one if some of them are not numbers (NaN).'''
+    try:
+        return np.array(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        floats = np.empty(len(values), dtype=np.float64)
+        for index, value in enumerate(values):
+            try:
+                floats[index] = float(value)
+            except (TypeError, ValueError):
+                floats[index] = np.nan
+        return floats
+
+
+def validate_column(field: Field, values: list) -> tuple[np.ndarray, np.ndarray, np.ndarray, str]:
+    '''Convert the values of a column, returns the typed column, the missing and invalid values masks, and the error message.'''
+    text = np.array(['' if v is None else str(v).strip() for v in values], dtype=object)
+    missing = text == ''
+
+    if field.kind == 'float':
+        column = to_floats(values)
+        invalid = ~np.isfinite(column)
+        if field.minimum is not None:
+            invalid |= column < field.minimum
+        if field.maximum is not None:
+            invalid |= column > field.maximum
+        bounds = [f'>= {field.minimum}'] * (field.minimum is not None) + [f'<= {field.maximum}'] * (field.maximum is not None)
+        message = ' '.join(['it must be a number', ' and '.join(bounds)]).strip()
+        return column, missing, invalid & ~missing, message
+
+    if field.kind == 'bool':
+        lowered = np.array([v.lower() for v in text], dtype=object)
+        column = np.isin(lowered, TRUE)
+        invalid = ~column & ~np.isin(lowered, FALSE)
+        return column, missing, invalid & ~missing, f'it must be one of the following: {" | ".join(TRUE + FALSE)}'
+
+    return text, missing, np.zeros(len(values), dtype=bool), ''
+
+
+def validate(fields: list[Field], rows: list[dict | None], offset: int = 0) -> tuple[dict[str, np.ndarray], np.ndarray, list[dict]]:
+    '''
+    Validate a batch of rows column by column.
+
+        :param fields [list[Field]]: Upload columns.
+        :param rows [list[dict]]: Batch rows, None for the rows that could not be parsed.
+        :param offset [int]: Number of rows of the previous batches, so that the reported rows are numbered from the start of the upload.
+
+        :returns [tuple]: Typed columns, valid rows mask, and errors of the invalid rows.
+    '''
+    parsed = np.array([row is not None for row in rows], dtype=bool)
+    rows = [row or {} for row in rows]
+    columns, masks = {}, {}
+
+    for field in fields:
+        column, missing, invalid, message = validate_column(field, [row.get(field.name) for row in rows])
+        columns[field.name] = column
+        if field.required:
+            masks[field.name] = (missing, invalid, message)
+        else:
+            masks[field.name] = (np.zeros(len(rows), dtype=bool), invalid, message)
+
+    valid = parsed.copy()
+    for missing, invalid, _ in masks.values():
+        valid &= ~(missing | invalid)
+
+    errors = []
+    for index in np.flatnonzero(~valid).tolist():
+        if not parsed[index]:
+            errors.append(dict(row=offset + index + 1, errors=dict(row='it must be a JSON object')))
+            continue
+        errors.append(dict(row=offset + index + 1, errors={
+            name: 'field required' if missing[index] else message
+            for name, (missing, invalid, message) in masks.items() if missing[index] or invalid[index]
+        }))
+    return columns, valid, errors
+
+
+def to_records(fields: list[Field], columns: dict[str, np.ndarray], valid: np.ndarray) -> list[tuple]:
+    '''Build the records of the valid rows, their values ordered as the fields.'''
+    return list(zip(*[columns[x.name][valid].tolist() for x in fields]))
+
+
+async def ingest(
+    rows: AsyncIterator[dict | None],
+    fields: list[Field],
+    write: Callable[[list[tuple]], Awaitable[dict[int, dict] | None]],
+    batch_size: int = BATCH_SIZE,
+    max_errors: int = MAX_ERRORS
+) -> dict:
+    '''
+    Validate and write the rows of an upload batch by batch.
+
+        :param rows [AsyncIterator]: Parsed rows, see csv_rows and ndjson_rows.
+        :param fields [list[Field]]: Upload columns, the records are written in the same order.
+        :param write [function]: Coroutine function that writes a batch of records, it returns the errors of the records it has rejected
+            (e.g. conflicting ones) keyed by their position in the batch, if any.
+        :param batch_size [int]: Number of rows validated and written at once.
+        :param max_errors [int]: Maximum number of invalid rows reported.
+
+        :returns [dict]: Number of rows, valid (written) and rejected rows, errors of the first rejected rows, duration and throughput.
+    '''
+    start = time.perf_counter()
+    stats = dict(rows=0, valid=0, rejected=0, errors=[])
+    batch = []
+
+    async def flush():
+        columns, valid, errors = validate(fields, batch, offset=stats['rows'])
+        records = to_records(fields, columns, valid)
+        rejected = (await write(records) or {}) if records else {}
+        if rejected:
+            rows = np.flatnonzero(valid)
+            errors = sorted([*errors, *[dict(row=stats['rows'] + int(rows[i]) + 1, errors=x) for i, x in rejected.items()]], key=lambda x: x['row'])
+        stats['rows'] += len(batch)
+        stats['valid'] += len(records) - len(rejected)
+        stats['rejected'] += len(errors)
+        stats['errors'].extend(errors[:max(max_errors - len(stats['errors']), 0)])
+        batch.clear()
+
+    async for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            await flush()
+    if batch:
+        await flush()
+
+    seconds = time.perf_counter() - start
+    return dict(stats, seconds=seconds, rows_per_second=stats['rows'] / seconds if seconds else 0.0)
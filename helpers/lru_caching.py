@@ -1,30 +1,222 @@
-'''This module uses the lru_cache decorator to create an object only once, instead of doing it for each request.
+'''This module caches function results, to create an object only once instead of doing it for each request.
+Entries expire individually on a monotonic clock, the least recently used ones are evicted once the cache is full (by size or by weight),
+and concurrent misses of the same key are computed once (single-flight). Both regular functions and coroutine functions can be cached.
 Learn more at https://fastapi.tiangolo.com/it/advanced/settings/#creating-the-settings-only-once-with-lru_cache'''
 
-from typing import Any, Callable, TypeVar
-from functools import lru_cache, wraps
-from datetime import datetime, timedelta
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from inspect import iscoroutinefunction
+from typing import Any, Awaitable, Callable, Hashable, TypeVar
 
 
 T = TypeVar('T')
 
+MISSING = object()  # sentinel of the cache misses, so that None results are cached
 
-def timed_lru_cache(seconds: int, maxsize: int = 128) -> Callable[..., Callable[..., T]]:
-    '''Set up a refresh time and space for the lru_cache decorator.'''
-
-    def decorator(func: Any) -> Any:
-        '''Wrap the decorated function with the lru_cache decorator.'''
-        func = lru_cache(maxsize=maxsize)(func)
-        func.lifetime = timedelta(seconds=seconds)
-        func.expiration = datetime.utcnow() + func.lifetime
-
-        @wraps(func)
-        def wrapper(*args: Any, **kwargs: Any) -> Any:
-            '''Before accessing an entry in the cache, it clears the cache and
-            recomputes the lifetime and expiration date if the current date is past the expiration date.'''
-            if datetime.utcnow() >= func.expiration:
-                func.cache_clear()
-                func.expiration = datetime.utcnow() + func.lifetime
-            return func(*args, **kwargs)
+
+def make_key(args: tuple, kwargs: dict) -> Hashable:
+    '''Make a cache key from the arguments of a call.'''
+    return (args, tuple(sorted(kwargs.items()))) if kwargs else args
+
+
+class TTLCache:
+    '''Thread-safe LRU cache whose entries expire individually.
+    The cache holds up to maxsize entries, or up to maxweight when a weigh function is given.'''
+
+    def __init__(self, ttl: float | None = None, maxsize: int = 128, maxweight: float | None = None, weigh: Callable[[Any], float] | None = None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.maxweight = maxweight
+        self.weigh = weigh
+        self.weight = 0.0
+        self.entries: OrderedDict[Hashable, tuple[Any, float, float]] = OrderedDict()  # value, expiration, weight
+        self.lock = threading.RLock()
+        self.stats = dict(hits=0, misses=0, evictions=0, expirations=0)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        '''Get a cached value, if it has not expired.'''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] <= time.monotonic():
+                self.remove(key)
+                self.stats['expirations'] += 1
+                entry = None
+            if entry is None:
+                self.stats['misses'] += 1
+                return default
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry[0]
+
+    def set(self, key: Hashable, value: Any, ttl: float | None = None) -> None:
+        '''Cache a value for ttl seconds (the cache TTL by default), evicting the least recently used entries if the cache is full.'''
+        ttl = self.ttl if ttl is None else ttl
+        if ttl is not None and ttl <= 0:
+            return
+        weight = self.weigh(value) if self.weigh else 1.0
+        with self.lock:
+            self.remove(key)
+            self.entries[key] = (value, time.monotonic() + ttl if ttl is not None else float('inf'), weight)
+            self.weight += weight
+            while self.entries and (len(self.entries) > self.maxsize or (self.maxweight is not None and self.weight > self.maxweight)):
+                self.remove(next(iter(self.entries)))
+                self.stats['evictions'] += 1
+
+    def remove(self, key: Hashable) -> None:
+        '''Remove an entry, if any.'''
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.weight -= entry[2]
+
+    def invalidate(self, key: Hashable) -> None:
+        '''Remove an entry from the cache.'''
+        self.remove(key)
+
+    def remove_if(self, predicate: Callable[[Hashable], bool]) -> int:
+        '''Remove the entries whose key matches a predicate, returns their number.'''
+        with self.lock:
+            keys = [x for x in self.entries if predicate(x)]
+            for key in keys:
+                self.remove(key)
+            return len(keys)
+
+    def clear(self) -> None:
+        '''Remove all entries from the cache.'''
+        with self.lock:
+            self.entries.clear()
+            self.weight = 0.0
+
+    def info(self) -> dict:
+        '''Get the cache statistics.'''
+        with self.lock:
+            return dict(self.stats, size=len(self.entries), weight=self.weight)
+
+
+class SingleFlight:
+    '''Run concurrent calls of the same key once, the other callers wait for the result of the first one.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls: dict[Hashable, tuple[threading.Event, list]] = {}
+        self.futures: dict[Hashable, asyncio.Future] = {}
+        self.stats = dict(calls=0, shared=0)
+
+    def call(self, key: Hashable, func: Callable[[], T]) -> T:
+        '''Call a function once for concurrent threads.'''
+        with self.lock:
+            leader = key not in self.calls
+            if leader:
+                self.calls[key] = (threading.Event(), [])
+            event, outcome = self.calls[key]
+            self.stats['calls' if leader else 'shared'] += 1
+
+        if not leader:
+            event.wait()
+            if isinstance(outcome[0], BaseException):
+                raise outcome[0]
+            return outcome[0]
+
+        try:
+            outcome.append(func())
+            return outcome[0]
+        except BaseException as e:
+            outcome.append(e)
+            raise
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+            event.set()
+
+    async def call_async(self, key: Hashable, func: Callable[[], Awaitable[T]]) -> T:
+        '''Await a coroutine function once for concurrent tasks of the running event loop.'''
+        future = self.futures.get(key)
+        if future is not None:
+            self.stats['shared'] += 1
+            await asyncio.wait([future])  # only raises if this task is cancelled
+            if future.cancelled():
+                return await self.call_async(key, func)  # the first task has been cancelled, run it again
+            return future.result()
+
+        future = self.futures[key] = asyncio.get_running_loop().create_future()
+        self.stats['calls'] += 1
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # retrieved, the other tasks (if any) raise it
+            raise
+        finally:
+            self.futures.pop(key, None)
+        future.set_result(result)
+        return result
+
+
+def ttl_cache(
+    ttl: float | None = None,
+    maxsize: int = 128,
+    maxweight: float | None = None,
+    weigh: Callable[[Any], float] | None = None
+) -> Callable[[Callable[..., T]], Callable[..., T]]:
+    '''
+    Cache the results of a function or a coroutine function per arguments.
+
+        :param ttl [float]: Seconds each result is cached for, forever by default.
+        :param maxsize [int]: Maximum number of cached results.
+        :param maxweight [float]: Maximum total weight of cached results, if weigh is given.
+        :param weigh [function]: Weight of a result, e.g. its size in bytes.
+
+        :returns [function]: Decorator, the wrapped function exposes cache_info(), cache_clear() and cache_invalidate(*args, **kwargs).
+    '''
+
+    def decorator(func: Callable[..., T]) -> Callable[..., T]:
+        '''Wrap the decorated function with a cache and a single-flight group.'''
+        cache = TTLCache(ttl=ttl, maxsize=maxsize, maxweight=maxweight, weigh=weigh)
+        flight = SingleFlight()
+
+        if iscoroutinefunction(func):
+            @wraps(func)
+            async def wrapper(*args: Any, **kwargs: Any) -> Any:
+                '''Await the coroutine function on cache misses only.'''
+                key = make_key(args, kwargs)
+                value = cache.get(key, MISSING)
+                if value is not MISSING:
+                    return value
+
+                async def compute() -> Any:
+                    value = await func(*args, **kwargs)
+                    cache.set(key, value)
+                    return value
+                return await flight.call_async(key, compute)
+        else:
+            @wraps(func)
+            def wrapper(*args: Any, **kwargs: Any) -> Any:
+                '''Call the function on cache misses only.'''
+                key = make_key(args, kwargs)
+                value = cache.get(key, MISSING)
+                if value is not MISSING:
+                    return value
+
+                def compute() -> Any:
+                    value = func(*args, **kwargs)
+                    cache.set(key, value)
+                    return value
+                return flight.call(key, compute)
+
+        wrapper.cache = cache
+        wrapper.cache_info = cache.info
+        wrapper.cache_clear = cache.clear
+        wrapper.cache_invalidate = lambda *args, **kwargs: cache.invalidate(make_key(args, kwargs))
         return wrapper
     return decorator
+
+
+def timed_lru_cache(seconds: int, maxsize: int = 128) -> Callable[..., Callable[..., T]]:
+    '''Set up a refresh time and space for the cache decorator, kept for compatibility with ttl_cache.'''
+    return ttl_cache(ttl=seconds, maxsize=maxsize)
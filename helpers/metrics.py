@@ -0,0 +1,423 @@
+'''This module records the runtime metrics of the application and exposes them in the Prometheus text format.
+Metrics are recorded per worker process without locks, from the event loop thread: each metric holds 1 value per label values.
+Each worker process writes its metrics to a shared directory at a fixed interval, so that the worker serving a scrape can
+add up the metrics of every worker process of its host (counters, histograms and gauges are summed). The counters and histograms
+of stopped worker processes are kept, so that the summed ones never go backwards.'''
+
+import asyncio
+import json
+import math
+import os
+import time
+from bisect import bisect_left
+from fcntl import LOCK_EX, lockf
+from contextvars import ContextVar
+from typing import Any, Callable
+from fastapi import FastAPI
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from config import get_settings
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'  # text types get a UTF-8 charset
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # seconds
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)  # seconds
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+RETIRED = 'retired.json'  # counters and histograms of the stopped worker processes, in the metrics directory
+OPERATIONS = frozenset(['SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'COPY', 'BEGIN', 'COMMIT', 'ROLLBACK'])
+
+
+class Metric:
+    '''Metric of the current worker process, 1 value per label values.'''
+
+    kind = 'untyped'
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values: dict[tuple, Any] = {}
+
+    def state(self) -> dict:
+        '''Serializable state of the metric, see merge.'''
+        return dict(kind=self.kind, description=self.description, labels=list(self.labels), samples=[[list(k), v] for k, v in self.values.items()])
+
+
+class Counter(Metric):
+    '''Monotonic counter.'''
+
+    kind = 'counter'
+
+    def inc(self, labels: tuple = (), amount: float = 1) -> None:
+        '''Increment the counter of label values.'''
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    '''Value that goes up and down.'''
+
+    kind = 'gauge'
+
+    def inc(self, labels: tuple = (), amount: float = 1) -> None:
+        '''Increment the gauge of label values.'''
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, labels: tuple = (), amount: float = 1) -> None:
+        '''Decrement the gauge of label values.'''
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+    def set(self, labels: tuple, value: float) -> None:
+        '''Set the gauge of label values.'''
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    '''Distribution of observed values: number of values per bucket (upper bound included) and sum of the values.'''
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, labels: tuple, value: float) -> None:
+        '''Record a value of label values.'''
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def state(self) -> dict:
+        return dict(super().state(), buckets=list(self.buckets))
+
+
+class MetricsRegistry:
+    '''Metrics of the current worker process, and collectors of the metrics read at scrape time (e.g. connection pool gauges).'''
+
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+        self.collectors: list[Callable[[], dict]] = []
+
+    def register(self, metric: Metric) -> Metric:
+        '''Register a metric, its name must be unique.'''
+        if metric.name in self.metrics:
+            raise ValueError(f'Metric {metric.name} is already registered.')
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, description: str, labels: tuple[str, ...] = ()) -> Counter:
+        '''Register a counter.'''
+        return self.register(Counter(name, description, labels))
+
+    def gauge(self, name: str, description: str, labels: tuple[str, ...] = ()) -> Gauge:
+        '''Register a gauge.'''
+        return self.register(Gauge(name, description, labels))
+
+    def histogram(self, name: str, description: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        '''Register a histogram.'''
+        return self.register(Histogram(name, description, labels, buckets))
+
+    def collector(self, func: Callable[[], dict]) -> Callable[[], dict]:
+        '''Register a function returning metric states keyed by name, called at scrape time. It can be used as a decorator.'''
+        self.collectors.append(func)
+        return func
+
+    def state(self) -> dict:
+        '''Serializable state of the metrics and of the collected ones.'''
+        state = {name: metric.state() for name, metric in self.metrics.items()}
+        for collect in self.collectors:
+            state.update(collect())
+        return state
+
+
+def metric_state(kind: str, description: str, samples: list, labels: tuple[str, ...] = (), buckets: tuple | None = None) -> dict:
+    '''State of a metric read at scrape time, for registry collectors: samples are pairs of label values and value.'''
+    state = dict(kind=kind, description=description, labels=list(labels), samples=[[list(k), v] for k, v in samples])
+    if buckets is not None:
+        state['buckets'] = list(buckets)
+    return state
+
+
+def add_sample(kind: str, samples: dict, labels: tuple, value: Any) -> None:
+    '''Add a value to the sample of label values, histogram values are added bucket by bucket.'''
+    current = samples.get(labels)
+    if current is None:
+        samples[labels] = [list(value[0]), value[1]] if kind == 'histogram' else value
+    elif kind == 'histogram':
+        current[0] = [x + y for x, y in zip(current[0], value[0])]
+        current[1] += value[1]
+    else:
+        samples[labels] = current + value
+
+
+def merge(states: list[dict]) -> dict:
+    '''Add up metric states, e.g. of several worker processes: values of the same metric and label values are summed.'''
+    merged: dict[str, dict] = {}
+    for state in states:
+        for name, metric in state.items():
+            target = merged.setdefault(name, dict(metric, samples={}))
+            for labels, value in metric['samples']:
+                add_sample(metric['kind'], target['samples'], tuple(labels), value)
+    for metric in merged.values():
+        metric['samples'] = list(metric['samples'].items())
+    return merged
+
+
+def format_value(value: float) -> str:
+    '''Prometheus sample value.'''
+    if isinstance(value, float) and math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def format_labels(pairs: list[tuple[str, Any]]) -> str:
+    '''Prometheus label set, values escaped.'''
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def render(state: dict) -> str:
+    '''Render metric states (see merge) in the Prometheus text format 0.0.4.'''
+    lines = []
+    for name in sorted(state):
+        metric = state[name]
+        lines.append(f'# HELP {name} {metric["description"]}')
+        lines.append(f'# TYPE {name} {metric["kind"]}')
+        for labels, value in sorted(metric['samples'], key=lambda x: [str(y) for y in x[0]]):
+            pairs = list(zip(metric['labels'], labels))
+            if metric['kind'] != 'histogram':
+                lines.append(f'{name}{format_labels(pairs)} {format_value(value)}')
+                continue
+            cumulative = 0
+            for bound, count in zip([*metric['buckets'], math.inf], value[0]):
+                cumulative += count
+                upper = '+Inf' if math.isinf(bound) else repr(float(bound))
+                lines.append(f'{name}_bucket{format_labels([*pairs, ("le", upper)])} {cumulative}')
+            lines.append(f'{name}_sum{format_labels(pairs)} {format_value(value[1])}')
+            lines.append(f'{name}_count{format_labels(pairs)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+http_requests = registry.counter('http_requests_total', 'HTTP requests, per method, route and status code.', ('method', 'route', 'status'))
+http_duration = registry.histogram('http_request_duration_seconds', 'HTTP request latency in seconds, until the response has been sent.', ('method', 'route'))
+http_in_flight = registry.gauge('http_requests_in_flight', 'HTTP requests being served.', ('method',))
+db_duration = registry.histogram('db_query_duration_seconds', 'Database statement latency in seconds, per operation.', ('operation',), QUERY_BUCKETS)
+db_rows = registry.counter('db_rows_total', 'Rows affected or returned by database statements, as reported by the driver, per operation.', ('operation',))
+db_request_queries = registry.histogram('db_queries_per_request', 'Database statements per HTTP request, per route.', ('route',), COUNT_BUCKETS)
+throttling_rejections = registry.counter('throttling_rejections_total', 'Requests rejected by the rate limiter, per policy.', ('policy',))
+
+
+class RequestMetrics:
+    '''Database statements of the HTTP request being served.'''
+
+    __slots__ = ('scope', 'queries', 'query_seconds', 'budget_exceeded')
+
+    def __init__(self, scope: Scope):
+        self.scope = scope
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.budget_exceeded = False
+
+
+current_request: ContextVar[RequestMetrics | None] = ContextVar('metrics_request', default=None)
+route_paths: dict[Any, str] = {}  # route path templates keyed by endpoint, so that metrics are labelled per route rather than per URL
+
+
+def route_path(scope: Scope) -> str:
+    '''Path template of the route that has served a request, e.g. /admin/farms/{farm_id}, unmatched if no route has.'''
+    endpoint = scope.get('endpoint')
+    if endpoint is None:
+        return 'unmatched'
+    path = route_paths.get(endpoint)
+    if path is None:
+        path = route_paths[endpoint] = next((x.path for x in scope['app'].routes if getattr(x, 'endpoint', None) is endpoint), 'unmatched')
+    return path
+
+
+def statement_operation(statement: str) -> str:
+    '''Operation of a SQL statement, its first keyword, OTHER if it is not a common one.'''
+    keyword = statement.lstrip(' \n\t(').split(None, 1)[0].upper() if statement.strip() else ''
+    return keyword if keyword in OPERATIONS else 'OTHER'
+
+
+def observe_query(statement: str, seconds: float, rows: int | None) -> None:
+    '''Record a database statement, and count it in the HTTP request being served, if any. Its rows are counted if the driver reports them.'''
+    operation = statement_operation(statement)
+    db_duration.observe((operation,), seconds)
+    if rows:
+        db_rows.inc((operation,), rows)
+    request = current_request.get()
+    if request is not None:
+        request.queries += 1
+        request.query_seconds += seconds
+
+
+class MetricsMiddleware:
+    '''ASGI middleware recording the latency, status code and database statements of the HTTP requests.'''
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        method = scope['method']
+        response = dict(status=500)  # the status of the requests failing before their response has started
+
+        async def send_status(message: Message) -> None:
+            if message['type'] == 'http.response.start':
+                response['status'] = message['status']
+            await send(message)
+
+        request = RequestMetrics(scope)
+        token = current_request.set(request)
+        http_in_flight.inc((method,))
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            seconds = time.perf_counter() - start
+            http_in_flight.dec((method,))
+            current_request.reset(token)
+            route = route_path(scope)
+            http_requests.inc((method, route, str(response['status'])))
+            http_duration.observe((method, route), seconds)
+            db_request_queries.observe((route,), request.queries)
+
+
+class MetricsPublisher:
+    '''Writer of the metrics of the current worker process to the METRICS.DIRECTORY, and reader of the metrics of every worker process.
+    The files that have not been written for 3 intervals belong to stopped worker processes: their counters and histograms are added
+    to the retired metrics (their gauges are dropped), so that the summed counters do not go backwards, which would read as a reset.'''
+
+    def __init__(self, metrics: MetricsRegistry):
+        self.registry = metrics
+        self.task: asyncio.Task | None = None
+
+    def path(self, directory: str) -> str:
+        '''Metrics file of the current worker process.'''
+        return os.path.join(directory, f'{os.getpid()}.json')
+
+    def write(self, directory: str) -> None:
+        '''Write the metrics of the current worker process, atomically.'''
+        os.makedirs(directory, exist_ok=True)
+        path = self.path(directory)
+        with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.registry.state(), f)
+        os.replace(f'{path}.tmp', path)
+
+    def retire(self, directory: str, names: list[str]) -> None:
+        '''Add the counters and histograms of stopped worker processes to the retired metrics, and remove their files.
+        Files are retired under a lock, so that each one is added once when several worker processes serve scrapes.'''
+        retired = os.path.join(directory, RETIRED)
+        with open(os.path.join(directory, f'{RETIRED}.lock'), 'w', encoding='utf-8') as lock:
+            lockf(lock, LOCK_EX)  # released on close
+            states = []
+            for name in names:
+                try:
+                    with open(os.path.join(directory, name), encoding='utf-8') as f:
+                        state = json.load(f)
+                except FileNotFoundError:
+                    continue  # already retired
+                except ValueError:
+                    state = {}
+                states.append({k: v for k, v in state.items() if v['kind'] != 'gauge'})
+                os.remove(os.path.join(directory, name))
+            if not states:
+                return
+            try:
+                with open(retired, encoding='utf-8') as f:
+                    states.append(json.load(f))
+            except (FileNotFoundError, ValueError):
+                pass
+            with open(f'{retired}.tmp', 'w', encoding='utf-8') as f:
+                json.dump(merge(states), f)
+            os.replace(f'{retired}.tmp', retired)
+
+    def read(self, directory: str, max_age: float) -> list[dict]:
+        '''Read the metrics of the other worker processes written less than max_age seconds ago, and the retired metrics.
+        The older files are retired first.'''
+        states, stale, now, own = [], [], time.time(), f'{os.getpid()}.json'
+        try:
+            names = [x for x in os.listdir(directory) if x.endswith('.json') and x not in (own, RETIRED)]
+        except FileNotFoundError:
+            return states
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                if now - os.path.getmtime(path) > max_age:
+                    stale.append(name)
+                    continue
+                with open(path, encoding='utf-8') as f:
+                    states.append(json.load(f))
+            except (FileNotFoundError, ValueError):
+                continue
+        if stale:
+            self.retire(directory, stale)
+        try:
+            with open(os.path.join(directory, RETIRED), encoding='utf-8') as f:
+                states.append(json.load(f))
+        except (FileNotFoundError, ValueError):
+            pass
+        return states
+
+    def collect(self) -> dict:
+        '''Metrics of the current worker process, added up with the ones of the other worker processes if METRICS.DIRECTORY is set.'''
+        config = get_settings().METRICS
+        states = [self.registry.state()]
+        if config.DIRECTORY:
+            states.extend(self.read(config.DIRECTORY, max_age=3 * config.INTERVAL))
+        return merge(states)
+
+    async def run(self) -> None:
+        '''Write the metrics of the current worker process at the METRICS.INTERVAL, settings are read at each write.'''
+        while True:
+            config = get_settings().METRICS
+            if config.DIRECTORY:
+                try:
+                    await asyncio.to_thread(self.write, config.DIRECTORY)
+                except OSError:
+                    pass  # retried at the next interval
+            await asyncio.sleep(config.INTERVAL)
+
+    async def start(self) -> None:
+        '''Start writing the metrics of the current worker process, the file left by a stopped process of the same PID is retired first.'''
+        directory = get_settings().METRICS.DIRECTORY
+        if directory and os.path.exists(self.path(directory)):
+            await asyncio.to_thread(self.retire, directory, [os.path.basename(self.path(directory))])
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        '''Stop writing the metrics, and retire the ones of the current worker process so that its gauges are no longer added up.'''
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        directory = get_settings().METRICS.DIRECTORY
+        if directory:
+            try:
+                await asyncio.to_thread(self.write, directory)
+                await asyncio.to_thread(self.retire, directory, [os.path.basename(self.path(directory))])
+            except OSError:
+                pass
+
+
+metrics_publisher = MetricsPublisher(registry)
+
+
+class Metrics:
+    '''Runtime metrics class.'''
+
+    def enable(app: FastAPI) -> FastAPI:
+        '''Enable the metrics middleware and the publishing of the metrics of the current worker process.'''
+        app.add_middleware(MetricsMiddleware)
+        app.add_event_handler('startup', metrics_publisher.start)
+        app.add_event_handler('shutdown', metrics_publisher.stop)
+        return app
@@ -2,21 +2,9 @@
 
 import json
 from typing import Any
-from uuid import UUID
 from decimal import Decimal
-from datetime import date, datetime
 from caseconverter import camelcase
-
-
-class AppSettings():
-    '''Application settings class.'''
-
-    def __init__(self, d):
-        for k, v in d.items():
-            if isinstance(k, (list, tuple)):
-                setattr(self, k, [AppSettings(x) if isinstance(x, dict) else x for x in v])
-            else:
-                setattr(self, k, AppSettings(v) if isinstance(v, dict) else v)
+import orjson
 
 
 class DataFormatter:
@@ -32,6 +20,13 @@ class DataFormatter:
             return s.replace('postgres', 'postgresql')
         return s
 
+    def asyncpg(s: str) -> str:
+        '''Format PostgreSQL URI string to use the asyncpg driver.'''
+        url = DataFormatter.postgresql(s)
+        if url.startswith('postgresql://'):
+            return url.replace('postgresql://', 'postgresql+asyncpg://', 1)
+        return url
+
 
 class FileManagement:
     '''File management class.'''
@@ -56,18 +51,20 @@ class FileManagement:
                 json.dump(data, f, indent=4)
 
 
-class JSONCustomEncoder(json.JSONEncoder):
-    '''JSON custom encoder class.'''
+class JSONSerializer:
+    '''orjson serializer class. Datetimes, dates and UUIDs are serialized natively, in ISO 8601 and canonical formats (UUIDs with dashes, not as .hex).'''
+
+    OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+    def default(obj: Any) -> float:
+        '''orjson hook for the objects not serializable natively.'''
+        if isinstance(obj, Decimal):
+            return float(obj)
+        raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
 
-    def default(self, o: Any) -> str | float:
-        '''JSON serializer for objects not serializable by default json code.'''
-        if isinstance(o, (datetime, date)):
-            return o.isoformat()
-        if isinstance(o, Decimal):
-            return float(o)
-        if isinstance(o, UUID):
-            return o.hex
-        return super().default(o)
+    def dumps(data: Any) -> bytes:
+        '''Serialize data to JSON bytes.'''
+        return orjson.dumps(data, default=JSONSerializer.default, option=JSONSerializer.OPTIONS)
 
 
 class ResponseFormatter:
@@ -110,3 +107,11 @@ def try_except(func, *args, **kwargs):
         return func(*args, **kwargs)
     except Exception as e:  # noqa: F841 pylint: disable=[W0612,W0703]
         return None
+
+
+async def try_except_async(func, *args, **kwargs):
+    '''Generic try-except function for coroutines.'''
+    try:
+        return await func(*args, **kwargs)
+    except Exception as e:  # noqa: F841 pylint: disable=[W0612,W0703]
+        return None
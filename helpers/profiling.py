@@ -0,0 +1,343 @@
+'''This module profiles single requests on demand: requests carrying the trusted profiling header, or sampled at the configured rate.
+The call stacks of the event loop thread are sampled while a request runs, and written with the request phase timings
+(body parsing, dependencies, CRUD calls, serialization) to a bounded ring of files: 1 folded stacks file per profile,
+the input format of flamegraph.pl, speedscope and most flame graph viewers, and 1 JSON summary.
+Phase timings are also sent back in the Server-Timing response header. Requests that are not profiled only pay a settings lookup,
+and the timers of their phases a context variable lookup.'''
+
+import asyncio
+import hmac
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextvars import ContextVar
+from functools import wraps
+from inspect import isasyncgenfunction
+from typing import Any, Callable
+from fastapi import FastAPI, Request, Response
+from fastapi.routing import APIRoute
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from config import ProfilingConfig, get_settings
+
+
+PHASES = ('parsing', 'dependencies', 'crud', 'serialization')  # the rest of the request time is reported as other
+
+
+class Frame:
+    '''Phase being timed, the time of its nested phases is excluded from its own.'''
+
+    __slots__ = ('phases', 'children')
+
+    def __init__(self, phases: defaultdict):
+        self.phases = phases
+        self.children = 0.0
+
+
+current_frame: ContextVar[Frame | None] = ContextVar('profiling_frame', default=None)
+
+
+class Phase:
+    '''Context manager adding its wall time to a phase of the request being profiled, if any.'''
+
+    __slots__ = ('name', 'parent', 'frame', 'token', 'start')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.parent = self.frame = self.token = None
+        self.start = 0.0
+
+    def __enter__(self) -> 'Phase':
+        self.parent = current_frame.get()
+        if self.parent is not None:
+            self.frame = Frame(self.parent.phases)
+            self.token = current_frame.set(self.frame)
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        if self.parent is not None:
+            elapsed = time.perf_counter() - self.start
+            current_frame.reset(self.token)
+            self.parent.children += elapsed
+            self.frame.phases[self.name] += elapsed - self.frame.children
+
+
+async def timed_step(phase: str, step: Any) -> tuple[bool, Any]:
+    '''Await a step of an async generator as a request phase, returns whether the generator is exhausted and the value it yielded.'''
+    with Phase(phase):
+        try:
+            return False, await step
+        except StopAsyncIteration:
+            return True, None
+
+
+def profiled_generator(phase: str) -> Callable[[Callable], Callable]:
+    '''Time each step of an async generator function as a request phase, e.g. a dependency with teardown, see profiled.'''
+
+    def decorator(func: Callable) -> Callable:
+        '''Wrap the decorated async generator function with a phase timer.'''
+        @wraps(func)
+        async def generator(*args: Any, **kwargs: Any) -> Any:
+            '''Forward the values, exceptions and closing of the consumer to the decorated generator.'''
+            agen = func(*args, **kwargs)
+            step = anext(agen)
+            try:
+                while True:
+                    done, value = await timed_step(phase, step)
+                    if done:
+                        return
+                    try:
+                        sent = yield value
+                    except GeneratorExit:
+                        raise
+                    except BaseException as e:  # pylint: disable=[W0703]
+                        step = agen.athrow(e)
+                    else:
+                        step = agen.asend(sent)
+            finally:
+                with Phase(phase):
+                    await agen.aclose()
+        return generator
+    return decorator
+
+
+def profiled(phase: str) -> Callable[[Callable], Callable]:
+    '''
+    Time a coroutine function, or each step of an async generator function, as a request phase.
+
+        :param phase [str]: Phase name, e.g. one of the following: parsing | dependencies | crud | serialization
+
+        :returns [function]: Decorator, the wrapped function keeps the signature of the decorated one.
+    '''
+
+    def decorator(func: Callable) -> Callable:
+        '''Wrap the decorated coroutine function with a phase timer.'''
+        if isasyncgenfunction(func):
+            return profiled_generator(phase)(func)
+
+        @wraps(func)
+        async def wrapper(*args: Any, **kwargs: Any) -> Any:
+            '''Await the decorated function.'''
+            if current_frame.get() is None:
+                return await func(*args, **kwargs)
+            with Phase(phase):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class ProfiledRequest(Request):
+    '''Request whose JSON body parsing is timed.'''
+
+    async def json(self) -> Any:
+        with Phase('parsing'):
+            return await super().json()
+
+
+class ProfiledRoute(APIRoute):
+    '''API route timing the JSON body parsing of the profiled requests.'''
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+
+        async def profiled_handler(request: Request) -> Response:
+            if current_frame.get() is not None:
+                request = ProfiledRequest(request.scope, request.receive)
+            return await handler(request)
+        return profiled_handler
+
+
+class StackSampler:
+    '''Thread sampling the call stacks of another thread at a fixed interval, counted per folded stack (outermost frame first).
+    The event loop thread runs every request, so that the stacks of concurrent requests are sampled too.'''
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter[str] = Counter()
+        self.labels: dict = {}
+        self.prefixes = sorted({os.path.join(os.path.abspath(x), '') for x in sys.path}, key=len, reverse=True)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='profiling-sampler', daemon=True)
+
+    def label(self, code) -> str:
+        '''Flame graph label of a code object: function name, file (relative to its import path) and first line.'''
+        label = self.labels.get(code)
+        if label is None:
+            filename = next((code.co_filename[len(x):] for x in self.prefixes if code.co_filename.startswith(x)), code.co_filename)
+            label = self.labels[code] = f'{code.co_name} ({filename}:{code.co_firstlineno})'
+        return label
+
+    def sample(self) -> None:
+        '''Count the current call stack of the sampled thread.'''
+        frame = sys._current_frames().get(self.thread_id)  # pylint: disable=[W0212]
+        labels = []
+        while frame is not None:
+            labels.append(self.label(frame.f_code))
+            frame = frame.f_back
+        if labels:
+            self.stacks[';'.join(reversed(labels))] += 1
+
+    def run(self) -> None:
+        '''Sample until stopped.'''
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+    def start(self) -> None:
+        '''Start sampling.'''
+        self.thread.start()
+
+    def stop(self) -> Counter:
+        '''Stop sampling, returns the number of samples per folded stack.'''
+        self.stop_event.set()
+        self.thread.join()
+        return self.stacks
+
+
+class ProfileRing:
+    '''Directory of the latest profiles, the oldest ones are deleted once there are more than max_profiles.
+    File names start with the profile time in milliseconds, so that they sort by age.'''
+
+    def __init__(self, directory: str, max_profiles: int):
+        self.directory = directory
+        self.max_profiles = max_profiles
+
+    def write(self, summary: dict, stacks: Counter) -> str:
+        '''Write a profile (folded stacks and JSON summary), returns its name.'''
+        os.makedirs(self.directory, exist_ok=True)
+        slug = re.sub(r'[^A-Za-z0-9]+', '_', summary['path']).strip('_') or 'root'
+        name = f'{int(summary["started_at"] * 1000):013d}-{os.getpid()}-{summary["method"]}-{slug[:80]}'
+        with open(os.path.join(self.directory, f'{name}.folded'), 'w', encoding='utf-8') as f:
+            f.writelines(f'{stack} {count}\n' for stack, count in stacks.items())
+        with open(os.path.join(self.directory, f'{name}.json'), 'w', encoding='utf-8') as f:
+            json.dump(summary, f)
+        self.trim()
+        return name
+
+    def names(self) -> list[str]:
+        '''Profile names, oldest first.'''
+        try:
+            return sorted(x[:-len('.json')] for x in os.listdir(self.directory) if x.endswith('.json'))
+        except FileNotFoundError:
+            return []
+
+    def trim(self) -> None:
+        '''Delete the oldest profiles over the limit, the ones deleted concurrently by another worker process are skipped.'''
+        names = self.names()
+        for name in names[:max(len(names) - self.max_profiles, 0)]:
+            for extension in ('json', 'folded'):
+                try:
+                    os.remove(os.path.join(self.directory, f'{name}.{extension}'))
+                except FileNotFoundError:
+                    pass
+
+    def summaries(self) -> list[dict]:
+        '''Summaries of the profiles, latest first.'''
+        summaries = []
+        for name in reversed(self.names()):
+            try:
+                with open(os.path.join(self.directory, f'{name}.json'), encoding='utf-8') as f:
+                    summaries.append(dict(json.load(f), name=name))
+            except (FileNotFoundError, ValueError):
+                continue
+        return summaries
+
+
+def phase_timings(phases: dict, total: float) -> dict[str, float]:
+    '''Phase timings of a request in seconds, the known phases first, and the time spent outside of any phase as other.'''
+    timings = {name: phases.get(name, 0.0) for name in PHASES}
+    timings.update((name, seconds) for name, seconds in phases.items() if name not in timings)
+    timings['other'] = max(total - sum(timings.values()), 0.0)
+    return timings
+
+
+def server_timing(phases: dict, total: float) -> str:
+    '''Server-Timing header value of phase timings, in milliseconds.'''
+    return ', '.join(f'{name};dur={seconds * 1000:.3f}' for name, seconds in [*phases.items(), ('total', total)])
+
+
+class ProfilingMiddleware:
+    '''ASGI middleware profiling the HTTP requests selected by the PROFILING settings, read on each request so that reloads apply.'''
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self.active = False  # 1 profile at a time per worker process, the sampler sees every request of the event loop
+
+    def selected(self, scope: Scope, config: ProfilingConfig) -> bool:
+        '''Check if a request carries the profiling token, or is sampled.'''
+        if config.TOKEN:
+            header = config.HEADER.lower().encode('latin-1')
+            for name, value in scope['headers']:
+                if name == header:
+                    return hmac.compare_digest(value, config.TOKEN.encode('latin-1'))
+        return config.SAMPLE_RATE > 0 and random.random() < config.SAMPLE_RATE
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        config = get_settings().PROFILING
+        if not config.ENABLED or self.active or not self.selected(scope, config):
+            await self.app(scope, receive, send)
+            return
+
+        self.active = True
+        try:
+            await self.profile(scope, receive, send, config)
+        finally:
+            self.active = False
+
+    async def profile(self, scope: Scope, receive: Receive, send: Send, config: ProfilingConfig) -> None:
+        '''Run a request with its phases timed and its call stacks sampled, then write its profile.'''
+        root = Frame(defaultdict(float))
+        response = dict(status=None)
+
+        async def send_timed(message: Message) -> None:
+            if message['type'] == 'http.response.start':
+                response['status'] = message['status']
+                timing = server_timing(dict(root.phases), time.perf_counter() - start)
+                message = dict(message, headers=[*message.get('headers', []), (b'server-timing', timing.encode('latin-1'))])
+            await send(message)
+
+        sampler = StackSampler(threading.get_ident(), config.INTERVAL)
+        started_at, start = time.time(), time.perf_counter()
+        token = current_frame.set(root)
+        sampler.start()
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            stacks = sampler.stop()
+            total = time.perf_counter() - start
+            current_frame.reset(token)
+            summary = dict(
+                method=scope['method'],
+                path=scope['path'],
+                status=response['status'],
+                started_at=started_at,
+                seconds=total,
+                phases=phase_timings(root.phases, total),
+                samples=sum(stacks.values()),
+                interval=config.INTERVAL
+            )
+            await asyncio.to_thread(ProfileRing(config.DIRECTORY, config.MAX_PROFILES).write, summary, stacks)
+
+
+class Profiling:
+    '''Request profiling class.'''
+
+    def enable(app: FastAPI) -> FastAPI:
+        '''Enable the profiling middleware, idle until the PROFILING settings enable it.'''
+        app.add_middleware(ProfilingMiddleware)
+        return app
+
+
+def profile_summaries() -> list[dict]:
+    '''Summaries of the latest profiles of this host, see ProfileRing.'''
+    config = get_settings().PROFILING
+    return ProfileRing(config.DIRECTORY, config.MAX_PROFILES).summaries()
@@ -0,0 +1,94 @@
+'''This module caches the serialized responses of GET routes per table version, and answers conditional requests.
+The entity tag of a response is derived from the version of the table it reads (see crud.get_version) and from its query:
+a request whose If-None-Match header matches it gets a 304 without the rows being read, and the bodies of the other requests are served
+from a cache bounded in bytes. Last-Modified is not sent: a delete does not change the latest updated_at, so that If-Modified-Since
+requests would get a 304 for a collection that has changed. The versions are read from the database on each request (1 primary key lookup),
+so that writes of any worker process are taken into account; the cache entries of a table are also dropped by the CRUD write functions
+of the current one.'''
+
+import hashlib
+from typing import Awaitable, Callable
+from fastapi import Request, Response, status
+
+from helpers.lru_caching import TTLCache
+
+
+MAX_BYTES = 32 * 1024 * 1024  # cached bodies per worker process
+TTL = 3600  # seconds
+CACHE_CONTROL = 'private, no-cache'  # clients store responses, and revalidate them on each use
+
+Version = tuple[int, int]  # number of writes and deletes of a table
+
+
+class ResponseCache:
+    '''Bounded cache of serialized responses keyed by table, route path and query parameters, see cached_response.'''
+
+    def __init__(self, ttl: float = TTL, max_bytes: int = MAX_BYTES):
+        self.cache = TTLCache(ttl=ttl, maxsize=1_000_000, maxweight=max_bytes, weigh=lambda x: len(x[1]))
+        self.stats = dict(not_modified=0, invalidations=0)
+
+    def get(self, key: tuple, etag: str) -> tuple[str, bytes, str | None] | None:
+        '''Get a cached response, if it has been cached for the same validator.'''
+        entry = self.cache.get(key)
+        return entry if entry is not None and entry[0] == etag else None
+
+    def set(self, key: tuple, etag: str, body: bytes, media_type: str | None) -> None:
+        '''Cache a response body.'''
+        self.cache.set(key, (etag, body, media_type))
+
+    def invalidate(self, table: str) -> None:
+        '''Remove the cached responses of a table, e.g. after it has been written to.'''
+        self.cache.remove_if(lambda key: key[0] == table)
+        self.stats['invalidations'] += 1
+
+    def info(self) -> dict:
+        '''Get the cache statistics.'''
+        return dict(self.cache.info(), **self.stats)
+
+
+response_cache = ResponseCache()
+
+
+def make_etag(key: tuple, version: Version) -> str:
+    '''Strong entity tag of a response, from its cache key and the version of its table.'''
+    digest = hashlib.blake2b(repr((key, version)).encode('utf-8'), digest_size=16).hexdigest()
+    return f'"{digest}"'
+
+
+def is_not_modified(request: Request, etag: str) -> bool:
+    '''Check the If-None-Match request header (RFC 7232), weak comparison.'''
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is None:
+        return False
+    tags = [x.strip().removeprefix('W/') for x in if_none_match.split(',')]
+    return '*' in tags or etag in tags
+
+
+async def cached_response(request: Request, table: str, version: Version, compute: Callable[[], Awaitable[Response]]) -> Response:
+    '''
+    Respond to a GET request from its validators or from the cache, computing the response only if the table version has changed.
+
+        :param request [Request]: Request, its path and query parameters are part of the cache key.
+        :param table [str]: Name of the table the response reads.
+        :param version [tuple]: Current table version, see crud.get_version.
+        :param compute [function]: Coroutine function that builds the response, only 200 responses are cached.
+
+        :returns [Response]: 304 response, cached response, or computed response, with ETag and Cache-Control headers.
+    '''
+    key = (table, request.url.path, tuple(sorted(request.query_params.multi_items())))
+    etag = make_etag(key, version)
+    headers = {'ETag': etag, 'Cache-Control': CACHE_CONTROL}
+
+    if is_not_modified(request, etag):
+        response_cache.stats['not_modified'] += 1
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    entry = response_cache.get(key, etag)
+    if entry is not None:
+        return Response(content=entry[1], media_type=entry[2], headers=headers)
+
+    response = await compute()
+    if response.status_code == status.HTTP_200_OK:
+        response_cache.set(key, etag, response.body, response.media_type)
+        response.headers.update(headers)
+    return response
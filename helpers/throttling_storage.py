@@ -0,0 +1,157 @@
+'''This module defines the storage backends of the throttling limiter.
+Limits are enforced with the Generic Cell Rate Algorithm (GCRA): each key only stores its theoretical arrival time (TAT).'''
+
+import asyncio
+import errno
+import hashlib
+import math
+import mmap
+import os
+import struct
+import time
+from fcntl import LOCK_EX, LOCK_NB, LOCK_UN, lockf
+from redis import asyncio as aioredis
+
+from helpers.lru_caching import TTLCache
+
+
+def gcra(tat: float | None, now: float, interval: float, capacity: float, cost: int) -> tuple[bool, float, float]:
+    '''
+    Apply the Generic Cell Rate Algorithm, which is equivalent to a token bucket refilled by 1 token every interval.
+
+        :param tat [float]: Current theoretical arrival time, if any.
+        :param now [float]: Current timestamp.
+        :param interval [float]: Seconds between 2 requests at the sustained rate.
+        :param capacity [float]: Burst size, in number of requests.
+        :param cost [int]: Number of requests to acquire.
+
+        :returns [tuple]: Whether the requests are allowed, the new theoretical arrival time, and the seconds to wait before retrying.
+    '''
+    new_tat = max(tat or now, now) + interval * cost
+    retry_after = new_tat - now - capacity * interval
+    if retry_after > 0:
+        return False, tat, retry_after
+    return True, new_tat, 0.0
+
+
+class MemoryStorage:
+    '''In-process storage, each worker process enforces its own limits.
+    A key expires at its theoretical arrival time, and the least recently used key is evicted once MAX_KEYS keys are stored.'''
+
+    MAX_KEYS = 100_000
+
+    def __init__(self):
+        self.tats = TTLCache(maxsize=self.MAX_KEYS)
+
+    async def acquire(self, key: str, interval: float, capacity: float, cost: int = 1) -> tuple[bool, float]:
+        '''Acquire requests for a key, returning whether they are allowed and the seconds to wait before retrying.'''
+        now = time.time()
+        allowed, tat, retry_after = gcra(self.tats.get(key), now, interval, capacity, cost)
+        if allowed:
+            self.tats.set(key, tat, ttl=tat - now)
+        return allowed, retry_after
+
+    async def close(self) -> None:
+        '''Release the storage resources.'''
+
+
+class SharedMemoryStorage:
+    '''Memory-mapped file storage shared by the worker processes of a single host.
+    Keys are hashed into buckets of slots, each bucket is guarded by a byte-range file lock so that workers rarely contend.
+    The lock is never waited for on the event loop: a locked bucket is tried again after LOCK_RETRY seconds.'''
+
+    SLOT = struct.Struct('Qd')  # key hash, theoretical arrival time
+    LOCK_RETRY = 0.001  # seconds
+
+    def __init__(self, path: str, buckets: int = 4096, slots: int = 8):
+        self.buckets = buckets
+        self.slots = slots
+        self.bucket_size = slots * self.SLOT.size
+        size = buckets * self.bucket_size
+        self.file_descriptor = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self.file_descriptor).st_size < size:
+            os.ftruncate(self.file_descriptor, size)
+        self.memory = mmap.mmap(self.file_descriptor, size)
+
+    async def acquire(self, key: str, interval: float, capacity: float, cost: int = 1) -> tuple[bool, float]:
+        '''Acquire requests for a key, returning whether they are allowed and the seconds to wait before retrying.'''
+        key_hash = int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little') or 1
+        offset = (key_hash % self.buckets) * self.bucket_size
+
+        await self.lock(offset)
+        try:
+            now = time.time()
+            position, tat = self.find_slot(offset, key_hash, now)
+            allowed, tat, retry_after = gcra(tat, now, interval, capacity, cost)
+            if allowed:
+                self.SLOT.pack_into(self.memory, position, key_hash, tat)
+        finally:
+            lockf(self.file_descriptor, LOCK_UN, self.bucket_size, offset)
+        return allowed, retry_after
+
+    async def lock(self, offset: int) -> None:
+        '''Lock the bucket at an offset, waiting without blocking the event loop while another worker process holds it.
+        The lock is held by the process: the acquisitions of a worker process do not await while they hold it.'''
+        while True:
+            try:
+                lockf(self.file_descriptor, LOCK_EX | LOCK_NB, self.bucket_size, offset)
+                return
+            except OSError as e:
+                if e.errno not in (errno.EACCES, errno.EAGAIN):
+                    raise
+            await asyncio.sleep(self.LOCK_RETRY)
+
+    def find_slot(self, offset: int, key_hash: int, now: float) -> tuple[int, float | None]:
+        '''Find the slot of a key in its bucket, or the slot to reuse (empty, expired, or the oldest one).'''
+        empty, oldest, oldest_tat = None, None, math.inf
+        for position in range(offset, offset + self.bucket_size, self.SLOT.size):
+            slot_hash, tat = self.SLOT.unpack_from(self.memory, position)
+            if slot_hash == key_hash:
+                return position, tat
+            if empty is None and (slot_hash == 0 or tat <= now):
+                empty = position
+            elif tat < oldest_tat:
+                oldest, oldest_tat = position, tat
+        return oldest if empty is None else empty, None
+
+    async def close(self) -> None:
+        '''Release the storage resources.'''
+        self.memory.close()
+        os.close(self.file_descriptor)
+
+
+class RedisStorage:
+    '''Redis storage shared by the worker processes of multiple hosts, each acquisition is 1 atomic script call.'''
+
+    SCRIPT = '''
+        local tat = tonumber(redis.call('GET', KEYS[1]))
+        local time = redis.call('TIME')
+        local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+        local interval, capacity, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+        local new_tat = math.max(tat or now, now) + interval * cost
+        local retry_after = new_tat - now - capacity * interval
+        if retry_after > 0 then
+            return {0, tostring(retry_after)}
+        end
+        redis.call('SET', KEYS[1], tostring(new_tat), 'PX', math.ceil((new_tat - now) * 1000))
+        return {1, '0'}
+    '''
+
+    def __init__(self, client, prefix: str = 'throttling:'):
+        self.client = client
+        self.prefix = prefix
+        self.script = client.register_script(self.SCRIPT)
+
+    @classmethod
+    def from_url(cls, url: str) -> 'RedisStorage':
+        '''Create the storage from a Redis URI.'''
+        return cls(aioredis.from_url(url))
+
+    async def acquire(self, key: str, interval: float, capacity: float, cost: int = 1) -> tuple[bool, float]:
+        '''Acquire requests for a key, returning whether they are allowed and the seconds to wait before retrying.'''
+        allowed, retry_after = await self.script(keys=[self.prefix + key], args=[interval, capacity, cost])
+        return bool(int(allowed)), float(retry_after)
+
+    async def close(self) -> None:
+        '''Release the storage resources.'''
+        await self.client.close()
@@ -2,28 +2,40 @@
 
 from fastapi import FastAPI
 from fastapi.exceptions import RequestValidationError
-from fastapi_pagination import add_pagination
 
-from config import get_settings
+from config import get_settings, settings_store
 from apis.middleware import api_routers
-from database.startup import start_database
+from database.startup import setup_database
 from helpers.api_routers import APIRouters
 from helpers.api_cors import CrossOrigin
+from helpers.api_responses import ORJSONResponse
 from helpers.api_throttling import Throttling
 from helpers.api_exceptions import ResponseValidationError, request_exception_handler, response_exception_handler
+from helpers.metrics import Metrics
+from helpers.profiling import Profiling
+from helpers.http_requests import http_client
+from security.principals import principal_listener
+from security.tokens import get_key_ring
 
 
 def start_application():
     '''Initiate the FastAPI application.'''
     settings = get_settings()
-    app = FastAPI(title=settings.APP.PROJECT_NAME, version=settings.APP.PROJECT_VERSION)
+    app = FastAPI(title=settings.APP.PROJECT_NAME, version=settings.APP.PROJECT_VERSION, default_response_class=ORJSONResponse)
+    app = Profiling.enable(app)
     app = Throttling.enable(app)
     app = CrossOrigin.enable(app)
+    app = Metrics.enable(app)
     app = APIRouters.include(app, api_routers)
     app.add_exception_handler(RequestValidationError, request_exception_handler)
     app.add_exception_handler(ResponseValidationError, response_exception_handler)
-    add_pagination(app)
-    start_database()
+    app.add_event_handler('startup', settings_store.start)
+    app.add_event_handler('startup', get_key_ring)
+    app.add_event_handler('startup', setup_database)
+    app.add_event_handler('startup', principal_listener.start)
+    app.add_event_handler('shutdown', principal_listener.stop)
+    app.add_event_handler('shutdown', settings_store.stop)
+    app.add_event_handler('shutdown', http_client.close)
     return app
 
 
@@ -2,22 +2,24 @@
 
 from fastapi import HTTPException, Depends, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from jose import JWTError
 
 from apis.schemas.admin import AccessTokenData, Admin
 from database import crud, models
 from database.session import get_db
+from helpers.profiling import profiled
 from security.hashing import SecureHash
+from security.principals import principal_cache
 from security.tokens import JSONWebToken
 
 
 OAUTH2_SCHEME = OAuth2PasswordBearer(tokenUrl='admin/token')
 
 
-def get_admin(db: Session, username: str):
+async def get_admin(db: AsyncSession, username: str):
     '''Retrieve admin from the database.'''
-    return crud.get_object(
+    return await crud.get_object(
         db=db,
         table=models.AdminsTable,
         column=models.AdminsTable.username,
@@ -26,20 +28,31 @@ def get_admin(db: Session, username: str):
     )
 
 
-def authenticate_admin(db: Session, username: str, password: str):
-    '''Authenticate admin credentials (username and password).'''
-    admin = get_admin(db=db, username=username)
-    if not admin or not SecureHash.verify(signature=password, hash=admin.hashed_password):
+async def authenticate_admin(db: AsyncSession, username: str, password: str):
+    '''Authenticate admin credentials (username and password), and upgrade the password hash if it is outdated.'''
+    admin = await get_admin(db=db, username=username)
+    if not admin or not await SecureHash.verify_async(signature=password, hash=admin.hashed_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail='Incorrect username or password',
             headers={'WWW-Authenticate': 'Bearer'},
         )
+
+    if SecureHash.needs_rehash(admin.hashed_password):
+        await crud.update_object(
+            db=db,
+            table=models.AdminsTable,
+            column=models.AdminsTable.username,
+            value=username,
+            data=dict(hashed_password=await SecureHash.create_async(password)),
+            exc_message='Unable to update admin.'
+        )
     return admin
 
 
-async def get_current_admin(db: Session = Depends(get_db), token: str = Depends(OAUTH2_SCHEME)):
-    '''Ensure admin JWT is valid.'''
+@profiled('dependencies')
+async def get_current_admin(db: AsyncSession = Depends(get_db), token: str = Depends(OAUTH2_SCHEME)):
+    '''Ensure admin JWT is valid. The admin is looked up in the principal cache first, then in the database.'''
     creds_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail='Could not validate credentials',
@@ -54,8 +67,11 @@ async def get_current_admin(db: Session = Depends(get_db), token: str = Depends(
         token_data = AccessTokenData(username=username)
     except JWTError as e:
         raise creds_exception from e
-    user = get_admin(db=db, username=token_data.username)
-    return user
+
+    async def load_admin() -> Admin:
+        admin = await get_admin(db=db, username=token_data.username)
+        return Admin(username=admin.username, is_active=admin.is_active)
+    return await principal_cache.load(token_data.username, expires_at=payload['exp'], func=load_admin)
 
 
 async def get_current_active_admin(current_admin: Admin = Depends(get_current_admin)):
@@ -1,15 +1,23 @@
 '''This module manages global application dependencies.'''
 
+import hmac
 import json
-from fastapi import Request, status
-from sqlalchemy.orm import Session
+from fastapi import Depends, HTTPException, Request, status
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from apis.schemas import user
+from config import get_settings
 from helpers.api_exceptions import ResponseValidationError
+from helpers.profiling import profiled
 from database import crud, models
+from database.session import get_db
 from security.hashing import SecureHash
 
 
+SCRAPE_SCHEME = HTTPBearer(auto_error=False)
+
+
 async def verify_request_content(request: Request):
     '''Ensure request content is JSON serializable.'''
 
@@ -20,10 +28,11 @@ async def verify_request_content(request: Request):
     return _json
 
 
-def authenticate_user(db: Session, item: user.UpdateUserRequest):
-    '''Ensure user is authenticated.'''
+@profiled('dependencies')
+async def authenticate_user(item: user.UpdateUserRequest, db: AsyncSession = Depends(get_db)):
+    '''Ensure user is authenticated, and upgrade the password hash if it is outdated.'''
 
-    user = crud.get_object(
+    user = await crud.get_object(
         db=db,
         table=models.UserTable,
         column=models.UserTable.email,
@@ -35,10 +44,30 @@ def authenticate_user(db: Session, item: user.UpdateUserRequest):
             message='Invalid email.'
         )
 
-    if not SecureHash.verify(item.password, user.hashed_password):
+    if not await SecureHash.verify_async(item.password, user.hashed_password):
         raise ResponseValidationError(
             status_code=status.HTTP_401_UNAUTHORIZED,
             message='Invalid password.'
         )
 
+    if SecureHash.needs_rehash(user.hashed_password):
+        await crud.update_object(
+            db=db,
+            table=models.UserTable,
+            column=models.UserTable.email,
+            value=item.email,
+            data=dict(hashed_password=await SecureHash.create_async(item.password))
+        )
+
     return user
+
+
+async def verify_scrape_token(credentials: HTTPAuthorizationCredentials | None = Depends(SCRAPE_SCHEME)):
+    '''Ensure the request carries the static bearer token of the metrics scrape jobs (METRICS.TOKEN), none is accepted while it is not set.'''
+    token = get_settings().METRICS.TOKEN
+    if not token or credentials is None or not hmac.compare_digest(credentials.credentials.encode('utf-8'), token.encode('utf-8')):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail='Could not validate credentials',
+            headers={'WWW-Authenticate': 'Bearer'},
+        )
@@ -1,22 +1,136 @@
 ''' This module manages encryption authentication.'''
 
+import asyncio
+import base64
 import hashlib
 import hmac
+import os
+from concurrent.futures import ThreadPoolExecutor
 
-from config import get_settings
+from config import SecurityConfig, Settings, get_settings, subscribe_settings
 
 
-settings = get_settings()
+class HmacSha3:
+    '''HMAC SHA3-512 keyed hash scheme. Its hashes are stored as bare hex digests, without a prefix.'''
+
+    name = 'hmac-sha3-512'
+
+    def __init__(self, key: str):
+        self.key = key.encode('utf-8')
+
+    def create(self, text: str) -> str:
+        '''Create a hash.'''
+        return hmac.new(key=self.key, msg=text.encode('utf-8'), digestmod=hashlib.sha3_512).hexdigest()
+
+    def verify(self, text: str, hash: str) -> bool:
+        '''Verify if text-hash pair is valid, in constant time.'''
+        return hmac.compare_digest(hash, self.create(text))
+
+    def needs_update(self, hash: str) -> bool:  # pylint: disable=[W0613]
+        '''Check if a hash has been created with other parameters.'''
+        return False
+
+
+class Scrypt:
+    '''Scrypt key derivation scheme with tunable cost. Its hashes are stored as scrypt$n=<n>,r=<r>,p=<p>$<salt>$<key>'''
+
+    name = 'scrypt'
+
+    def __init__(self, cost: int, block_size: int, parallelism: int, salt_size: int = 16, key_size: int = 64):
+        self.cost = cost
+        self.block_size = block_size
+        self.parallelism = parallelism
+        self.salt_size = salt_size
+        self.key_size = key_size
+
+    @property
+    def params(self) -> dict:
+        '''Scrypt parameters, as named by the stored hashes.'''
+        return dict(n=self.cost, r=self.block_size, p=self.parallelism)
+
+    @staticmethod
+    def derive(text: str, salt: bytes, params: dict, key_size: int) -> bytes:
+        '''Derive a key from a text, OpenSSL releases the GIL while deriving it.'''
+        maxmem = 256 * params['n'] * params['r'] + 1024 * 1024
+        return hashlib.scrypt(text.encode('utf-8'), salt=salt, n=params['n'], r=params['r'], p=params['p'], dklen=key_size, maxmem=maxmem)
+
+    @staticmethod
+    def parse(hash: str) -> tuple[dict, bytes, bytes]:
+        '''Split a hash into its parameters, salt and key.'''
+        _, params, salt, key = hash.split('$')
+        params = {k: int(v) for k, v in (x.split('=') for x in params.split(','))}
+        return params, base64.b64decode(salt), base64.b64decode(key)
+
+    def create(self, text: str) -> str:
+        '''Create a hash.'''
+        salt = os.urandom(self.salt_size)
+        key = self.derive(text, salt, self.params, self.key_size)
+        params = ','.join(f'{k}={v}' for k, v in self.params.items())
+        return f'{self.name}${params}${base64.b64encode(salt).decode()}${base64.b64encode(key).decode()}'
+
+    def verify(self, text: str, hash: str) -> bool:
+        '''Verify if text-hash pair is valid, in constant time.'''
+        try:
+            params, salt, key = self.parse(hash)
+        except (KeyError, ValueError):
+            return False
+        return hmac.compare_digest(key, self.derive(text, salt, params, len(key)))
+
+    def needs_update(self, hash: str) -> bool:
+        '''Check if a hash has been created with other parameters.'''
+        params, salt, key = self.parse(hash)
+        return params != self.params or len(salt) != self.salt_size or len(key) != self.key_size
+
+
+def create_schemes(security: SecurityConfig) -> dict[str, HmacSha3 | Scrypt]:
+    '''Create the hashing schemes from the SECURITY settings.'''
+    return {
+        HmacSha3.name: HmacSha3(key=security.JWT_SECRET_KEY),
+        Scrypt.name: Scrypt(cost=security.HASHING.SCRYPT_N, block_size=security.HASHING.SCRYPT_R, parallelism=security.HASHING.SCRYPT_P)
+    }
+
+
+SCHEMES = create_schemes(get_settings().SECURITY)
+EXECUTOR = ThreadPoolExecutor(max_workers=get_settings().SECURITY.HASHING.WORKERS, thread_name_prefix='hashing')
+
+
+@subscribe_settings
+def reconfigure_hashing(old: Settings, new: Settings) -> None:
+    '''Update the hashing schemes and the thread pool size when their settings change.'''
+    global EXECUTOR  # pylint: disable=[W0603]
+    if (new.SECURITY.HASHING, new.SECURITY.JWT_SECRET_KEY) != (old.SECURITY.HASHING, old.SECURITY.JWT_SECRET_KEY):
+        SCHEMES.update(create_schemes(new.SECURITY))
+    if new.SECURITY.HASHING.WORKERS != old.SECURITY.HASHING.WORKERS:
+        previous, EXECUTOR = EXECUTOR, ThreadPoolExecutor(max_workers=new.SECURITY.HASHING.WORKERS, thread_name_prefix='hashing')
+        previous.shutdown(wait=False)
 
 
 class SecureHash:
     '''Secure Hash Algorithm (SHA) class.'''
 
-    def create(text: str):
+    def scheme(hash: str | None = None) -> HmacSha3 | Scrypt:
+        '''Get the scheme a hash has been created with, or the default scheme.'''
+        if hash is None:
+            return SCHEMES[get_settings().SECURITY.HASHING.ALGORITHM]
+        return SCHEMES.get(hash.split('$', 1)[0], SCHEMES[HmacSha3.name])
+
+    def create(text: str) -> str:
         '''Create a encripted hash.'''
-        key = settings.SECURITY.JWT_SECRET_KEY.encode('utf-8')
-        return hmac.new(key=key, msg=text.encode('utf-8'), digestmod=hashlib.sha3_512).hexdigest()
+        return SecureHash.scheme().create(text)
 
-    def verify(signature: str, hash: str):
+    def verify(signature: str, hash: str) -> bool:
         '''Verify if signature-hash pair is valid.'''
-        return bool(hash == SecureHash.create(signature))
+        return SecureHash.scheme(hash).verify(signature, hash)
+
+    def needs_rehash(hash: str) -> bool:
+        '''Check if a hash must be upgraded to the default scheme and parameters.'''
+        scheme = SecureHash.scheme(hash)
+        return scheme is not SecureHash.scheme() or scheme.needs_update(hash)
+
+    async def create_async(text: str) -> str:
+        '''Create a encripted hash in the hashing thread pool, without blocking the event loop.'''
+        return await asyncio.get_running_loop().run_in_executor(EXECUTOR, SecureHash.create, text)
+
+    async def verify_async(signature: str, hash: str) -> bool:
+        '''Verify if signature-hash pair is valid in the hashing thread pool, without blocking the event loop.'''
+        return await asyncio.get_running_loop().run_in_executor(EXECUTOR, SecureHash.verify, signature, hash)
@@ -0,0 +1,140 @@
+'''This module caches authenticated admin principals, so that authenticated requests skip the admin database lookup.
+Entries live until their token expires (or the configured TTL), and are invalidated across worker processes through PostgreSQL LISTEN/NOTIFY.'''
+
+import asyncio
+import time
+from typing import Awaitable, Callable
+import asyncpg
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from apis.schemas.admin import Admin
+from config import Settings, get_settings, subscribe_settings
+from helpers.lru_caching import SingleFlight, TTLCache
+
+
+CHANNEL = 'admin_principals'
+
+
+class PrincipalCache:
+    '''In-process LRU cache of admin principals, concurrent misses of the same principal are loaded once.
+    Every invalidation starts a new epoch: the principals loaded in an earlier epoch are not cached, since they may be stale.
+    Principals are not cached either while the cache is paused, i.e. while invalidations can not be received.'''
+
+    def __init__(self, ttl: float, maxsize: int):
+        self.ttl = ttl
+        self.cache = TTLCache(ttl=ttl, maxsize=maxsize)
+        self.flight = SingleFlight()
+        self.epoch = 0
+        self.paused = False
+
+    def get(self, username: str) -> Admin | None:
+        '''Get a cached principal, if it has not expired.'''
+        return self.cache.get(username)
+
+    def set(self, principal: Admin, expires_at: float, epoch: int | None = None) -> None:
+        '''Cache a principal until the token expiration timestamp, bounded by the cache TTL, unless it has been loaded in an earlier epoch.'''
+        if self.paused or (epoch is not None and epoch != self.epoch):
+            return
+        self.cache.set(principal.username, principal, ttl=min(self.ttl, expires_at - time.time()))
+
+    async def load(self, username: str, expires_at: float, func: Callable[[], Awaitable[Admin]]) -> Admin:
+        '''Get a cached principal, or load and cache it once for the concurrent requests of the same principal and epoch.'''
+        principal = self.get(username)
+        if principal is not None:
+            return principal
+
+        epoch = self.epoch
+
+        async def compute() -> Admin:
+            principal = await func()
+            self.set(principal, expires_at=expires_at, epoch=epoch)
+            return principal
+        return await self.flight.call_async((username, epoch), compute)
+
+    def invalidate(self, username: str) -> None:
+        '''Remove a principal from the cache.'''
+        self.epoch += 1
+        self.cache.invalidate(username)
+
+    def clear(self) -> None:
+        '''Remove all principals from the cache.'''
+        self.epoch += 1
+        self.cache.clear()
+
+    def pause(self) -> None:
+        '''Remove all principals from the cache, and stop caching them until it is resumed.'''
+        self.paused = True
+        self.clear()
+
+    def resume(self) -> None:
+        '''Cache principals again, from a new epoch.'''
+        self.clear()
+        self.paused = False
+
+    def info(self) -> dict:
+        '''Get the cache statistics.'''
+        return self.cache.info()
+
+
+class PrincipalListener:
+    '''Listen to principal invalidations broadcast by other worker processes, on a dedicated database connection.'''
+
+    RECONNECT_DELAY = 5  # seconds
+
+    def __init__(self, cache: PrincipalCache):
+        self.cache = cache
+        self.connection: asyncpg.Connection | None = None
+        self.task: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        '''Open the listening connection, retrying in background if the database is unreachable.
+        Principals are cached from a new epoch once it listens, the invalidations sent while it did not are lost.'''
+        try:
+            self.connection = await asyncpg.connect(get_settings().DATABASE.BASE_URL)
+            self.connection.add_termination_listener(self.on_termination)
+            await self.connection.add_listener(CHANNEL, self.on_notification)
+        except (OSError, asyncpg.PostgresError):
+            self.on_termination(self.connection)
+            return
+        self.cache.resume()
+
+    async def stop(self) -> None:
+        '''Close the listening connection.'''
+        if self.task:
+            self.task.cancel()
+        if self.connection and not self.connection.is_closed():
+            self.connection.remove_termination_listener(self.on_termination)
+            await self.connection.close()
+
+    def on_notification(self, connection, pid, channel, payload) -> None:  # pylint: disable=[W0613]
+        '''Invalidate the principal named by a notification.'''
+        self.cache.invalidate(payload)
+
+    def on_termination(self, connection) -> None:  # pylint: disable=[W0613]
+        '''Drop every principal and stop caching them while invalidations cannot be received, then reconnect.'''
+        self.cache.pause()
+        self.task = asyncio.create_task(self.reconnect())
+
+    async def reconnect(self) -> None:
+        '''Reconnect after a delay.'''
+        await asyncio.sleep(self.RECONNECT_DELAY)
+        await self.start()
+
+
+async def broadcast_invalidation(db: AsyncSession, username: str) -> None:
+    '''Notify every worker process to invalidate a principal, once the current transaction commits.'''
+    await db.execute(text('SELECT pg_notify(:channel, :username)'), dict(channel=CHANNEL, username=username))
+
+
+principal_cache = PrincipalCache(ttl=get_settings().SECURITY.PRINCIPAL_CACHE.TTL, maxsize=get_settings().SECURITY.PRINCIPAL_CACHE.MAXSIZE)
+principal_listener = PrincipalListener(cache=principal_cache)
+
+
+@subscribe_settings
+def reconfigure_principal_cache(old: Settings, new: Settings) -> None:
+    '''Apply the principal cache settings, cached principals are dropped when they change.'''
+    if new.SECURITY.PRINCIPAL_CACHE != old.SECURITY.PRINCIPAL_CACHE:
+        principal_cache.ttl = principal_cache.cache.ttl = new.SECURITY.PRINCIPAL_CACHE.TTL
+        principal_cache.cache.maxsize = new.SECURITY.PRINCIPAL_CACHE.MAXSIZE
+        principal_cache.clear()
@@ -1,12 +1,77 @@
 '''This module manages the creation of JWTs.'''
 
 from datetime import datetime, timedelta
-from jose import jwt
+from functools import lru_cache
+from jose import jwk, jwt, JWTError
 
-from config import get_settings
+from config import SecurityConfig, Settings, get_settings, subscribe_settings
 
 
-settings = get_settings()
+DEFAULT_KID = 'default'  # key of the tokens issued without a kid header
+
+
+class SigningKey:
+    '''JWT key parsed once: tokens are signed with its private (or secret) key and verified with its public (or secret) key.
+    A ValueError is raised if it can not verify tokens: HS keys need their secret key, the other ones a private or a public key.'''
+
+    def __init__(self, kid: str, algorithm: str, key: str | None = None, public_key: str | None = None):
+        if not key and (algorithm.startswith('HS') or not public_key):
+            raise ValueError(f'JWT key {kid} needs a {"secret key" if algorithm.startswith("HS") else "private or public key"} ({algorithm}).')
+        self.kid = kid
+        self.algorithm = algorithm
+        self.private = jwk.construct(key, algorithm) if key else None
+        if public_key:
+            self.public = jwk.construct(public_key, algorithm)
+        elif algorithm.startswith('HS'):
+            self.public = self.private
+        else:
+            self.public = self.private.public_key()
+
+    @property
+    def can_sign(self) -> bool:
+        '''Check if tokens can be signed with this key, retiring keys only verify tokens.'''
+        return self.private is not None
+
+
+class KeyRing:
+    '''JWT key ring, keys are selected by the kid header so that old and new keys overlap during rotation.'''
+
+    def __init__(self, keys: list[SigningKey], active_kid: str):
+        self.keys = {k.kid: k for k in keys}
+        if active_kid not in self.keys or not self.keys[active_kid].can_sign:
+            raise ValueError(f'The active JWT key {active_kid} must be in the key ring, with a private key.')
+        self.active = self.keys[active_kid]
+
+    @classmethod
+    def from_settings(cls, security: SecurityConfig) -> 'KeyRing':
+        '''Load the key ring from the SECURITY settings, or a single key from JWT_SECRET_KEY and JWT_ALGORITHM.'''
+        keys = [SigningKey(kid=k.KID, algorithm=k.ALGORITHM, key=k.KEY, public_key=k.PUBLIC_KEY) for k in security.JWT_KEYS]
+        if not keys:
+            keys = [SigningKey(kid=DEFAULT_KID, algorithm=security.JWT_ALGORITHM, key=security.JWT_SECRET_KEY)]
+        return cls(keys=keys, active_kid=security.JWT_ACTIVE_KID or keys[0].kid)
+
+    def get(self, kid: str | None) -> SigningKey:
+        '''Get the key that verifies a token.'''
+        try:
+            return self.keys[kid or DEFAULT_KID]
+        except KeyError as e:
+            raise JWTError('Unknown JWT key.') from e
+
+
+@lru_cache(maxsize=1)
+def get_key_ring() -> KeyRing:
+    '''Parse the JWT keys once.'''
+    return KeyRing.from_settings(get_settings().SECURITY)
+
+
+@subscribe_settings
+def reload_key_ring(old: Settings, new: Settings) -> None:
+    '''Parse the JWT keys again when they change, so that keys can be rotated without a restart.'''
+    fields = ['JWT_ALGORITHM', 'JWT_SECRET_KEY', 'JWT_ACTIVE_KID', 'JWT_KEYS']
+    if any(getattr(old.SECURITY, x) != getattr(new.SECURITY, x) for x in fields):
+        KeyRing.from_settings(new.SECURITY)  # invalid keys raise before the current key ring is dropped
+        get_key_ring.cache_clear()
+        get_key_ring()
 
 
 class JSONWebToken:
@@ -14,11 +79,13 @@ class JSONWebToken:
 
     def create(data: dict):
         '''Create a JWT token.'''
-        expire = datetime.utcnow() + timedelta(minutes=int(settings.SECURITY.JWT_EXPIRE_MINUTES))
+        key = get_key_ring().active
+        expire = datetime.utcnow() + timedelta(minutes=get_settings().SECURITY.JWT_EXPIRE_MINUTES)
         to_encode = data.copy()
         to_encode.update({'exp': expire})
-        return jwt.encode(to_encode, settings.SECURITY.JWT_SECRET_KEY, algorithm=settings.SECURITY.JWT_ALGORITHM)
+        return jwt.encode(to_encode, key.private, algorithm=key.algorithm, headers={'kid': key.kid})
 
     def decode(token: str):
         '''Decode a JWT token.'''
-        return jwt.decode(token, settings.SECURITY.JWT_SECRET_KEY, algorithms=[settings.SECURITY.JWT_ALGORITHM])
+        key = get_key_ring().get(jwt.get_unverified_header(token).get('kid'))
+        return jwt.decode(token, key.public, algorithms=[key.algorithm])
@@ -0,0 +1,24 @@
+'''This module performs Unit tests on the following directory: ./apis/'''
+
+import unittest
+
+from apis.routers.admin_farms import kept_missing_farms
+
+
+class AdminFarmsTest(unittest.TestCase):
+    '''Test the following file functions: ../routers/admin_farms.py'''
+
+    def setUp(self):
+        '''Configure test inputs.'''
+        self.report = dict(rows=3, valid=3, rejected=0, errors=[])
+
+    def tearDown(self):
+        '''Reset test inputs.'''
+        self.report = None
+
+    def test_kept_missing_farms(self):
+        '''Test that missing farms are only deactivated from a complete, non-empty dataset.'''
+        self.assertIsNone(kept_missing_farms(self.report))
+        self.assertEqual(kept_missing_farms(dict(self.report, valid=2, rejected=1)), 'some rows are invalid')
+        self.assertEqual(kept_missing_farms(dict(self.report, rows=0, valid=0)), 'the dataset is empty')
+        self.assertEqual(kept_missing_farms(dict(self.report, rows=1, valid=0, rejected=1)), 'some rows are invalid')
@@ -0,0 +1,86 @@
+'''This module performs Unit tests on the following file: ./config.py'''
+
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+from pydantic import ValidationError
+
+from config import SettingsStore, load_settings
+
+
+class SettingsTest(unittest.TestCase):
+    '''Test the following file functions: ../../config.py'''
+
+    def setUp(self):
+        '''Configure test inputs.'''
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'config.yaml')
+        shutil.copy('config.yaml', self.path)
+
+    def tearDown(self):
+        '''Reset test inputs.'''
+        self.directory.cleanup()
+        self.path = None
+
+    def edit(self, old: str, new: str):
+        '''Replace a value of the test config file.'''
+        with open(self.path, encoding='utf-8') as f:
+            config = f.read()
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.write(config.replace(old, new))
+
+    def test_load(self):
+        '''Test that settings are typed, derived and immutable.'''
+        settings = load_settings(self.path)
+        self.assertEqual(settings.API.PREFIX, '/api/v1')
+        self.assertIsInstance(settings.DATABASE.POOL.SIZE, int)
+        self.assertTrue(settings.DATABASE.ASYNC_URL.startswith('postgresql+asyncpg://'))
+        self.assertEqual(settings.THROTTLING.POLICIES[0].LIMITS, ('10/minute',))
+        self.assertRaises(TypeError, setattr, settings.DATABASE.POOL, 'SIZE', 1)
+
+    def test_validation(self):
+        '''Test that invalid settings are rejected.'''
+        for old, new in [('SIZE: 5', 'SIZE: 0'), ('SCRYPT_N: 16384', 'SCRYPT_N: 1000'), ("['10/minute']", "['10/week']"), ('KEY: user', 'KEY: email')]:
+            shutil.copy('config.yaml', self.path)
+            self.edit(old, new)
+            self.assertRaises(ValidationError, load_settings, self.path)
+
+    def test_jwt_keys(self):
+        '''Test that JWT keys are rejected without a key that can verify tokens.'''
+        for key, valid in [('KEY: secret', True), ('PUBLIC_KEY: pem', False), ('KEY:', False)]:
+            shutil.copy('config.yaml', self.path)
+            self.edit('JWT_KEYS: []', f'JWT_KEYS: [{{KID: a, ALGORITHM: HS256, {key}}}]')
+            if valid:
+                self.assertEqual(load_settings(self.path).SECURITY.JWT_KEYS[0].KEY, 'secret')
+            else:
+                self.assertRaises(ValidationError, load_settings, self.path)
+        for key, valid in [('PUBLIC_KEY: pem', True), ('KEY: pem', True), ('KEY:, PUBLIC_KEY:', False)]:
+            shutil.copy('config.yaml', self.path)
+            self.edit('JWT_KEYS: []', f'JWT_KEYS: [{{KID: a, ALGORITHM: RS256, {key}}}]')
+            if valid:
+                self.assertEqual(load_settings(self.path).SECURITY.JWT_KEYS[0].KID, 'a')
+            else:
+                self.assertRaises(ValidationError, load_settings, self.path)
+
+    def test_reload(self):
+        '''Test that a reload swaps the snapshot and notifies the subscribers, unless the settings are invalid.'''
+        store = SettingsStore(self.path)
+        calls = []
+
+        async def subscriber(old, new):
+            calls.append((old.DATABASE.POOL.SIZE, new.DATABASE.POOL.SIZE))
+        store.subscribe(subscriber)
+
+        self.assertIs(asyncio.run(store.reload()), store.current)
+        self.assertEqual(calls, [])
+
+        self.edit('SIZE: 5', 'SIZE: 7')
+        asyncio.run(store.reload())
+        self.assertEqual(store.current.DATABASE.POOL.SIZE, 7)
+        self.assertEqual(calls, [(5, 7)])
+
+        self.edit('SIZE: 7', 'SIZE: -1')
+        self.assertRaises(ValidationError, asyncio.run, store.reload())
+        self.assertEqual(store.current.DATABASE.POOL.SIZE, 7)
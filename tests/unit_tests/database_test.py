@@ -0,0 +1,310 @@
+'''This module performs Unit tests on the following directory: ./database/'''
+
+import asyncio
+import unittest
+from datetime import datetime, timedelta, timezone
+import numpy as np
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.schema import CreateTable
+
+from config import QueriesConfig, get_settings
+from database import crud, models
+from database.pool import PoolStatistics
+from database.query_log import QueryBudgets, after_query, before_query, current_operation, instrumented, normalize, redact
+from database.snapshot import TableSnapshot
+from helpers.metrics import RequestMetrics, current_request
+from helpers.api_exceptions import ResponseValidationError
+
+
+class SessionStandIn:
+    '''Database session that records the executed statements, each of them returns 1 row.'''
+
+    def __init__(self):
+        self.statements = []
+        self.commits = 0
+
+    async def execute(self, statement):
+        '''Record a statement.'''
+        self.statements.append(statement)
+        return type('Result', (), dict(all=lambda self: [('row',)], first=lambda self: (3, 1)))()
+
+    async def commit(self):
+        '''Count the commits.'''
+        self.commits += 1
+
+
+class CrudTest(unittest.TestCase):
+    '''Test the following file functions: ../crud.py'''
+
+    def setUp(self):
+        '''Configure test inputs.'''
+        self.timestamp = datetime(2022, 11, 20, 10, 30, tzinfo=timezone.utc)
+
+    def tearDown(self):
+        '''Reset test inputs.'''
+        self.timestamp = None
+
+    def test_cursor(self):
+        '''Test the keyset pagination cursor encoding.'''
+        cursor = crud.encode_cursor('id', 42, 42)
+        self.assertIsInstance(cursor, str)
+        self.assertEqual(crud.decode_cursor(cursor, 'id'), (42, 42))
+
+        cursor = crud.encode_cursor('updated_at', self.timestamp, 7)
+        self.assertEqual(crud.decode_cursor(cursor, 'updated_at'), (self.timestamp, 7))
+
+    def test_invalid_cursor(self):
+        '''Test that tampered cursors are rejected.'''
+        cursor = crud.encode_cursor('id', 42, 42)
+        with self.assertRaises(ResponseValidationError):
+            crud.decode_cursor(cursor, 'updated_at')
+        with self.assertRaises(ResponseValidationError):
+            crud.decode_cursor('not-a-cursor', 'id')
+
+    def test_version(self):
+        '''Test that a table version is read from its version row, without reading the table.'''
+        session = SessionStandIn()
+        self.assertEqual(asyncio.run(crud.get_version(db=session, table=models.FarmsTable)), (3, 1))
+        sql = str(session.statements[0].compile(dialect=postgresql.dialect()))
+        self.assertIn('FROM table_versions \nWHERE table_versions.name = %(name_1)s', sql)
+        self.assertNotIn('farms.', sql)
+
+    def test_insert_objects(self):
+        '''Test that each batch is 1 multi-row INSERT skipping existing objects, committed once.'''
+        session = SessionStandIn()
+
+        async def batches():
+            yield [dict(email='a@b.com', hashed_password='x', is_active=True), dict(email='c@d.com', hashed_password='y', is_active=True)]
+            yield []
+            yield [dict(email='e@f.com', hashed_password='z', is_active=True)]
+
+        rows = asyncio.run(crud.insert_objects(db=session, table=models.UserTable, batches=batches(), conflict=['email'], returning=['email']))
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(session.commits, 1)
+        sql = [str(x.compile(dialect=postgresql.dialect())) for x in session.statements]
+        self.assertEqual(len(sql), 3)
+        self.assertIn('VALUES (%(email_m0)s', sql[0])
+        self.assertIn('(%(email_m1)s', sql[0])
+        self.assertIn('ON CONFLICT (email) DO NOTHING RETURNING users.email', sql[0])
+        self.assertIn('INSERT INTO table_versions', sql[2])
+        self.assertIn('ON CONFLICT (name) DO UPDATE SET version = (table_versions.version + ', sql[2])
+
+
+class SnapshotStandIn(TableSnapshot):
+    '''Snapshot of an in-memory table, with the running transactions of the database.'''
+
+    def __init__(self):
+        super().__init__(table=type('Table', (), dict(__tablename__='things')), columns=dict(id='int', name='str', updated_at='datetime'))
+        self.rows: dict[int, dict] = {}
+        self.writes, self.deletes = 0, 0
+        self.transactions: list[datetime] = []  # start times
+        self.fetched: list[datetime | None] = []
+        self.chunks = 0
+
+    async def state(self, db):
+        '''Table version and start time of the oldest running transaction.'''
+        return (self.writes, self.deletes), min(self.transactions, default=None)
+
+    async def fetch(self, db, since=None):
+        '''Rows updated after a time ordered by id, 2 rows at once.'''
+        self.fetched.append(since)
+        rows = [self.rows[x] for x in sorted(self.rows) if since is None or self.rows[x]['updated_at'] > since]
+        for start in range(0, len(rows), 2):
+            self.chunks += 1
+            yield {name: [x[name] for x in rows[start:start + 2]] for name in ('id', 'name', 'updated_at')}
+
+
+class SnapshotTest(unittest.TestCase):
+    '''Test the following file functions: ../snapshot.py'''
+
+    def setUp(self):
+        '''Configure test inputs.'''
+        self.snapshot = SnapshotStandIn()
+        self.time = lambda second: datetime(2022, 11, 20, 10, 30, second, tzinfo=timezone.utc)
+
+    def tearDown(self):
+        '''Reset test inputs.'''
+        self.snapshot = None
+        self.time = None
+
+    def write(self, id_: int, name: str, second: int):
+        '''Commit a row updated at a time.'''
+        self.snapshot.rows[id_] = dict(id=id_, name=name, updated_at=self.time(second))
+        self.snapshot.writes += 1
+
+    def delete(self, id_: int):
+        '''Commit the delete of a row.'''
+        del self.snapshot.rows[id_]
+        self.snapshot.writes += 1
+        self.snapshot.deletes += 1
+
+    def test_refresh(self):
+        '''Test that nothing is fetched while the version is unchanged, and that deletes reload the snapshot.'''
+        self.write(1, 'a', 1)
+        asyncio.run(self.snapshot.refresh(None))
+        asyncio.run(self.snapshot.refresh(None))
+        self.assertEqual(self.snapshot.fetched, [None])
+        self.write(1, 'b', 2)
+        asyncio.run(self.snapshot.refresh(None))
+        self.assertEqual(self.snapshot.fetched, [None, self.time(1)])
+        self.assertEqual(self.snapshot.data.rows(np.arange(1))[0]['name'], 'b')
+
+        self.delete(1)
+        asyncio.run(self.snapshot.refresh(None))
+        self.assertEqual(self.snapshot.fetched, [None, self.time(1), None])
+        self.assertEqual(len(self.snapshot.data), 0)
+
+    def test_chunks(self):
+        '''Test that the snapshot is loaded chunk by chunk, and that the watermark is the latest update time of every chunk.'''
+        for id_, second in ((1, 3), (2, 9), (3, 1), (4, 2), (5, 4)):
+            self.write(id_, 'a', second)
+        asyncio.run(self.snapshot.refresh(None))
+        self.assertEqual(self.snapshot.chunks, 3)
+        self.assertEqual(len(self.snapshot.data), 5)
+        self.assertEqual(self.snapshot.watermark, self.time(9))
+        self.assertEqual(self.snapshot.stats['last_rows'], 5)
+
+    def test_out_of_order_commit(self):
+        '''Test that a row with an older updated_at committed after a newer one is fetched from the watermark.'''
+        self.write(1, 'a', 1)
+        self.write(2, 'b', 2)
+        asyncio.run(self.snapshot.refresh(None))
+
+        self.snapshot.transactions.append(self.time(5))  # long transaction, its rows are updated at its start time
+        self.write(1, 'c', 10)
+        asyncio.run(self.snapshot.refresh(None))
+        self.assertEqual(self.snapshot.watermark, self.time(5) - timedelta(microseconds=1))
+
+        self.snapshot.transactions.clear()
+        self.write(2, 'd', 5)  # committed, the latest update time is unchanged
+        asyncio.run(self.snapshot.refresh(None))
+        self.assertEqual(self.snapshot.fetched[-1], self.time(5) - timedelta(microseconds=1))
+        self.assertEqual(self.snapshot.data.rows(self.snapshot.data.filter(dict(id=2)))[0]['name'], 'd')
+        self.assertEqual(self.snapshot.version, (4, 0))
+
+        fetched = len(self.snapshot.fetched)
+        asyncio.run(self.snapshot.refresh(None))
+        self.assertEqual(len(self.snapshot.fetched), fetched)
+
+
+class ModelsTest(unittest.TestCase):
+    '''Test the following file functions: ../models.py'''
+
+    def test_content_hash(self):
+        '''Test that farms are unique by FarmId, and that their content hash is generated by PostgreSQL from every content column.'''
+        ddl = str(CreateTable(models.FarmsTable.__table__).compile(dialect=postgresql.dialect()))
+        self.assertIn('UNIQUE ("FarmId")', ddl)
+        self.assertIn('"ContentHash" VARCHAR GENERATED ALWAYS AS (md5(', ddl)
+        self.assertIn('"IsActive"::text', ddl)
+        self.assertNotIn('"FarmId"::text', ddl)
+
+
+class PoolTest(unittest.TestCase):
+    '''Test the following file functions: ../pool.py'''
+
+    def setUp(self):
+        '''Configure test inputs.'''
+        self.stats = PoolStatistics()
+        self.pool = QueuePool(creator=lambda: None, pool_size=3, max_overflow=2)
+
+    def tearDown(self):
+        '''Reset test inputs.'''
+        self.stats = None
+        self.pool = None
+
+    def test_snapshot(self):
+        '''Test the pool gauges and the checkout wait histogram.'''
+        for seconds in [0.0005, 0.002, 0.2, 30]:
+            self.stats.observe_checkout(seconds)
+        self.stats.observe_timeout()
+
+        data = self.stats.snapshot(self.pool)
+        self.assertEqual(data['size'], 3)
+        self.assertEqual(data['checked_out'], 0)
+        self.assertEqual(data['overflow'], 0)
+        self.assertEqual(data['checkouts'], 4)
+        self.assertEqual(data['checkout_timeouts'], 1)
+        self.assertEqual(data['wait_seconds_histogram']['0.001'], 1)
+        self.assertEqual(data['wait_seconds_histogram']['0.25'], 3)
+        self.assertEqual(data['wait_seconds_histogram']['+Inf'], 4)
+
+        self.stats.reset()
+        self.assertEqual(self.stats.snapshot(self.pool)['checkouts'], 0)
+
+
+class QueryLogTest(unittest.TestCase):
+    '''Test the following file functions: ../query_log.py'''
+
+    def setUp(self):
+        '''Configure test inputs.'''
+        self.config = QueriesConfig(BUDGET=5, BUDGETS=[dict(ROUTE='/admin/farms', MAX=20), dict(ROUTE='/admin/farms/export')])
+        self.request = RequestMetrics(dict(type='http', method='GET', path='/nowhere'))
+        self.token = current_request.set(self.request)
+
+    def tearDown(self):
+        '''Reset test inputs.'''
+        current_request.reset(self.token)
+        self.config = None
+        self.request = None
+
+    def test_normalize(self):
+        '''Test that literals and placeholders are replaced, and that lists and repeated rows are collapsed.'''
+        self.assertEqual(
+            normalize("SELECT count_1 FROM t1\n  WHERE name = 'it''s' AND id IN ($1, $2, $3) AND kind::text = :kind LIMIT 10"),
+            'SELECT count_1 FROM t1 WHERE name = ? AND id IN (...) AND kind::text = ? LIMIT ?'
+        )
+        self.assertEqual(normalize('INSERT INTO t (a, b) VALUES (%s, %s), (%s, %s), (%s, %s)'), 'INSERT INTO t (a, b) VALUES (...), ...')
+
+    def test_redact(self):
+        '''Test that parameters are described by their types only.'''
+        self.assertEqual(redact(('secret', 42, None)), '(str, int, NoneType)')
+        self.assertEqual(redact(dict(password='secret')), '(password: str)')
+        self.assertEqual(redact(list(range(12))), '(int, int, int, int, int, int, int, int, int, int, +2 more)')
+        self.assertEqual(redact(None), '()')
+
+    def test_budgets(self):
+        '''Test that the longest matching route prefix wins, and that budgets are reloaded with the settings.'''
+        budgets = QueryBudgets()
+        self.assertEqual(budgets.get('/admin', self.config), 5)
+        self.assertEqual(budgets.get('/admin/farms/{farm_id}', self.config), 20)
+        self.assertIsNone(budgets.get('/admin/farms/export', self.config))
+        self.assertEqual(budgets.get('/admin/farmsx', self.config), 5)
+        self.assertIsNone(budgets.get('/admin', QueriesConfig()))
+
+    def test_budget_exceeded(self):
+        '''Test that a request over budget is logged once.'''
+        budget = QueryBudgets().get('unmatched', get_settings().QUERIES)
+        if budget is None:
+            self.skipTest('No default query budget.')
+        self.request.queries = budget - 1
+        with self.assertNoLogs('database.query_log'):
+            before_query('SELECT 1')
+        self.request.queries = budget
+        with self.assertLogs('database.query_log') as logs:
+            before_query('SELECT 1')
+            before_query('SELECT 2')
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn(f'GET unmatched: statement {budget + 1} of {budget} allowed', logs.output[0])
+
+    def test_slow_query(self):
+        '''Test that slow statements are logged with their rows, or without when the driver does not report them.'''
+        slow = get_settings().QUERIES.SLOW
+        if slow is None:
+            self.skipTest('No slow statement threshold.')
+        with self.assertNoLogs('database.query_log'):
+            after_query('SELECT 1', (), slow / 2, None)
+        with self.assertLogs('database.query_log') as logs:
+            after_query('SELECT 1', (), slow, None)
+            after_query('DELETE FROM farms WHERE id = $1', (1,), slow, 1)
+        self.assertIn(', - rows) on GET unmatched', logs.output[0])
+        self.assertIn(', 1 rows) on GET unmatched', logs.output[1])
+
+    def test_instrumented(self):
+        '''Test that the statements of a CRUD function are named after it.'''
+        @instrumented
+        async def get_things():
+            return current_operation.get()
+
+        self.assertEqual(asyncio.run(get_things()), 'get_things')
+        self.assertIsNone(current_operation.get())
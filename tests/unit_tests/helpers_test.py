@@ -1,8 +1,40 @@
 '''This module performs Unit tests on the following directory: ./helpers/'''
 
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import threading
+import tempfile
+import time
 import unittest
+import numpy as np
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from decimal import Decimal
+from enum import Enum
+from uuid import UUID
 from pyaml_env import parse_config
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from helpers import misc
+from helpers.lru_caching import SingleFlight, TTLCache, ttl_cache
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Route
+from helpers.api_exceptions import ResponseValidationError
+from helpers.http_requests import CircuitBreaker, CircuitOpenError, HTTPClient, Retry, RetryError, circuit_breaker, coalesce, error_handler
+from helpers.analytics import group_by, group_rows
+from helpers.columnar import ColumnarTable
+from helpers.export import csv_chunks, export_response, ndjson_chunks, select_columns
+from helpers.metrics import MetricsPublisher, MetricsRegistry, merge, render, statement_operation
+from helpers.profiling import Frame, Phase, ProfileRing, StackSampler, current_frame, profiled, server_timing
+from helpers.response_cache import cached_response, response_cache
+from helpers.geo import MAX_RANGES, cell, cell_ranges, haversine, nearest, radius_bbox, within_radius
+from helpers.ingestion import Field, IngestionError, csv_rows, ingest, ndjson_rows, validate
+from helpers.api_throttling import Policy, PolicyTable, RateLimiter, Rule, ThrottlingMiddleware, user_key
+from helpers.throttling_storage import MemoryStorage, RedisStorage, SharedMemoryStorage, gcra
 
 
 class MiscTest(unittest.TestCase):
@@ -48,6 +80,1102 @@ class MiscTest(unittest.TestCase):
         self.assertIsInstance(flat, list)
         self.assertListEqual(flat, self.unpacked_list)
 
+    def test_json(self):
+        '''Test the JSON serializer hook.'''
+        data = dict(at=datetime(2022, 1, 1, tzinfo=timezone.utc), value=Decimal('1.5'), id=UUID(int=1))
+        self.assertEqual(
+            misc.JSONSerializer.dumps(data),
+            b'{"at":"2022-01-01T00:00:00+00:00","value":1.5,"id":"00000000-0000-0000-0000-000000000001"}'
+        )
+        self.assertRaises(TypeError, misc.JSONSerializer.dumps, object())
+
     def test_reading_file(self):
         '''Test if the following files exist and are readable.'''
         assert parse_config(path=self.yaml_)
+
+
+class CachingTest(unittest.TestCase):
+    '''Test the following file functions: ../lru_caching.py'''
+
+    def setUp(self):
+        '''Configure test inputs.'''
+        self.calls = []
+
+    def tearDown(self):
+        '''Reset test inputs.'''
+        self.calls = None
+
+    def test_ttl(self):
+        '''Test that entries expire individually.'''
+        cache = TTLCache(ttl=60)
+        cache.set('short', 1, ttl=0.05)
+        cache.set('long', 2)
+        cache.set('none', None)
+        time.sleep(0.1)
+        self.assertIsNone(cache.get('short'))
+        self.assertEqual(cache.get('long'), 2)
+        self.assertIsNone(cache.get('none', 'missing'))
+        self.assertEqual(cache.info(), dict(hits=2, misses=1, evictions=0, expirations=1, size=2, weight=2.0))
+
+    def test_eviction(self):
+        '''Test the least recently used entries eviction, by size and by weight.'''
+        cache = TTLCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(list(cache.entries), ['a', 'c'])
+
+        cache = TTLCache(maxsize=100, maxweight=10, weigh=len)
+        for key in ['a', 'b', 'c']:
+            cache.set(key, 'x' * 4)
+        self.assertEqual(list(cache.entries), ['b', 'c'])
+        self.assertEqual(cache.info()['evictions'], 1)
+        self.assertEqual(cache.info()['weight'], 8)
+
+    def test_remove_if(self):
+        '''Test that the entries whose key matches a predicate are removed, with their weight.'''
+        cache = TTLCache(maxweight=100, weigh=len)
+        for key in [('admins', 1), ('admins', 2), ('farms', 1)]:
+            cache.set(key, 'x' * 4)
+        self.assertEqual(cache.remove_if(lambda key: key[0] == 'admins'), 2)
+        self.assertEqual(list(cache.entries), [('farms', 1)])
+        self.assertEqual(cache.info()['weight'], 4)
+
+    def test_sync_decorator(self):
+        '''Test that concurrent misses call the function once.'''
+        barrier = threading.Barrier(4)
+
+        @ttl_cache(ttl=60)
+        def square(x):
+            self.calls.append(x)
+            time.sleep(0.1)
+            return x * x
+
+        def call(_):
+            barrier.wait()
+            return square(3)
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(call, range(4)))
+        self.assertEqual(results, [9] * 4)
+        self.assertEqual(square(3), 9)
+        self.assertEqual(self.calls, [3])
+        square.cache_invalidate(3)
+        self.assertEqual(square(3), 9)
+        self.assertEqual(self.calls, [3, 3])
+
+    def test_async_decorator(self):
+        '''Test that concurrent misses await the coroutine function once, and share its exceptions.'''
+        @ttl_cache(ttl=60)
+        async def square(x):
+            self.calls.append(x)
+            await asyncio.sleep(0.05)
+            if x < 0:
+                raise ValueError(x)
+            return x * x
+
+        async def run():
+            results = await asyncio.gather(*[square(3) for _ in range(5)], *[square(-1) for _ in range(2)], return_exceptions=True)
+            return results + [await square(3)]
+
+        results = asyncio.run(run())
+        self.assertEqual(results[:5] + results[-1:], [9] * 6)
+        self.assertTrue(all(isinstance(x, ValueError) for x in results[5:7]))
+        self.assertEqual(self.calls, [3, -1])
+        self.assertEqual(square.cache_info()['hits'], 1)
+
+    def test_single_flight_cancellation(self):
+        '''Test that the waiting tasks run the call again if the first task is cancelled.'''
+        flight = SingleFlight()
+
+        async def compute():
+            self.calls.append(1)
+            await asyncio.sleep(0.05)
+            return 'ok'
+
+        async def run():
+            first = asyncio.create_task(flight.call_async('key', compute))
+            await asyncio.sleep(0)
+            second = asyncio.create_task(flight.call_async('key', compute))
+            await asyncio.sleep(0)
+            first.cancel()
+            return await second
+
+        self.assertEqual(asyncio.run(run()), 'ok')
+        self.assertEqual(self.calls, [1, 1])
+
+
+class RedisStandIn:
+    '''Local stand-in of a Redis client, running the throttling script logic in Python.'''
+
+    def __init__(self):
+        self.data = {}
+
+    def register_script(self, script):
+        '''Return a callable script.'''
+        async def call(keys, args):
+            allowed, tat, retry_after = gcra(self.data.get(keys[0]), time.time(), *args)
+            if allowed:
+                self.data[keys[0]] = tat
+            return [int(allowed), str(retry_after)]
+        return call
+
+    async def close(self):
+        '''Close the client.'''
+
+
+class ThrottlingTest(unittest.TestCase):
+    '''Test the following file functions: ../api_throttling.py, ../throttling_storage.py'''
+
+    def setUp(self):
+        '''Configure test inputs.'''
+        self.directory = tempfile.TemporaryDirectory()
+        self.shm_path = os.path.join(self.directory.name, 'throttling')
+        self.rule = Rule('5/minute')
+        self.policy = Policy(name='default', key='ip', limits=['5/minute'])
+
+    def tearDown(self):
+        '''Reset test inputs.'''
+        self.directory.cleanup()
+        self.shm_path = None
+        self.rule = None
+        self.policy = None
+
+    async def hits(self, limiter, key, n):
+        '''Count the allowed requests out of n.'''
+        return sum([(await limiter.hit(key, self.policy))[0] for _ in range(n)])
+
+    def test_gcra(self):
+        '''Test the burst capacity and the retry delay.'''
+        tat = None
+        for _ in range(5):
+            allowed, tat, _ = gcra(tat, 1000.0, interval=12.0, capacity=5, cost=1)
+            self.assertTrue(allowed)
+        allowed, _, retry_after = gcra(tat, 1000.0, interval=12.0, capacity=5, cost=1)
+        self.assertFalse(allowed)
+        self.assertAlmostEqual(retry_after, 12.0)
+        self.assertTrue(gcra(tat, 1012.0, interval=12.0, capacity=5, cost=1)[0])
+
+    def test_storages(self):
+        '''Test that every storage enforces the limit per key.'''
+        storages = [MemoryStorage(), SharedMemoryStorage(path=self.shm_path, buckets=16), RedisStorage(RedisStandIn())]
+        for storage in storages:
+            limiter = RateLimiter(storage=storage)
+            self.assertEqual(asyncio.run(self.hits(limiter, '1.1.1.1', 8)), 5)
+            self.assertEqual(asyncio.run(self.hits(limiter, '2.2.2.2', 3)), 3)
+            self.assertEqual(limiter.rejections['default'], 3)
+            asyncio.run(storage.close())
+
+    def test_memory_keys(self):
+        '''Test that the in-process storage keeps its most recently used keys only, without rebuilding them.'''
+        storage = MemoryStorage()
+        storage.tats.maxsize = 3
+        limiter = RateLimiter(storage=storage)
+        for key in ['1.1.1.1', '2.2.2.2', '3.3.3.3', '4.4.4.4']:
+            self.assertEqual(asyncio.run(self.hits(limiter, key, 6)), 5)
+        self.assertEqual(storage.tats.info()['size'], 3)
+        self.assertEqual(storage.tats.info()['evictions'], 1)
+        self.assertEqual(asyncio.run(self.hits(limiter, '4.4.4.4', 1)), 0)
+
+    def test_shared_memory_lock(self):
+        '''Test that the event loop keeps running while another worker process holds the bucket lock.'''
+        storage = SharedMemoryStorage(path=self.shm_path, buckets=1)
+        script = 'import fcntl, os, sys, time; fd = os.open(sys.argv[1], os.O_RDWR); fcntl.lockf(fd, fcntl.LOCK_EX); print(flush=True); time.sleep(0.3)'
+        with subprocess.Popen([sys.executable, '-c', script, self.shm_path], stdout=subprocess.PIPE) as holder:
+            holder.stdout.readline()
+
+            async def run():
+                ticks = 0
+
+                async def ticker():
+                    nonlocal ticks
+                    while True:
+                        await asyncio.sleep(0.01)
+                        ticks += 1
+                task = asyncio.create_task(ticker())
+                allowed, _ = await storage.acquire('1.1.1.1', interval=1, capacity=1)
+                task.cancel()
+                return allowed, ticks
+
+            allowed, ticks = asyncio.run(run())
+        self.assertTrue(allowed)
+        self.assertGreater(ticks, 10)
+        asyncio.run(storage.close())
+
+    def test_shared_memory(self):
+        '''Test that worker processes sharing the memory-mapped file share the limit, with and without batching.'''
+        for batch in [1, 2]:
+            path = f'{self.shm_path}-{batch}'
+            workers = [RateLimiter(storage=SharedMemoryStorage(path=path), batch=batch) for _ in range(2)]
+            allowed = sum(asyncio.run(self.hits(worker, '1.1.1.1', 4)) for worker in workers)
+            self.assertEqual(allowed, 5)
+            for worker in workers:
+                asyncio.run(worker.storage.close())
+
+    def test_policies(self):
+        '''Test that routes get the policy of their longest prefix, and the burst of the policy.'''
+        routes = [Route(x, endpoint=lambda request: None) for x in ['/admin/token', '/admin/users', '/user/{id:int}', '/docs']]
+        policies = [Policy(name='/admin', key='admin', limits=['10/minute']), Policy(name='/admin/token', key='ip', limits=['1/second'], burst=3)]
+        table = PolicyTable(routes=routes, policies=policies + [Policy(name='/user', key='user', limits=['1/minute'])], default=self.policy)
+        self.assertEqual(table.get('/admin/token').rules[0].capacity, 3)
+        self.assertEqual(table.get('/admin/users').key, 'admin')
+        self.assertEqual(table.get('/user/1').key, 'user')
+        self.assertIs(table.get('/docs'), self.policy)
+        self.assertIs(table.get('/unknown'), self.policy)
+        self.assertRaises(ValueError, Policy, name='/user', key='email', limits=['1/minute'])
+
+    def test_user_key(self):
+        '''Test that the user email is read from the request body, which is replayed to the application.'''
+        messages = [dict(type='http.request', body=b'{"email": "A@b.com",', more_body=True), dict(type='http.request', body=b' "password": "x"}')]
+
+        async def receive():
+            return messages.pop(0)
+
+        async def read():
+            key, replay = await user_key(receive)
+            return key, [await replay(), await replay()]
+
+        key, replayed = asyncio.run(read())
+        self.assertEqual(key, 'user:a@b.com')
+        self.assertEqual(b''.join(x['body'] for x in replayed), b'{"email": "A@b.com", "password": "x"}')
+
+    def test_user_key_size(self):
+        '''Test that the body is read up to a size only, the rest is still replayed to the application.'''
+        messages = [dict(type='http.request', body=b'{"email": "a@b.com",', more_body=True), dict(type='http.request', body=b' "x": 1}')]
+        received = list(messages)
+
+        async def receive():
+            return messages.pop(0)
+
+        async def read():
+            key, replay = await user_key(receive, max_bytes=10)
+            return key, len(messages), [await replay(), await replay()]
+
+        self.assertEqual(asyncio.run(read()), (None, 1, received))
+
+    def test_user_policy(self):
+        '''Test that the requests of a user policy are limited per IP address too, whatever their email.'''
+        async def app(scope, receive, send):
+            await Response(content=b'ok')(scope, receive, send)
+
+        middleware = ThrottlingMiddleware(app, RateLimiter(storage=MemoryStorage()))
+        middleware.default = Policy(name='default', key='ip', limits=['4/minute'])
+        user = Policy(name='/user/update', key='user', limits=['2/minute'])
+        middleware.table = PolicyTable(routes=[Route('/user/update', endpoint=app)], policies=[user], default=middleware.default)
+
+        async def request(email):
+            messages, statuses = [dict(type='http.request', body=json.dumps(dict(email=email)).encode())], []
+
+            async def receive():
+                return messages.pop(0)
+
+            async def send(message):
+                if message['type'] == 'http.response.start':
+                    statuses.append(message['status'])
+            scope = dict(type='http', method='PUT', path='/user/update', headers=[], client=('1.1.1.1', 1234))
+            await middleware(scope, receive, send)
+            return statuses[0]
+
+        self.assertEqual([asyncio.run(request('a@b.com')) for _ in range(3)], [200, 200, 429])
+        self.assertEqual([asyncio.run(request(f'{x}@b.com')) for x in range(3)], [200, 429, 429])
+        self.assertEqual(middleware.limiter.rejections, Counter({'/user/update': 1, 'default': 2}))
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    '''Local upstream stub: /ok answers 200, /flaky answers 503 twice then 200, /down always answers 503, /slow and /delay* answer after 1 and 0.2 seconds.'''
+
+    hits: dict = {}
+
+    def do_GET(self):  # pylint: disable=[C0103]
+        '''Answer a GET request.'''
+        hits = self.hits[self.path] = self.hits.get(self.path, 0) + 1
+        if self.path == '/slow':
+            time.sleep(1)
+        if self.path.startswith('/delay'):
+            time.sleep(0.2)
+        code = 503 if self.path == '/down' or (self.path == '/flaky' and hits <= 2) else 200
+        self.send_response(code)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        '''Silence the server logs.'''
+
+
+class HTTPRequestsTest(unittest.TestCase):
+    '''Test the following file functions: ../http_requests.py'''
+
+    def setUp(self):
+        '''Configure test inputs.'''
+        StubHandler.hits = {}
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        self.retries = Retry(total=3, backoff_factor=0.05)
+
+    def tearDown(self):
+        '''Reset test inputs.'''
+        self.server.shutdown()
+        self.server.server_close()
+        self.server = None
+        self.url = None
+        self.retries = None
+
+    async def call(self, path, timeout=5, **kwargs):
+        '''Send a GET request to the stub with a new client.'''
+        client = HTTPClient(timeout=timeout, retries=self.retries)
+        try:
+            return await client.get(self.url + path, **kwargs)
+        finally:
+            await client.close()
+
+    def test_retries(self):
+        '''Test that retryable status codes are retried, up to the retry policy.'''
+        self.assertEqual(asyncio.run(self.call('/flaky')).status_code, 200)
+        self.assertEqual(StubHandler.hits['/flaky'], 3)
+        self.assertRaises(RetryError, asyncio.run, self.call('/down'))
+        self.assertEqual(StubHandler.hits['/down'], 4)
+
+    def test_non_blocking_backoff(self):
+        '''Test that the event loop keeps running while a request waits for its retries.'''
+        self.retries = Retry(total=3, backoff_factor=0.2)
+
+        async def run():
+            ticks = 0
+
+            async def ticker():
+                nonlocal ticks
+                while True:
+                    await asyncio.sleep(0.01)
+                    ticks += 1
+            task = asyncio.create_task(ticker())
+            await self.call('/flaky')
+            task.cancel()
+            return ticks
+
+        self.assertGreater(asyncio.run(run()), 0)
+
+    def test_connection_pool(self):
+        '''Test that the requests to the same host share a client.'''
+        client = HTTPClient()
+        self.assertIs(client.client(self.url + '/a'), client.client(self.url + '/b?c=d'))
+        self.assertIsNot(client.client(self.url), client.client('http://localhost:1'))
+        asyncio.run(client.close())
+
+    def test_error_handler(self):
+        '''Test that deadlines and transport errors are mapped to response errors.'''
+        @error_handler
+        async def fetch(url, timeout):
+            response = await HTTPClient(timeout=timeout, retries=self.retries).get(url)
+            response.raise_for_status()
+            return response
+
+        errors = [
+            asyncio.run(fetch(self.url + '/slow', timeout=0.3)),
+            asyncio.run(fetch('http://127.0.0.1:1', timeout=1)),
+            asyncio.run(fetch(self.url + '/down', timeout=5))
+        ]
+        self.assertTrue(all(isinstance(x, ResponseValidationError) for x in errors))
+        self.assertEqual([x.status_code for x in errors], [408, 404, 429])
+        self.assertEqual(asyncio.run(fetch(self.url + '/ok', timeout=1)).status_code, 200)
+
+    def test_circuit_breaker(self):
+        '''Test the closed, open and half-open states transitions.'''
+        breaker = CircuitBreaker(name='upstream', window=4, min_calls=4, error_rate=0.5, latency=1, reset_timeout=0.05)
+        for failed in [False, True, False]:
+            self.assertEqual(breaker.allow(), 0)
+            breaker.record(failed=failed, duration=0.01)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.record(failed=True, duration=0.01)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertIsNone(breaker.allow())
+
+        time.sleep(0.06)
+        trial = breaker.allow()
+        self.assertEqual(trial, 1)
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertIsNone(breaker.allow())
+        breaker.record(failed=False, duration=2, trial=trial)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        time.sleep(0.06)
+        for _ in range(CircuitBreaker.HALF_OPEN_CALLS):
+            trial = breaker.allow()
+            self.assertEqual(trial, 2)
+            breaker.record(failed=False, duration=0.01, trial=trial)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(breaker.snapshot()['opened'], 2)
+
+    def test_circuit_breaker_late_calls(self):
+        '''Test that calls let through before a half-open phase are not counted as its trial calls.'''
+        breaker = CircuitBreaker(name='upstream', window=2, min_calls=2, error_rate=0.5, latency=1, reset_timeout=0.05)
+        late = breaker.allow()
+        for _ in range(2):
+            breaker.record(failed=True, duration=0.01, trial=breaker.allow())
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        time.sleep(0.06)
+        stale = breaker.allow()
+        breaker.release(stale)
+        time.sleep(0.06)
+        breaker.open()
+        time.sleep(0.06)
+        trial = breaker.allow()
+        for call in [late, stale]:
+            breaker.record(failed=False, duration=0.01, trial=call)
+            self.assertEqual((breaker.state, breaker.trials), (CircuitBreaker.HALF_OPEN, 1))
+        self.assertIsNone(breaker.allow())
+        breaker.record(failed=True, duration=0.01, trial=late)
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertEqual(len(breaker.calls), 0)
+
+        breaker.record(failed=False, duration=0.01, trial=trial)
+        self.assertEqual((breaker.state, breaker.trials, len(breaker.calls)), (CircuitBreaker.HALF_OPEN, 0, 1))
+
+    def test_circuit_breaker_decorator(self):
+        '''Test that calls fail fast once the upstream circuit breaker is open.'''
+        self.retries = Retry(total=0)
+
+        @error_handler
+        @circuit_breaker(upstream=f'stub-{self.server.server_port}', window=2, min_calls=2)
+        async def fetch():
+            return await self.call('/down')
+
+        codes = [asyncio.run(fetch()).status_code for _ in range(4)]
+        self.assertEqual(codes, [429, 429, 503, 503])
+        self.assertEqual(StubHandler.hits['/down'], 2)
+        self.assertRaises(CircuitOpenError, asyncio.run, fetch.__wrapped__())
+
+        upstream = f'stub-{self.server.server_port}'
+        circuit_breaker(upstream=upstream, window=2, min_calls=2)(fetch)
+        self.assertRaises(ValueError, circuit_breaker, upstream=upstream, window=5, min_calls=2)
+
+    def test_coalesce(self):
+        '''Test that identical concurrent calls share one upstream call.'''
+        @coalesce
+        async def fetch(path):
+            return await self.call(path)
+
+        async def run():
+            return await asyncio.gather(*[fetch('/delay-a') for _ in range(5)], fetch('/delay-b'))
+
+        responses = asyncio.run(run())
+        self.assertTrue(all(x.status_code == 200 for x in responses))
+        self.assertIs(responses[0], responses[4])
+        self.assertEqual(StubHandler.hits, {'/delay-a': 1, '/delay-b': 1})
+
+    def test_coalesce_arguments(self):
+        '''Test that calls with dict and list arguments, e.g. params or headers, are coalesced by their values.'''
+        @coalesce
+        async def fetch(path, **kwargs):
+            return await self.call(path, **kwargs)
+
+        async def run():
+            return await asyncio.gather(
+                fetch('/delay', params={'a': '1', 'b': ['2', '3']}, headers={'X-Trace': 't'}),
+                fetch('/delay', headers={'X-Trace': 't'}, params={'b': ['2', '3'], 'a': '1'}),
+                fetch('/delay', params={'a': '2', 'b': ['2', '3']}, headers={'X-Trace': 't'})
+            )
+
+        responses = asyncio.run(run())
+        self.assertIs(responses[0], responses[1])
+        self.assertEqual(StubHandler.hits, {'/delay?a=1&b=2&b=3': 1, '/delay?a=2&b=2&b=3': 1})
+
+    def test_coalesce_modules(self):
+        '''Test that functions of the same name in different modules do not share their calls.'''
+        async def fetch(path):
+            return await self.call(path)
+
+        async def fetch_again(path):
+            return await self.call(path)
+
+        fetch_again.__module__, fetch_again.__qualname__ = 'another.module', fetch.__qualname__
+
+        async def run():
+            return await asyncio.gather(coalesce(fetch)('/delay-a'), coalesce(fetch_again)('/delay-a'))
+
+        responses = asyncio.run(run())
+        self.assertIsNot(responses[0], responses[1])
+        self.assertEqual(StubHandler.hits, {'/delay-a': 2})
+
+
+async def chunks(data: bytes, size: int):
+    '''Stream bytes in chunks, as a request body.'''
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+
+async def async_rows(rows: list):
+    '''Yield parsed rows, as an upload.'''
+    for row in rows:
+        yield row
+
+
+async def collect(rows):
+    '''Collect the rows of an asynchronous iterator.'''
+    return [row async for row in rows]
+
+
+class IngestionTest(unittest.TestCase):
+    '''Test the following file functions: ../ingestion.py'''
+
+    def setUp(self):
+        '''Configure test inputs.'''
+        self.fields = [Field('name'), Field('latitude', 'float', minimum=-90, maximum=90), Field('active', 'bool')]
+        self.csv = 'name,latitude,active\n"multi\nline, quoted",1.5,true\nb,95,no\n,x,maybe\n'.encode('utf-8')
+
+    def tearDown(self):
+        '''Reset test inputs.'''
+        self.fields = None
+        self.csv = None
+
+    def test_csv_rows(self):
+        '''Test that CSV records are parsed whatever the chunk boundaries, and that a missing column is rejected.'''
+        for size in [1, 7, len(self.csv)]:
+            rows = asyncio.run(collect(csv_rows(chunks(self.csv, size), required=['name'])))
+            self.assertEqual([x['name'] for x in rows], ['multi\nline, quoted', 'b', ''])
+        self.assertRaises(IngestionError, asyncio.run, collect(csv_rows(chunks(self.csv, 5), required=['email'])))
+
+    def test_ndjson_rows(self):
+        '''Test that NDJSON lines are parsed whatever the chunk boundaries, None for the lines that are not JSON objects.'''
+        data = b'{"name": "a"}\n[1]\n\nnot json\n{"name": "b"}'
+        rows = asyncio.run(collect(ndjson_rows(chunks(data, 3))))
+        self.assertEqual(rows, [{'name': 'a'}, None, None, {'name': 'b'}])
+
+    def test_validate(self):
+        '''Test that each invalid row is reported with the error of each invalid column.'''
+        rows = [dict(name='a', latitude='1.5', active='Yes'), dict(name='b', latitude=95, active='no'), None, dict(latitude='x', active='maybe')]
+        columns, valid, errors = validate(self.fields, rows, offset=10)
+        self.assertEqual(valid.tolist(), [True, False, False, False])
+        self.assertEqual(columns['latitude'][0], 1.5)
+        self.assertTrue(columns['active'][0])
+        self.assertEqual([x['row'] for x in errors], [12, 13, 14])
+        self.assertEqual(list(errors[0]['errors']), ['latitude'])
+        self.assertEqual(list(errors[1]['errors']), ['row'])
+        self.assertEqual(errors[2]['errors']['name'], 'field required')
+        self.assertEqual(list(errors[2]['errors']), ['name', 'latitude', 'active'])
+
+    def test_ingest(self):
+        '''Test that valid rows are written batch by batch, and that the error report is capped.'''
+        written = []
+
+        async def write(records):
+            written.append(records)
+
+        rows = csv_rows(chunks(self.csv, 4))
+        report = asyncio.run(ingest(rows, self.fields, write, batch_size=2, max_errors=1))
+        self.assertEqual((report['rows'], report['valid'], report['rejected']), (3, 1, 2))
+        self.assertEqual(written, [[('multi\nline, quoted', 1.5, True)]])
+        self.assertEqual(len(report['errors']), 1)
+        self.assertGreater(report['rows_per_second'], 0)
+
+    def test_ingest_conflicts(self):
+        '''Test that the records rejected by the writer are reported with their row numbers, in row order.'''
+        async def write(records):
+            return {i: dict(name='it already exists') for i, x in enumerate(records) if x[0] == 'b'}
+
+        rows = [dict(name='a', latitude=1, active=True), dict(name='x', latitude=95, active=True), dict(name='b', latitude=2, active=False)]
+        report = asyncio.run(ingest(async_rows(rows), self.fields, write, batch_size=10))
+        self.assertEqual((report['rows'], report['valid'], report['rejected']), (3, 1, 2))
+        self.assertEqual([x['row'] for x in report['errors']], [2, 3])
+        self.assertEqual(report['errors'][1]['errors'], dict(name='it already exists'))
+
+
+class GeoTest(unittest.TestCase):
+    '''Test the following file functions: ../geo.py'''
+
+    def setUp(self):
+        '''Configure test inputs.'''
+        rng = np.random.default_rng(7)
+        self.latitudes = np.append(rng.uniform(-35, -22, 5000), [10.0, 10.0])
+        self.longitudes = np.append(rng.uniform(16, 33, 5000), [179.95, -179.95])
+        self.cells = np.array([cell(a, b) for a, b in zip(self.latitudes, self.longitudes)])
+        self.fetched = []
+
+    def tearDown(self):
+        '''Reset test inputs.'''
+        self.latitudes = None
+        self.longitudes = None
+        self.cells = None
+        self.fetched = None
+
+    async def fetch(self, bbox):
+        '''Return the points of the cells that overlap a bounding box, as the database does.'''
+        mask = np.zeros(len(self.cells), dtype=bool)
+        for start, end in cell_ranges(bbox):
+            mask |= (self.cells >= start) & (self.cells <= end)
+        self.fetched.append(int(mask.sum()))
+        keys = np.flatnonzero(mask)
+        return keys, self.latitudes[keys], self.longitudes[keys]
+
+    def test_cell_ranges(self):
+        '''Test that the cell ranges are merged, wrap around the 180th meridian, and are coarsened for large areas.'''
+        self.assertEqual(cell_ranges((0, -180, 0.05, 180)), [(cell(0, -180), cell(0, 180))])
+        self.assertEqual(cell_ranges((10, 179.9, 10.05, -179.9)), [(cell(10, -180), cell(10, -179.9)), (cell(10, 179.9), cell(10, 180))])
+        self.assertEqual(len(cell_ranges((-10, 0, 10, 1))), 201)
+        self.assertLessEqual(len(cell_ranges((-12.8, 0, 12.8, 1))), MAX_RANGES)
+        self.assertEqual(cell_ranges((-80, 0, 80, 1)), [(cell(-80, 0), cell(80, 1))])
+
+    def test_radius_bbox(self):
+        '''Test that a circle fits in its bounding box.'''
+        min_lat, min_lon, max_lat, max_lon = radius_bbox(-29, 30, 100)
+        self.assertAlmostEqual(haversine(-29, 30, np.array([max_lat]), np.array([30]))[0], 100)
+        self.assertAlmostEqual(haversine(-29, 30, np.array([-29.0]), np.array([max_lon]))[0], 100, delta=1)
+        self.assertLess(min_lat, -29)
+        self.assertLess(min_lon, 30)
+        self.assertEqual(radius_bbox(89, 0, 500)[1:4:2], (-180.0, 180.0))
+        self.assertGreater(radius_bbox(10, 179.9, 50)[1], radius_bbox(10, 179.9, 50)[3])
+
+    def test_within_radius(self):
+        '''Test that radius queries match a brute force search, while reading only the overlapped cells.'''
+        distances = haversine(-29, 30, self.latitudes, self.longitudes)
+        found = asyncio.run(within_radius(self.fetch, -29, 30, 50))
+        self.assertEqual(sorted(x[0] for x in found), np.flatnonzero(distances <= 50).tolist())
+        self.assertEqual([x[1] for x in found], sorted(x[1] for x in found))
+        self.assertLess(self.fetched[0], len(self.cells) / 10)
+
+    def test_nearest(self):
+        '''Test that k-nearest queries match a brute force search, across the 180th meridian too.'''
+        distances = haversine(-29, 30, self.latitudes, self.longitudes)
+        found = asyncio.run(nearest(self.fetch, -29, 30, 10))
+        self.assertEqual([x[0] for x in found], np.argsort(distances)[:10].tolist())
+        found = asyncio.run(nearest(self.fetch, 10, 180, 2))
+        self.assertEqual(sorted(x[0] for x in found), [5000, 5001])
+
+
+class AnalyticsTest(unittest.TestCase):
+    '''Test the following file functions: ../analytics.py'''
+
+    def setUp(self):
+        '''Configure test inputs.'''
+        rng = np.random.default_rng(3)
+        self.columns = dict(
+            Country=rng.choice(np.array(['ZA', 'MZ', 'BR'], dtype=object), 1000),
+            GenusName=rng.choice(np.array(['Eucalyptus', 'Pinus']), 1000),
+            FarmSize=rng.gamma(2, 10, 1000)
+        )
+
+    def tearDown(self):
+        '''Reset test inputs.'''
+        self.columns = None
+
+    def test_group_rows(self):
+        '''Test that rows are grouped by the combination of their keys, groups in sorted order.'''
+        keys, groups = group_rows([np.array(['b', 'a', 'b', 'a']), np.array([1, 2, 1, 1])])
+        self.assertEqual([x.tolist() for x in keys], [['a', 'a', 'b'], [1, 2, 1]])
+        self.assertEqual(groups.tolist(), [2, 1, 2, 0])
+
+    def test_group_by(self):
+        '''Test that the aggregates of each group match NumPy reductions over that group.'''
+        result = group_by(self.columns, keys=['Country', 'GenusName'], metrics=['FarmSize'], percentiles=[0, 50, 90], bins=5)
+        self.assertEqual(len(result['groups']), 6)
+        self.assertEqual(result['groups'][0]['group'], dict(Country='BR', GenusName='Eucalyptus'))
+        self.assertEqual(sum(x['count'] for x in result['groups']), 1000)
+
+        edges = np.array(result['edges']['FarmSize'])
+        for item in result['groups']:
+            mask = (self.columns['Country'] == item['group']['Country']) & (self.columns['GenusName'] == item['group']['GenusName'])
+            values, aggregates = self.columns['FarmSize'][mask], item['FarmSize']
+            self.assertEqual(item['count'], mask.sum())
+            self.assertAlmostEqual(aggregates['sum'], values.sum())
+            self.assertAlmostEqual(aggregates['mean'], values.mean())
+            self.assertEqual((aggregates['min'], aggregates['max']), (values.min(), values.max()))
+            self.assertEqual(list(aggregates['percentiles']), ['p0', 'p50', 'p90'])
+            np.testing.assert_allclose(list(aggregates['percentiles'].values()), np.percentile(values, [0, 50, 90]))
+            self.assertEqual(aggregates['histogram'], np.histogram(values, bins=edges)[0].tolist())
+
+    def test_group_by_all(self):
+        '''Test that all rows are 1 group without keys, and that no rows give no groups.'''
+        result = group_by(self.columns, keys=[], metrics=['FarmSize'], percentiles=[50])
+        self.assertEqual(len(result['groups']), 1)
+        self.assertEqual(result['groups'][0]['group'], {})
+        self.assertNotIn('histogram', result['groups'][0]['FarmSize'])
+        self.assertEqual(group_by(dict(FarmSize=np.array([])), keys=[], metrics=['FarmSize'], percentiles=[50]), dict(groups=[], edges={}))
+
+
+class ColumnarTest(unittest.TestCase):
+    '''Test the following file functions: ../columnar.py'''
+
+    def setUp(self):
+        '''Configure test inputs.'''
+        self.table = ColumnarTable(
+            columns=dict(id='int', FarmId='str', Country='category', FarmSize='float', IsActive='bool', updated_at='datetime'),
+            unique=('FarmId',)
+        )
+        self.time = datetime(2022, 11, 1, 12, 30, 15, 123456, tzinfo=timezone.utc)
+        self.table.upsert(dict(
+            id=[1, 2, 3],
+            FarmId=['F1', 'F2', 'F3'],
+            Country=['ZA', 'MZ', 'ZA'],
+            FarmSize=[1.5, 2.5, 3.5],
+            IsActive=[True, True, False],
+            updated_at=[self.time] * 3
+        ))
+
+    def tearDown(self):
+        '''Reset test inputs.'''
+        self.table = None
+        self.time = None
+
+    def test_encoding(self):
+        '''Test that columns are typed arrays, low-cardinality strings stored once and rows holding their code.'''
+        self.assertEqual(len(self.table), 3)
+        self.assertEqual(self.table.column('FarmSize').dtype, np.float64)
+        self.assertEqual(self.table.column('Country').tolist(), [0, 1, 0])
+        self.assertEqual(self.table.dictionaries['Country'].values, ['ZA', 'MZ'])
+        self.assertEqual(self.table.rows(np.array([2]))[0], dict(id=3, FarmId='F3', Country='ZA', FarmSize=3.5, IsActive=False, updated_at=self.time))
+
+    def test_upsert(self):
+        '''Test that existing rows are overwritten in place, new rows appended, and unique values reindexed.'''
+        updated, inserted = self.table.upsert(dict(
+            id=[2, 4],
+            FarmId=['F2-renamed', 'F4'],
+            Country=['BR', 'ZA'],
+            FarmSize=[20.0, 4.5],
+            IsActive=[False, True],
+            updated_at=[self.time] * 2
+        ))
+        self.assertEqual((updated, inserted), (1, 1))
+        self.assertEqual(len(self.table), 4)
+        self.assertIsNone(self.table.find('FarmId', 'F2'))
+        self.assertEqual(self.table.find('FarmId', 'F2-renamed'), 1)
+        self.assertEqual(self.table.find('id', 4), 3)
+        self.assertEqual(self.table.values('Country', np.arange(4)), ['ZA', 'BR', 'ZA', 'ZA'])
+        self.assertEqual(self.table.values('FarmSize', np.array([1])), [20.0])
+
+    def test_filter(self):
+        '''Test that rows are filtered by equality, dictionary-encoded columns by code.'''
+        self.assertEqual(self.table.filter(dict(Country='ZA')).tolist(), [0, 2])
+        self.assertEqual(self.table.filter(dict(Country='ZA', IsActive=True)).tolist(), [0])
+        self.assertEqual(self.table.filter(dict(Country='NZ')).tolist(), [])
+        self.assertEqual(self.table.filter({}).tolist(), [0, 1, 2])
+
+    def test_nbytes(self):
+        '''Test that the memory footprint accounts for each column and the lookup indexes.'''
+        sizes = self.table.nbytes()
+        self.assertEqual(set(sizes), {'id', 'FarmId', 'Country', 'FarmSize', 'IsActive', 'updated_at', 'indexes'})
+        self.assertEqual(sizes['FarmSize'], len(self.table.arrays['FarmSize']) * 8)
+        self.assertGreater(sizes['FarmId'], sizes['FarmSize'])
+
+
+async def batches(*items):
+    '''Stream batches of rows, as fetched by a server-side cursor.'''
+    for rows in items:
+        yield rows
+
+
+class ExportTest(unittest.TestCase):
+    '''Test the following file functions: ../export.py'''
+
+    def setUp(self):
+        '''Configure test inputs.'''
+        self.columns = ['id', 'name', 'is_active', 'status', 'updated_at']
+        self.time = datetime(2022, 11, 1, 12, 30, tzinfo=timezone.utc)
+        self.rows = [
+            [(1, 'a, "b"', True, Enum('Status', dict(APPROVED='approved')).APPROVED, self.time)],
+            [(2, None, False, None, None)]
+        ]
+
+    def tearDown(self):
+        '''Reset test inputs.'''
+        self.columns = None
+        self.time = None
+        self.rows = None
+
+    def test_select_columns(self):
+        '''Test that all columns are exported by default, and that unknown columns are rejected.'''
+        self.assertEqual(select_columns(['id', 'name'], []), ['id', 'name'])
+        self.assertEqual(select_columns(['id', 'name'], ['name', 'name']), ['name'])
+        with self.assertRaises(ResponseValidationError):
+            select_columns(['id', 'name'], ['hashed_password'])
+
+    def test_csv_chunks(self):
+        '''Test that each batch is 1 chunk, fields formatted as they are ingested and quoted when needed.'''
+        chunks = asyncio.run(collect(csv_chunks(self.columns, batches(*self.rows))))
+        self.assertEqual(len(chunks), 2)
+        self.assertEqual(chunks[0].decode().splitlines(), [
+            'id,name,is_active,status,updated_at',
+            '1,"a, ""b""",true,approved,2022-11-01T12:30:00+00:00'
+        ])
+        self.assertEqual(chunks[1], b'2,,false,,\n')
+        self.assertEqual(asyncio.run(collect(csv_chunks(self.columns, batches()))), [b'id,name,is_active,status,updated_at\n'])
+
+    def test_csv_chunks_nulls(self):
+        '''Test that the fields of a column that is null in the first batch are still formatted in the next ones.'''
+        chunks = asyncio.run(collect(csv_chunks(self.columns, batches(*reversed(self.rows)))))
+        self.assertEqual(chunks[0].decode().splitlines(), ['id,name,is_active,status,updated_at', '2,,false,,'])
+        self.assertEqual(chunks[1], b'1,"a, ""b""",true,approved,2022-11-01T12:30:00+00:00\n')
+
+    def test_ndjson_chunks(self):
+        '''Test that each row is 1 JSON object per line.'''
+        chunks = asyncio.run(collect(ndjson_chunks(['id', 'name'], batches([(1, 'a'), (2, None)]))))
+        self.assertEqual(chunks, [b'{"id":1,"name":"a"}\n{"id":2,"name":null}\n'])
+
+    def test_export_response(self):
+        '''Test that the response is an attachment of the export format, the first batch fetched before it is sent.'''
+        fetched = []
+
+        async def fetch():
+            for rows in [[(1, 'a')], [(2, 'b')]]:
+                fetched.append(rows)
+                yield rows
+
+        async def run():
+            response = await export_response(['id', 'name'], fetch(), 'csv', filename='farms')
+            self.assertEqual(len(fetched), 1)
+            return response, b''.join([x async for x in response.body_iterator])
+
+        response, body = asyncio.run(run())
+        self.assertEqual(response.headers['content-disposition'], 'attachment; filename="farms.csv"')
+        self.assertTrue(response.headers['content-type'].startswith('text/csv'))
+        self.assertEqual(body, b'id,name\n1,a\n2,b\n')
+
+
+class ResponseCacheTest(unittest.TestCase):
+    '''Test the following file functions: ../response_cache.py'''
+
+    def setUp(self):
+        '''Configure test inputs.'''
+        self.version = (5, 1)
+        self.calls = []
+        response_cache.cache.clear()
+
+    def tearDown(self):
+        '''Reset test inputs.'''
+        self.version = None
+        self.calls = None
+        response_cache.cache.clear()
+
+    def get(self, query: str = 'size=10', version: tuple | None = None, headers: dict | None = None) -> Response:
+        '''Respond to a GET /admin request.'''
+        scope = dict(
+            type='http', method='GET', path='/admin', query_string=query.encode(),
+            headers=[(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()]
+        )
+
+        async def compute():
+            self.calls.append(query)
+            return Response(content=f'page {len(self.calls)}', media_type='application/json')
+        return asyncio.run(cached_response(Request(scope), 'admins', version or self.version, compute))
+
+    def test_cached_response(self):
+        '''Test that responses are computed once per table version and query, and served with their validators.'''
+        first = self.get()
+        self.assertEqual(first.status_code, 200)
+        self.assertNotIn('last-modified', first.headers)
+        self.assertEqual(first.headers['cache-control'], 'private, no-cache')
+
+        second = self.get()
+        self.assertEqual((second.body, second.headers['etag']), (first.body, first.headers['etag']))
+        self.assertEqual(second.media_type, 'application/json')
+        self.assertEqual(len(self.calls), 1)
+
+        self.assertNotEqual(self.get(query='size=20').headers['etag'], first.headers['etag'])
+        self.assertNotEqual(self.get(version=(self.version[0] + 1, self.version[1])).headers['etag'], first.headers['etag'])
+        self.assertEqual(len(self.calls), 3)
+
+    def test_not_modified(self):
+        '''Test that a matching If-None-Match gets a 304 response without computing it, and that If-Modified-Since is ignored.'''
+        etag = self.get().headers['etag']
+        response = self.get(headers={'If-None-Match': f'"other", W/{etag}'})
+        self.assertEqual((response.status_code, response.body), (304, b''))
+        self.assertEqual(response.headers['etag'], etag)
+        self.assertEqual(len(self.calls), 1)
+
+        self.assertEqual(self.get(headers={'If-None-Match': '"other"'}).status_code, 200)
+        self.assertEqual(self.get(headers={'If-Modified-Since': 'Tue, 01 Nov 2022 12:30:15 GMT'}).status_code, 200)
+
+    def test_deleted_rows(self):
+        '''Test that a delete, which leaves the latest update time unchanged, changes the validator.'''
+        etag = self.get().headers['etag']
+        response = self.get(version=(self.version[0] + 1, self.version[1] + 1), headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['etag'], etag)
+
+    def test_invalidate(self):
+        '''Test that the responses of a table are computed again once it has been invalidated.'''
+        self.get()
+        response_cache.invalidate('farms')
+        self.get()
+        self.assertEqual(len(self.calls), 1)
+        response_cache.invalidate('admins')
+        self.get()
+        self.assertEqual(len(self.calls), 2)
+
+
+class ProfilingTest(unittest.TestCase):
+    '''Test the following file functions: ../profiling.py'''
+
+    def setUp(self):
+        '''Configure test inputs.'''
+        self.directory = tempfile.TemporaryDirectory()
+        self.events = []
+
+    def tearDown(self):
+        '''Reset test inputs.'''
+        self.directory.cleanup()
+        self.events = None
+
+    def test_phases(self):
+        '''Test that nested phases are excluded from their parent phase, and that nothing is timed outside of a profiled request.'''
+
+        @profiled('crud')
+        async def query():
+            await asyncio.sleep(0.05)
+            return 'row'
+
+        @profiled('dependencies')
+        async def dependency():
+            await asyncio.sleep(0.02)
+            return await query()
+
+        async def run():
+            self.assertEqual(await dependency(), 'row')
+            root = Frame(defaultdict(float))
+            token = current_frame.set(root)
+            try:
+                await dependency()
+                with Phase('serialization'):
+                    pass
+            finally:
+                current_frame.reset(token)
+            return root
+
+        root = asyncio.run(run())
+        self.assertEqual(set(root.phases), {'dependencies', 'crud', 'serialization'})
+        self.assertTrue(0.02 <= root.phases['dependencies'] < 0.05)
+        self.assertGreaterEqual(root.phases['crud'], 0.05)
+        self.assertAlmostEqual(root.children, sum(root.phases.values()), places=6)
+        self.assertEqual(server_timing(dict(crud=0.0125), 0.02), 'crud;dur=12.500, total;dur=20.000')
+
+    def test_generator(self):
+        '''Test that a profiled async generator (dependency with teardown) gets the exceptions and closing of its consumer.'''
+
+        @profiled('dependencies')
+        async def session():
+            self.events.append('open')
+            try:
+                yield 'db'
+            except ValueError as e:
+                self.events.append(f'rollback {e}')
+                raise
+            finally:
+                self.events.append('close')
+
+        async def run():
+            root = Frame(defaultdict(float))
+            token = current_frame.set(root)
+            agen = session()
+            self.assertEqual(await anext(agen), 'db')
+            with self.assertRaises(ValueError):
+                await agen.athrow(ValueError('error'))
+            agen = session()
+            await anext(agen)
+            await agen.aclose()
+            current_frame.reset(token)
+            return root
+
+        root = asyncio.run(run())
+        self.assertEqual(self.events, ['open', 'rollback error', 'close', 'open', 'close'])
+        self.assertIn('dependencies', root.phases)
+
+    def test_sampler(self):
+        '''Test that call stacks are folded outermost frame first.'''
+        sampler = StackSampler(threading.get_ident(), interval=0.001)
+        sampler.sample()
+        stack, count = sampler.stacks.most_common(1)[0]
+        self.assertEqual(count, 1)
+        self.assertTrue(stack.split(';')[-1].startswith('sample (helpers/profiling.py:'))
+        self.assertIn(';test_sampler (', stack)
+
+    def test_ring(self):
+        '''Test that the oldest profiles are deleted once there are more than max_profiles.'''
+        ring = ProfileRing(self.directory.name, max_profiles=2)
+        for index, path in enumerate(['/admin', '/admin/farms/{farm_id}', '/']):
+            ring.write(dict(method='GET', path=path, started_at=1667305800 + index), Counter({'main;handler': 3}))
+        names = ring.names()
+        self.assertEqual(len(names), 2)
+        self.assertTrue(names[0].startswith('1667305801000-') and names[0].endswith('-GET-admin_farms_farm_id'))
+        self.assertEqual([x['path'] for x in ring.summaries()], ['/', '/admin/farms/{farm_id}'])
+        with open(os.path.join(self.directory.name, f'{names[1]}.folded'), encoding='utf-8') as f:
+            self.assertEqual(f.read(), 'main;handler 3\n')
+        self.assertEqual(len(os.listdir(self.directory.name)), 4)
+
+
+class MetricsTest(unittest.TestCase):
+    '''Test the following file functions: ../metrics.py'''
+
+    def setUp(self):
+        '''Configure test inputs.'''
+        self.directory = tempfile.TemporaryDirectory()
+        self.registry = MetricsRegistry()
+        self.requests = self.registry.counter('http_requests_total', 'HTTP requests.', ('route', 'status'))
+        self.latency = self.registry.histogram('http_request_duration_seconds', 'HTTP request latency.', ('route',), buckets=(0.1, 1.0))
+
+    def tearDown(self):
+        '''Reset test inputs.'''
+        self.directory.cleanup()
+        self.registry = None
+        self.requests = None
+        self.latency = None
+
+    def test_render(self):
+        '''Test the Prometheus text format: cumulative buckets, sum and count of histograms, escaped label values.'''
+        self.requests.inc(('/admin', '200'))
+        self.requests.inc(('/admin', '200'))
+        self.requests.inc(('say "hi"\n', '404'))
+        for value in [0.05, 0.1, 0.5, 3]:
+            self.latency.observe(('/admin',), value)
+        self.assertRaises(ValueError, self.registry.counter, 'http_requests_total', 'HTTP requests.')
+
+        text = render(merge([self.registry.state()]))
+        self.assertIn('# TYPE http_requests_total counter\nhttp_requests_total{route="/admin",status="200"} 2\n', text)
+        self.assertIn('http_requests_total{route="say \\"hi\\"\\n",status="404"} 1\n', text)
+        self.assertIn(
+            'http_request_duration_seconds_bucket{route="/admin",le="0.1"} 2\n'
+            'http_request_duration_seconds_bucket{route="/admin",le="1.0"} 3\n'
+            'http_request_duration_seconds_bucket{route="/admin",le="+Inf"} 4\n'
+            'http_request_duration_seconds_sum{route="/admin"} 3.65\n'
+            'http_request_duration_seconds_count{route="/admin"} 4\n', text
+        )
+
+    def test_merge(self):
+        '''Test that the metrics of several worker processes are added up, histograms bucket by bucket.'''
+        self.requests.inc(('/admin', '200'), 3)
+        self.latency.observe(('/admin',), 0.5)
+        other = MetricsRegistry()
+        other.counter('http_requests_total', 'HTTP requests.', ('route', 'status')).inc(('/admin', '500'))
+        other.histogram('http_request_duration_seconds', 'HTTP request latency.', ('route',), buckets=(0.1, 1.0)).observe(('/admin',), 2)
+
+        merged = merge([self.registry.state(), json.loads(json.dumps(other.state()))])
+        self.assertEqual(dict(merged['http_requests_total']['samples']), {('/admin', '200'): 3, ('/admin', '500'): 1})
+        self.assertEqual(dict(merged['http_request_duration_seconds']['samples']), {('/admin',): [[0, 1, 1], 2.5]})
+        self.assertEqual(self.latency.values[('/admin',)], [[0, 1, 0], 0.5])
+
+    def test_publisher(self):
+        '''Test that the metrics of the other worker processes are read, and that the stale ones are retired and counted once.'''
+        self.requests.inc(('/admin', '200'))
+        publisher = MetricsPublisher(self.registry)
+        publisher.write(self.directory.name)
+        self.assertEqual(publisher.read(self.directory.name, max_age=15), [])
+
+        for pid, age in [(1, 0), (2, 60)]:
+            path = os.path.join(self.directory.name, f'{pid}.json')
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(self.registry.state(), f)
+            os.utime(path, (time.time() - age, time.time() - age))
+        states = publisher.read(self.directory.name, max_age=15)
+        self.assertEqual(len(states), 2)
+        self.assertFalse(os.path.exists(os.path.join(self.directory.name, '2.json')))
+        self.assertEqual(dict(merge(states)['http_requests_total']['samples']), {('/admin', '200'): 2})
+        states = publisher.read(self.directory.name, max_age=15)
+        self.assertEqual(dict(merge(states)['http_requests_total']['samples']), {('/admin', '200'): 2})
+
+    def test_statement_operation(self):
+        '''Test that statements are labelled by their first keyword.'''
+        self.assertEqual(statement_operation('\n  SELECT id FROM farms'), 'SELECT')
+        self.assertEqual(statement_operation('(select 1) union (select 2)'), 'SELECT')
+        self.assertEqual(statement_operation('ANALYZE farms_staging'), 'OTHER')
+        self.assertEqual(statement_operation(''), 'OTHER')
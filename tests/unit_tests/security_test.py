@@ -0,0 +1,211 @@
+'''This module performs Unit tests on the following directory: ./security/'''
+
+import asyncio
+import time
+import unittest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from fastapi import HTTPException
+from fastapi.security import HTTPAuthorizationCredentials
+from jose import jwt, JWTError
+
+from apis.schemas.admin import Admin
+from security.dependencies import verify_scrape_token
+from security.hashing import SCHEMES, HmacSha3, Scrypt, SecureHash
+from security.principals import PrincipalCache, PrincipalListener
+from security.tokens import KeyRing, SigningKey
+
+
+class HashingTest(unittest.TestCase):
+    '''Test the following file functions: ../hashing.py'''
+
+    def setUp(self):
+        '''Configure test inputs.'''
+        self.password = 'this-is-a-test-password'
+        self.legacy = HmacSha3(key='test-key')
+        self.scrypt = Scrypt(cost=2 ** 10, block_size=8, parallelism=1)
+
+    def tearDown(self):
+        '''Reset test inputs.'''
+        self.password = None
+        self.legacy = None
+        self.scrypt = None
+
+    def test_schemes(self):
+        '''Test that each scheme verifies its own hashes only for the right password.'''
+        for scheme in [self.legacy, self.scrypt]:
+            hash = scheme.create(self.password)
+            self.assertTrue(scheme.verify(self.password, hash))
+            self.assertFalse(scheme.verify('wrong-password', hash))
+
+        hash = self.scrypt.create(self.password)
+        self.assertTrue(hash.startswith('scrypt$n=1024,r=8,p=1$'))
+        self.assertNotEqual(hash, self.scrypt.create(self.password))
+        self.assertFalse(self.scrypt.needs_update(hash))
+        self.assertTrue(Scrypt(cost=2 ** 11, block_size=8, parallelism=1).needs_update(hash))
+
+    def test_secure_hash(self):
+        '''Test the default scheme, legacy hashes detection and the asynchronous API.'''
+        hash = asyncio.run(SecureHash.create_async(self.password))
+        self.assertTrue(asyncio.run(SecureHash.verify_async(self.password, hash)))
+        self.assertFalse(SecureHash.needs_rehash(hash))
+
+        legacy_hash = SCHEMES[HmacSha3.name].create(self.password)
+        self.assertTrue(SecureHash.verify(self.password, legacy_hash))
+        self.assertTrue(SecureHash.needs_rehash(legacy_hash))
+
+
+class PrincipalsTest(unittest.TestCase):
+    '''Test the following file functions: ../principals.py'''
+
+    def setUp(self):
+        '''Configure test inputs.'''
+        self.cache = PrincipalCache(ttl=60, maxsize=2)
+        self.expires_at = time.time() + 300
+
+    def tearDown(self):
+        '''Reset test inputs.'''
+        self.cache = None
+        self.expires_at = None
+
+    def test_cache(self):
+        '''Test principals caching, LRU eviction and invalidation.'''
+        for username in ['admin1', 'admin2']:
+            self.cache.set(Admin(username=username, is_active=True), expires_at=self.expires_at)
+        self.assertTrue(self.cache.get('admin1').is_active)
+
+        self.cache.set(Admin(username='admin3', is_active=False), expires_at=self.expires_at)
+        self.assertIsNone(self.cache.get('admin2'))
+        self.assertFalse(self.cache.get('admin3').is_active)
+
+        self.cache.invalidate('admin1')
+        self.assertIsNone(self.cache.get('admin1'))
+
+    def test_token_expiry(self):
+        '''Test that principals are never cached beyond their token expiration.'''
+        self.cache.set(Admin(username='admin1', is_active=True), expires_at=time.time() - 1)
+        self.assertIsNone(self.cache.get('admin1'))
+
+        self.cache.set(Admin(username='admin1', is_active=True), expires_at=time.time() + 0.05)
+        self.assertIsNotNone(self.cache.get('admin1'))
+        time.sleep(0.1)
+        self.assertIsNone(self.cache.get('admin1'))
+
+    def test_invalidated_load(self):
+        '''Test that a principal loaded before its invalidation is not cached, nor shared with the requests that follow it.'''
+        loads = []
+
+        async def run():
+            started = asyncio.Event()
+
+            async def load_admin():
+                load = len(loads)
+                loads.append(load)
+                started.set()
+                await asyncio.sleep(0.05)
+                return Admin(username='admin1', is_active=load > 0)  # activated while the first load runs
+
+            first = asyncio.create_task(self.cache.load('admin1', expires_at=self.expires_at, func=load_admin))
+            await started.wait()
+            self.cache.invalidate('admin1')
+            second = await self.cache.load('admin1', expires_at=self.expires_at, func=load_admin)
+            return await first, second
+
+        first, second = asyncio.run(run())
+        self.assertEqual(loads, [0, 1])
+        self.assertFalse(first.is_active)
+        self.assertTrue(second.is_active)
+        self.assertTrue(self.cache.get('admin1').is_active)
+
+    def test_listener_gap(self):
+        '''Test that principals are not cached while the listening connection is down, and that they are dropped once it is back.'''
+        listener = PrincipalListener(cache=self.cache)
+        self.cache.set(Admin(username='admin1', is_active=True), expires_at=self.expires_at)
+
+        async def terminate():
+            listener.on_termination(None)
+            listener.task.cancel()
+        asyncio.run(terminate())
+        self.assertIsNone(self.cache.get('admin1'))
+        self.cache.set(Admin(username='admin1', is_active=True), expires_at=self.expires_at)
+        self.assertIsNone(self.cache.get('admin1'))
+
+        epoch = self.cache.epoch
+        self.cache.resume()
+        self.cache.set(Admin(username='admin1', is_active=True), expires_at=self.expires_at, epoch=epoch)
+        self.assertIsNone(self.cache.get('admin1'))
+        self.cache.set(Admin(username='admin1', is_active=True), expires_at=self.expires_at)
+        self.assertIsNotNone(self.cache.get('admin1'))
+
+
+class TokensTest(unittest.TestCase):
+    '''Test the following file functions: ../tokens.py'''
+
+    def setUp(self):
+        '''Configure test inputs.'''
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.private_pem = private_key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()).decode()
+        self.public_pem = private_key.public_key().public_bytes(
+            serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo).decode()
+        self.claims = {'username': 'admin', 'exp': time.time() + 60}
+
+    def tearDown(self):
+        '''Reset test inputs.'''
+        self.private_pem = None
+        self.public_pem = None
+        self.claims = None
+
+    def test_rotation(self):
+        '''Test that tokens signed by a retiring key are still verified once a new key is active.'''
+        old_key = SigningKey(kid='old', algorithm='HS256', key='old-secret')
+        old_token = jwt.encode(self.claims, old_key.private, algorithm='HS256', headers={'kid': 'old'})
+
+        key_ring = KeyRing(
+            keys=[SigningKey(kid='old', algorithm='HS256', key='old-secret'), SigningKey(kid='new', algorithm='RS256', key=self.private_pem)],
+            active_kid='new'
+        )
+        new_token = jwt.encode(self.claims, key_ring.active.private, algorithm='RS256', headers={'kid': 'new'})
+
+        for token in [old_token, new_token]:
+            key = key_ring.get(jwt.get_unverified_header(token).get('kid'))
+            self.assertEqual(jwt.decode(token, key.public, algorithms=[key.algorithm])['username'], 'admin')
+
+        with self.assertRaises(JWTError):
+            key_ring.get('unknown')
+
+    def test_verify_only_key(self):
+        '''Test that a retiring key without private key verifies tokens but can not be the active key.'''
+        key = SigningKey(kid='retiring', algorithm='RS256', public_key=self.public_pem)
+        self.assertFalse(key.can_sign)
+        with self.assertRaises(ValueError):
+            KeyRing(keys=[key], active_kid='retiring')
+
+        token = jwt.encode(self.claims, self.private_pem, algorithm='RS256')
+        self.assertEqual(jwt.decode(token, key.public, algorithms=['RS256'])['username'], 'admin')
+
+    def test_missing_key(self):
+        '''Test that a key that can not verify tokens is rejected with a clear error.'''
+        for algorithm, public_key in [('RS256', None), ('HS256', None), ('HS256', 'secret')]:
+            with self.assertRaisesRegex(ValueError, '^JWT key typo needs a'):
+                SigningKey(kid='typo', algorithm=algorithm, public_key=public_key)
+
+
+class ScrapeTokenTest(unittest.TestCase):
+    '''Test the following file functions: ../dependencies.py'''
+
+    def setUp(self):
+        '''Configure test inputs.'''
+        self.credentials = HTTPAuthorizationCredentials(scheme='Bearer', credentials='scrape-token')
+
+    def tearDown(self):
+        '''Reset test inputs.'''
+        self.credentials = None
+
+    def test_unset_token(self):
+        '''Test that metrics scrapes are rejected, with or without a bearer token, while METRICS.TOKEN is not set.'''
+        for credentials in [None, self.credentials, HTTPAuthorizationCredentials(scheme='Bearer', credentials='')]:
+            with self.assertRaises(HTTPException) as context:
+                asyncio.run(verify_scrape_token(credentials))
+            self.assertEqual(context.exception.status_code, 401)
+            self.assertEqual(context.exception.headers, {'WWW-Authenticate': 'Bearer'})